@@ -491,6 +491,41 @@ class BasicProcessor(FourcatModule, BasicWorker, metaclass=abc.ABCMeta):
 
 		return staging_area
 
+	def get_checkpoint_path(self, name, parameters=None):
+		"""
+		Get a folder to keep intermediate results in until processing is done
+
+		The folder is in the dataset's cache area, so unlike a staging area
+		it is kept when the processor is interrupted, and results in it can be
+		re-used when the processor runs again. The processor should remove it
+		once it has finished.
+
+		Results are only valid for the parameters they were made with, so
+		these are stored in the folder; if it turns out to have been created
+		for different parameters, it is emptied first.
+
+		:param str name:  Name of the folder
+		:param parameters:  Parameters the results depend on; should be
+		serialisable as JSON. By default, the processor's parameters.
+		:return Path:  Path to the folder
+		"""
+		checkpoint_path = self.dataset.get_cache_area().joinpath(name)
+		parameters_path = checkpoint_path.joinpath("parameters.json")
+		parameters = json.dumps(self.parameters if parameters is None else parameters, sort_keys=True)
+
+		if checkpoint_path.exists():
+			try:
+				if parameters_path.read_text(encoding="utf-8") == parameters:
+					return checkpoint_path
+			except FileNotFoundError:
+				pass
+
+			shutil.rmtree(checkpoint_path)
+
+		checkpoint_path.mkdir(parents=True)
+		parameters_path.write_text(parameters, encoding="utf-8")
+		return checkpoint_path
+
 	def write_csv_items_and_finish(self, data):
 		"""
 		Write data as csv to results file and finish dataset
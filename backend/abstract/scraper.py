@@ -2,6 +2,7 @@
 Basic scraper worker - should be inherited by workers to scrape specific types of content
 """
 import collections
+import threading
 import requests
 import random
 import json
@@ -24,6 +25,18 @@ class BasicHTTPScraper(BasicWorker, metaclass=abc.ABCMeta):
 	log_level = "warning"
 	_logger_method = None
 
+	# HTTP sessions, per scraper type, so connections can be re-used between
+	# jobs
+	sessions = {}
+
+	# ETag and Last-Modified headers of the last successfully processed
+	# response per URL, per scraper type, so unchanged resources are not
+	# downloaded and processed again
+	validators = {}
+	max_validators = 100000
+
+	session_lock = threading.Lock()
+
 	def __init__(self, job, logger=None, manager=None, modules=None):
 		"""
 		Set up database connection - we need one to store the thread data
@@ -72,8 +85,11 @@ class BasicHTTPScraper(BasicWorker, metaclass=abc.ABCMeta):
 				else:
 					proxies = None
 
-				# do the request!
-				data = requests.get(url, timeout=config.get('SCRAPE_TIMEOUT', 60), proxies=proxies, headers={"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.1 Safari/605.1.15"})
+				# do the request! only get the data if it has changed since
+				# we last processed it
+				headers = {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.1 Safari/605.1.15"}
+				headers.update(self.get_validators(url))
+				data = self.get_session().get(url, timeout=config.get('SCRAPE_TIMEOUT', 60), proxies=proxies, headers=headers)
 			except (requests.exceptions.RequestException, ConnectionRefusedError) as e:
 				if self.job.data["attempts"] > 2:
 					self.job.finish()
@@ -92,6 +108,10 @@ class BasicHTTPScraper(BasicWorker, metaclass=abc.ABCMeta):
 			# this should be handled differently from an actually erroneous response
 			# because it may indicate that the resource has been deleted
 			self.not_found()
+		elif data.status_code == 304:
+			# nothing new since the last time
+			self.log.debug("Data for %s %s not modified since last scrape" % (self.type, id))
+			self.not_modified()
 		else:
 			parsed_data = self.parse(data.content)
 			if parsed_data is None:
@@ -105,7 +125,10 @@ class BasicHTTPScraper(BasicWorker, metaclass=abc.ABCMeta):
 				return
 
 			# finally, pass it on
-			self.process(parsed_data)
+			processed = self.process(parsed_data)
+			if processed is not False and "file" not in self.job.details:
+				self.remember_validators(url, data.headers)
+
 			self.after_process()
 
 	def after_process(self):
@@ -121,6 +144,77 @@ class BasicHTTPScraper(BasicWorker, metaclass=abc.ABCMeta):
 		"""
 		self.job.finish()
 
+	def not_modified(self):
+		"""
+		Called if the request returned a 304 response, i.e. the data has not
+		changed since it was last processed, so there is nothing to do.
+		"""
+		self.job.finish()
+
+	@classmethod
+	def get_session(cls):
+		"""
+		Get HTTP session for this type of scraper
+
+		The session is shared by all workers of this type, so connections to
+		the scraped host are kept alive and re-used between jobs, rather than
+		set up anew for every request. Each worker can use one connection per
+		host at a time.
+
+		:return requests.Session:
+		"""
+		with cls.session_lock:
+			if cls.type not in cls.sessions:
+				session = requests.Session()
+				adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(1, cls.max_workers))
+				session.mount("http://", adapter)
+				session.mount("https://", adapter)
+				cls.sessions[cls.type] = session
+
+			return cls.sessions[cls.type]
+
+	def get_validators(self, url):
+		"""
+		Get conditional request headers for a URL
+
+		:param str url:  URL that will be requested
+		:return dict:  `If-None-Match` and/or `If-Modified-Since` headers, if
+		the URL was successfully processed before
+		"""
+		with self.session_lock:
+			etag, last_modified = self.validators.get(self.type, {}).get(url, (None, None))
+
+		headers = {}
+		if etag:
+			headers["If-None-Match"] = etag
+		if last_modified:
+			headers["If-Modified-Since"] = last_modified
+
+		return headers
+
+	def remember_validators(self, url, response_headers):
+		"""
+		Store the validators of a successfully processed response
+
+		Only a limited amount of URLs is remembered; the least recently
+		processed ones are forgotten first.
+
+		:param str url:  URL that was requested
+		:param response_headers:  Headers of the response to that URL
+		"""
+		etag = response_headers.get("ETag")
+		last_modified = response_headers.get("Last-Modified")
+
+		with self.session_lock:
+			validators = self.validators.setdefault(self.type, collections.OrderedDict())
+			validators.pop(url, None)
+			if not etag and not last_modified:
+				return
+
+			validators[url] = (etag, last_modified)
+			while len(validators) > self.max_validators:
+				validators.popitem(last=False)
+
 	def parse(self, data):
 		"""
 		Parse incoming data
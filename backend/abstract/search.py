@@ -83,7 +83,11 @@ class Search(BasicProcessor, ABC):
 			else:
 				raise NotImplementedError("Datasource query cannot be saved as %s file" % results_file.suffix)
 
-			self.dataset.update_status("Query finished, results are available.")
+			if num_items > 0:
+				self.dataset.update_status("Query finished, results are available.")
+			else:
+				# items can be a generator, which is only empty once iterated
+				self.dataset.update_status("Query finished, no results found.")
 		elif items is not None:
 			self.dataset.update_status("Query finished, no results found.")
 
@@ -390,9 +394,22 @@ class SearchWithScope(Search, ABC):
 		if query.get("search_scope", None) == "dense-threads":
 			# dense threads - all items in all threads in which the requested
 			# proportion of items matches
-			# first, get amount of items for all threads in which matching
-			# items occur and that are long enough
-			thread_ids = tuple([post["thread_id"] for post in items])
+			# first, determine how many matching items occur per thread in the
+			# initial data set (in one pass, since items may be streamed)
+			items_per_thread = {}
+			for item in items:
+				if item["thread_id"] not in items_per_thread:
+					items_per_thread[item["thread_id"]] = 0
+
+				items_per_thread[item["thread_id"]] += 1
+
+			# then get amount of items for all threads in which matching items
+			# occur and that are long enough
+			thread_ids = tuple(items_per_thread.keys())
+			if not thread_ids:
+				# items were streamed, and there turned out to be none
+				return None
+
 			self.dataset.update_status("Retrieving thread metadata for %i threads" % len(thread_ids))
 			try:
 				min_length = int(query.get("scope_length", 30))
@@ -401,15 +418,6 @@ class SearchWithScope(Search, ABC):
 
 			thread_sizes = self.get_thread_sizes(thread_ids, min_length)
 
-			# determine how many matching items occur per thread in the initial
-			# data set
-			items_per_thread = {}
-			for item in items:
-				if item["thread_id"] not in items_per_thread:
-					items_per_thread[item["thread_id"]] = 0
-
-				items_per_thread[item["thread_id"]] += 1
-
 			# keep all thread IDs where that amount is more than the requested
 			# density
 			qualifying_thread_ids = set()
@@ -444,6 +452,10 @@ class SearchWithScope(Search, ABC):
 		elif query.get("search_scope", None) == "full-threads":
 			# get all items in threads containing at least one matching item
 			thread_ids = tuple(set([item["thread_id"] for item in items]))
+			if not thread_ids:
+				# items were streamed, and there turned out to be none
+				return None
+
 			if len(thread_ids) > 25000:
 				self.dataset.update_status(
 					"Too many matching threads (%i) to get full thread data for, aborting. Please try again with a narrower query." % len(
@@ -29,6 +29,15 @@ class BasicWorker(threading.Thread, metaclass=abc.ABCMeta):
 	#: are easily violated.
 	max_workers = 1
 
+	#: Whether to run this worker in a separate process rather than a thread.
+	#: Set this for CPU-bound workers, which would otherwise compete with all
+	#: other workers for the same interpreter lock. Such workers run via
+	#: `backend.lib.worker_process`, with their own database connection; their
+	#: log records are passed to the back-end process. Only workers running in
+	#: their own process can spawn further processes, e.g. via
+	#: `DataSet.map_chunks()`.
+	run_in_process = False
+
 	#: Flag value to indicate worker interruption type - not interrupted
 	INTERRUPT_NONE = False
 
@@ -68,7 +77,8 @@ class BasicWorker(threading.Thread, metaclass=abc.ABCMeta):
 		Set up object attributes, e.g. the worker queue and manager, and
 		initialize a new database connection and connected job queue. We cannot
 		share database connections between workers because they are not
-		thread-safe.
+		thread-safe, but if the manager has a connection pool, the connection
+		is checked out from it for the duration of the job.
 
 		:param Logger logger:  Logging interface
 		:param Job job:  Job this worker is being run on
@@ -89,7 +99,7 @@ class BasicWorker(threading.Thread, metaclass=abc.ABCMeta):
 		self.all_modules = modules
 
 		database_appname = "%s-%s" % (self.type, self.job.data["id"])
-		self.db = Database(logger=self.log, appname=database_appname)
+		self.db = Database(logger=self.log, appname=database_appname, pool=getattr(manager, "db_pool", None))
 		self.queue = JobQueue(logger=self.log, database=self.db) if not queue else queue
 
 	def run(self):
@@ -128,6 +138,9 @@ class BasicWorker(threading.Thread, metaclass=abc.ABCMeta):
 			location = "->".join(frames)
 			self.log.error("Worker %s raised exception %s and will abort: %s at %s" % (self.type, e.__class__.__name__, str(e), location))
 			self.job.add_status("Crash during execution")
+		finally:
+			# return the connection to the pool, if it came from one
+			self.db.close()
 
 	def abort(self):
 		"""
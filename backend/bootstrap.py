@@ -7,9 +7,10 @@ import os
 from pathlib import Path
 
 from common.lib.queue import JobQueue
-from common.lib.database import Database
+from common.lib.database import Database, DatabasePool
 from backend.lib.manager import WorkerManager
 from common.lib.logger import Logger
+from common.lib.helpers import convert_to_int
 
 import common.config_manager as config
 
@@ -57,13 +58,17 @@ def run(as_daemon=True):
 	db = Database(logger=log, appname="main")
 	queue = JobQueue(logger=log, database=db)
 
+	# workers check out their connection from a shared pool, if configured
+	pool_size = convert_to_int(config.get("4cat.db_pool_size"), 50)
+	db_pool = DatabasePool(size=pool_size, appname="worker") if pool_size > 0 else None
+
 	# clean up after ourselves
 	db.commit()
 	queue.release_all()
 
 	# make it happen
 	# this is blocking until the back-end is shut down
-	WorkerManager(logger=log, database=db, queue=queue, as_daemon=as_daemon)
+	WorkerManager(logger=log, database=db, queue=queue, as_daemon=as_daemon, db_pool=db_pool)
 
 	# clean up pidfile, if running as daemon
 	if as_daemon:
@@ -31,6 +31,13 @@ CREATE UNIQUE INDEX IF NOT EXISTS unique_job
     remote_id
   );
 
+-- used to quickly find jobs that may be claimed
+CREATE INDEX IF NOT EXISTS jobs_claimable
+  ON jobs (
+    jobtype,
+    timestamp
+  ) WHERE timestamp_claimed = 0;
+
 
 -- queries
 CREATE TABLE IF NOT EXISTS datasets (
@@ -54,6 +61,17 @@ CREATE TABLE IF NOT EXISTS datasets (
   annotation_fields text DEFAULT ''
 );
 
+CREATE INDEX IF NOT EXISTS datasets_key
+  ON datasets (
+    key
+  );
+
+-- used to retrieve dataset trees
+CREATE INDEX IF NOT EXISTS datasets_key_parent
+  ON datasets (
+    key_parent
+  );
+
 -- annotations
 CREATE TABLE IF NOT EXISTS annotations (
   key               text UNIQUE PRIMARY KEY,
@@ -5,7 +5,8 @@ import signal
 import time
 
 from backend import all_modules
-from common.lib.exceptions import JobClaimedException
+from backend.lib.worker_process import WorkerProcess
+from common.lib.database import Database
 
 
 class WorkerManager:
@@ -14,6 +15,8 @@ class WorkerManager:
 	"""
 	queue = None
 	db = None
+	db_pool = None
+	listener = None
 	log = None
 
 	worker_pool = {}
@@ -21,7 +24,7 @@ class WorkerManager:
 	pool = []
 	looping = True
 
-	def __init__(self, queue, database, logger, as_daemon=True):
+	def __init__(self, queue, database, logger, as_daemon=True, db_pool=None):
 		"""
 		Initialize manager
 
@@ -29,11 +32,18 @@ class WorkerManager:
 		:param database:  Database handler
 		:param logger:  Logger object
 		:param bool as_daemon:  Whether the manager is being run as a daemon
+		:param DatabasePool db_pool:  Connection pool workers check out their
+		database connection from. If `None`, each worker opens its own.
 		"""
 		self.queue = queue
 		self.db = database
+		self.db_pool = db_pool
 		self.log = logger
 
+		# separate connection that is only used to wait for new jobs
+		self.listener = Database(logger=self.log, appname="listener")
+		self.listener.listen(self.queue.CHANNEL)
+
 		if as_daemon:
 			signal.signal(signal.SIGTERM, self.abort)
 			signal.signal(signal.SIGINT, self.request_interrupt)
@@ -56,11 +66,10 @@ class WorkerManager:
 		"""
 		Delegate work
 
-		Checks for open jobs, and then passes those to dedicated workers, if
-		slots are available for those workers.
+		Checks which job types have worker slots available, claims open jobs
+		for those types, and passes them to dedicated workers. Then waits
+		until new jobs are queued or a second has passed.
 		"""
-		jobs = self.queue.get_all_jobs()
-
 		num_active = sum([len(self.worker_pool[jobtype]) for jobtype in self.worker_pool])
 		self.log.debug("Running workers: %i" % num_active)
 
@@ -74,29 +83,37 @@ class WorkerManager:
 
 			del all_workers
 
-		# check if workers are available for unclaimed jobs
-		for job in jobs:
-			jobtype = job.data["jobtype"]
+		# only ask for jobs of types that have open worker slots
+		slots = {}
+		for jobtype, worker_class in all_modules.workers.items():
+			free_slots = worker_class.max_workers - len(self.worker_pool.get(jobtype, []))
+			if free_slots > 0:
+				slots[jobtype] = free_slots
 
-			if jobtype in all_modules.workers:
-				worker_class = all_modules.workers[jobtype]
-				if jobtype not in self.worker_pool:
-					self.worker_pool[jobtype] = []
-
-				# if a job is of a known type, and that job type has open
-				# worker slots, start a new worker to run it
-				if len(self.worker_pool[jobtype]) < worker_class.max_workers:
-					try:
-						self.log.debug("Starting new worker for job %s" % jobtype)
-						job.claim()
-						worker = worker_class(logger=self.log, manager=self, job=job, modules=all_modules)
-						worker.start()
-						self.worker_pool[jobtype].append(worker)
-					except JobClaimedException:
-						# it's fine
-						pass
-
-		time.sleep(1)
+		# workers need a database connection; if not enough are available from
+		# the pool, claim fewer jobs and wait until other workers have finished
+		limit = self.db_pool.available() if self.db_pool else None
+		if limit is not None and limit < 1:
+			self.log.debug("No database connections available for new workers")
+
+		for job in self.queue.claim_jobs(slots, limit=limit):
+			jobtype = job.data["jobtype"]
+			worker_class = all_modules.workers[jobtype]
+			if jobtype not in self.worker_pool:
+				self.worker_pool[jobtype] = []
+
+			if worker_class.run_in_process:
+				self.log.debug("Starting new worker process for job %s" % jobtype)
+				worker = WorkerProcess(worker_class, logger=self.log, job=job, manager=self)
+			else:
+				self.log.debug("Starting new worker for job %s" % jobtype)
+				worker = worker_class(logger=self.log, manager=self, job=job, modules=all_modules)
+			worker.start()
+			self.worker_pool[jobtype].append(worker)
+
+		# wait for new jobs to be queued, but check again after a second in any
+		# case, e.g. for jobs with a delay or workers that have finished
+		self.listener.wait_for_notifications(timeout=1)
 
 	def loop(self):
 		"""
@@ -127,6 +144,11 @@ class WorkerManager:
 				self.log.info("Waiting for worker %s..." % jobtype)
 				worker.join()
 
+		if self.db_pool:
+			self.db_pool.close()
+
+		self.listener.close()
+
 		time.sleep(3)
 
 		# abort
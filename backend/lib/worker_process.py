@@ -0,0 +1,216 @@
+"""
+Run a single worker in a separate process
+
+Workers are threads in the backend's process, so CPU-bound workers compete for
+the same interpreter lock. Workers that set `run_in_process` are instead run
+via this module in a child process with its own database connection. The
+manager keeps track of it through a `WorkerProcess` object that behaves like a
+worker thread as far as the manager is concerned.
+
+The child process does not write to the log file itself; it passes its log
+records to the back-end process through a pipe, where they are logged with the
+back-end's logger.
+"""
+import subprocess
+import traceback
+import threading
+import signal
+import types
+import json
+import time
+import sys
+import os
+
+import common.config_manager as config
+
+
+class WorkerProcess:
+	"""
+	Stand-in for a worker thread, for workers running in a child process
+
+	The job is passed to the child process via its stdin, followed by any
+	interrupt requests; the worker in the child process then handles them like
+	it would in a thread.
+	"""
+	type = None
+	name = None
+	log = None
+	job = None
+	manager = None
+	process = None
+	log_reader = None
+	interrupted = False
+	init_time = 0
+
+	def __init__(self, worker_class, logger, job, manager=None):
+		"""
+		Set up worker process
+
+		:param worker_class:  Class of the worker to run
+		:param Logger logger:  Logging interface
+		:param Job job:  Job the worker is run for
+		:param WorkerManager manager:  Scheduler instance that started the worker
+		"""
+		self.type = worker_class.type
+		self.name = self.type
+		self.log = logger
+		self.job = job
+		self.manager = manager
+		self.init_time = int(time.time())
+
+		# the manager uses this to cancel the worker's running queries; the
+		# child process connects with the same application name
+		self.db = types.SimpleNamespace(appname="4CAT-%s-%s" % (self.type, self.job.data["id"]))
+
+	def start(self):
+		"""
+		Start the child process
+		"""
+		log_read, log_write = os.pipe()
+		try:
+			self.process = subprocess.Popen(
+				[sys.executable, "-m", "backend.lib.worker_process", self.type, str(log_write)],
+				stdin=subprocess.PIPE, cwd=str(config.get("PATH_ROOT")), pass_fds=(log_write,))
+		finally:
+			os.close(log_write)
+
+		self.log_reader = threading.Thread(target=self.forward_logs, args=(os.fdopen(log_read, encoding="utf-8"),),
+										   daemon=True)
+		self.log_reader.start()
+
+		self.process.stdin.write((json.dumps(self.job.data) + "\n").encode("utf-8"))
+		self.process.stdin.flush()
+
+	def forward_logs(self, pipe):
+		"""
+		Log records passed on by the child process
+
+		Runs in a separate thread until the child process closes the pipe.
+
+		:param pipe:  Read end of the pipe the child process writes its log
+		records to
+		"""
+		with pipe:
+			for line in pipe:
+				try:
+					record = json.loads(line)
+				except json.JSONDecodeError:
+					continue
+
+				frame = traceback.FrameSummary(record["filename"], record["lineno"], record["name"], lookup_line=False)
+				self.log.log(record["message"], record["level"], frame=frame)
+
+	def is_alive(self):
+		"""
+		Check whether the child process is still running
+
+		:return bool:
+		"""
+		return self.process is not None and self.process.poll() is None
+
+	def join(self, timeout=None):
+		"""
+		Wait for the child process to end
+
+		:param timeout:  Seconds to wait at most, or `None` to wait until the
+		process has ended
+		"""
+		if not self.process:
+			return
+
+		try:
+			self.process.wait(timeout=timeout)
+		except subprocess.TimeoutExpired:
+			return
+
+		# make sure everything the worker logged has been logged
+		self.log_reader.join()
+
+		if self.process.stdin.closed:
+			# already joined before
+			return
+
+		self.process.stdin.close()
+		if self.process.returncode != 0:
+			self.log.error("Process for worker %s (job %s) exited with code %i" % (
+				self.type, self.job.data["id"], self.process.returncode))
+
+	def request_interrupt(self, level=1):
+		"""
+		Pass an interrupt request to the worker in the child process
+
+		:param int level:  Retry or cancel? Either `INTERRUPT_RETRY` or
+		  `INTERRUPT_CANCEL`.
+		"""
+		self.log.debug("Interrupt requested for worker process %s/%s" % (self.job.data["jobtype"], self.job.data["remote_id"]))
+		self.interrupted = level
+
+		if not self.is_alive():
+			return
+
+		try:
+			self.process.stdin.write(("%i\n" % level).encode("ascii"))
+			self.process.stdin.flush()
+		except (BrokenPipeError, OSError, ValueError):
+			# process ended in the meantime
+			pass
+
+	def abort(self):
+		"""
+		Called when the application shuts down
+
+		Workers in a child process are stopped via `request_interrupt()`, so
+		this does nothing.
+		"""
+		pass
+
+
+def listen_for_interrupts(worker):
+	"""
+	Pass interrupt requests read from stdin to the worker
+
+	:param BasicWorker worker:  Worker to interrupt
+	"""
+	for line in sys.stdin:
+		try:
+			level = int(line.strip())
+		except ValueError:
+			continue
+
+		worker.request_interrupt(level)
+
+
+def run(jobtype, log_pipe):
+	"""
+	Run the worker for a job in this process
+
+	The (already claimed) job is read from stdin, as JSON-encoded job data.
+
+	:param str jobtype:  Worker type
+	:param int log_pipe:  File descriptor of the pipe to pass log records to
+	the back-end process through
+	"""
+	# ctrl+c in the terminal reaches the whole process group; the manager
+	# decides when this worker should stop
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+	from backend import all_modules
+	from common.lib.logger import Logger
+	from common.lib.job import Job
+
+	log = Logger(output=False, pipe=os.fdopen(log_pipe, "w", encoding="utf-8"))
+
+	# the job uses the worker's database connection, so the process needs
+	# only one
+	job = Job.get_by_data(json.loads(sys.stdin.readline()), None)
+	worker = all_modules.workers[jobtype](logger=log, job=job, modules=all_modules)
+	job.db = worker.db
+
+	interrupt_listener = threading.Thread(target=listen_for_interrupts, args=(worker,), daemon=True)
+	interrupt_listener.start()
+
+	worker.run()
+
+
+if __name__ == "__main__":
+	run(sys.argv[1], int(sys.argv[2]))
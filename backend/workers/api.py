@@ -174,6 +174,13 @@ class InternalAPI(BasicWorker):
 
 			return workers
 
+		if request == "db-pool":
+			# statistics for the connection pool shared by the workers
+			if not self.manager.db_pool:
+				return {"enabled": False}
+
+			return {"enabled": True, **self.manager.db_pool.get_stats()}
+
 		if request == "jobs":
 			# return queued jobs, sorted by type
 			jobs = self.db.fetchall("SELECT * FROM jobs")
@@ -233,7 +240,7 @@ class InternalAPI(BasicWorker):
 
 					queue[job["jobtype"]] += 1
 				else:
-					if hasattr(worker, "dataset") and worker.dataset:
+					if hasattr(worker, "dataset") and worker.dataset and worker.is_alive():
 						running_key = worker.dataset.key
 						running_user = worker.dataset.owner
 						running_parent = worker.dataset.top_parent().key
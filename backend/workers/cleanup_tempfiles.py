@@ -37,6 +37,10 @@ class TempFileCleaner(BasicWorker):
             if self.interrupted:
                 raise WorkerInterruptedException("Interrupted while cleaning up orphaned result files")
 
+            if file.name == "media-cache":
+                # shared between datasets, and trimmed by the processors using it
+                continue
+
             # the key of the dataset files belong to can be extracted from the
             # file name in a predictable way.
             possible_keys = re.findall(r"[abcdef0-9]{32}", file.stem)
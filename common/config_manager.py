@@ -1,4 +1,5 @@
 """ 4CAT configuration """
+import threading
 import os
 import json
 from pathlib import Path
@@ -89,16 +90,192 @@ def quick_db_connect():
     return connection, cursor
 
 
+class SettingsCache:
+    """
+    Process-wide in-memory copy of the `settings` table
+
+    Reading a setting used to mean opening a database connection, running a
+    single query and closing the connection again, for every call to `get()`.
+    Instead, the whole table is loaded once and subsequent reads are served
+    from memory.
+
+    To pick up changes made elsewhere (e.g. the front-end changing a setting
+    the back-end uses), the cache keeps one connection open that LISTENs on
+    the `settings_changed` channel, on which `set_or_create_setting()` and
+    `delete_setting()` send a NOTIFY. Before each read that connection is
+    polled - which does not require a round trip to the database - and the
+    table is reloaded if a notification came in.
+    """
+    CHANNEL = "settings_changed"
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.values = None
+        self.connection = None
+        self.pid = None
+
+        # connections inherited from a parent process; see `check_process()`
+        self.orphaned = []
+
+        # counters, to be able to tell how often we actually hit the database
+        self.stats = {
+            "db_roundtrips": 0,
+            "loads": 0,
+            "hits": 0,
+            "invalidations": 0
+        }
+
+    def count_roundtrip(self, amount=1):
+        """
+        Register a query sent to the database for reading or writing settings
+
+        :param int amount:  Number of round trips to add
+        """
+        with self.lock:
+            self.stats["db_roundtrips"] += amount
+
+    def check_process(self):
+        """
+        Make sure the listening connection belongs to this process
+
+        The 4CAT daemon forks after the config has been loaded, and sharing a
+        database connection between processes is not possible. The inherited
+        connection is not closed (that would close it for the parent process
+        as well) but kept around so it does not get garbage-collected, and a
+        new one is made for this process.
+        """
+        if self.pid != os.getpid():
+            if self.connection is not None:
+                self.orphaned.append(self.connection)
+
+            self.connection = None
+            self.values = None
+            self.pid = os.getpid()
+
+    def invalidate(self):
+        """
+        Discard cached values
+
+        The table will be reloaded on the next read.
+        """
+        with self.lock:
+            if self.values is not None:
+                self.stats["invalidations"] += 1
+
+            self.values = None
+
+    def poll(self):
+        """
+        Check the listening connection for change notifications
+
+        If any came in, the cached values are discarded. If the connection
+        turns out to be broken, it is discarded too, and a new one will be
+        made when the settings are reloaded.
+        """
+        if self.connection is None:
+            return
+
+        try:
+            self.connection.poll()
+        except psycopg2.Error:
+            try:
+                self.connection.close()
+            except psycopg2.Error:
+                pass
+
+            self.connection = None
+            self.invalidate()
+            return
+
+        if self.connection.notifies:
+            self.connection.notifies.clear()
+            self.invalidate()
+
+    def load(self):
+        """
+        (Re)load all settings from the database
+
+        If no listening connection exists yet, one is made. LISTEN is issued
+        before the settings are read, so no change can slip by unnoticed
+        between reading and listening.
+        """
+        if self.connection is None:
+            self.connection, cursor = quick_db_connect()
+            self.connection.autocommit = True
+            cursor.execute("LISTEN %s" % self.CHANNEL)
+            self.count_roundtrip()
+        else:
+            cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+        cursor.execute("SELECT name, value FROM settings")
+        self.values = {row["name"]: row["value"] for row in cursor.fetchall()}
+        cursor.close()
+
+        self.count_roundtrip()
+        self.stats["loads"] += 1
+
+    def get_all(self):
+        """
+        Get all settings, loading them from the database if needed
+
+        :return dict:  Settings, as setting -> JSON-encoded value
+        """
+        with self.lock:
+            self.check_process()
+            self.poll()
+
+            if self.values is None:
+                try:
+                    self.load()
+                except (Exception, psycopg2.DatabaseError) as error:
+                    raise ConfigException("Error getting settings: {}".format(repr(error)))
+            else:
+                self.stats["hits"] += 1
+
+            return self.values
+
+    def get_stats(self):
+        """
+        Get cache statistics
+
+        :return dict:  Counters for database round trips, (re)loads, reads
+        served from memory and invalidations, for this process
+        """
+        with self.lock:
+            return self.stats.copy()
+
+
+settings_cache = SettingsCache()
+
+
+def notify_settings_changed(cursor):
+    """
+    Let all settings caches know that a setting has changed
+
+    The notification is delivered when the transaction the cursor is part of
+    is committed. The cache of the current process is invalidated directly.
+
+    :param cursor:  Database cursor to send the notification with
+    """
+    cursor.execute("NOTIFY %s" % SettingsCache.CHANNEL)
+    settings_cache.invalidate()
+
+
 def get(attribute_name, default=None, connection=None, cursor=None, keep_connection_open=False, raw=False):
     """
     Get a setting's value from the database
 
     If the setting does not exist, the provided fallback value is returned.
 
+    Values are read from the process-wide settings cache, unless a connection
+    and cursor are explicitly passed, in which case the database is queried
+    directly with those.
+
     :param str attribute_name:  Setting to return
     :param default:  Value to return if setting does not exist
-    :param connection:  Database connection, if None then a new connection will be created
-    :param cursor:  Database cursor, if None then a new cursor will be created
+    :param connection:  Database connection, if None then the settings cache
+    is used
+    :param cursor:  Database cursor, if None then the settings cache is used
     :param bool keep_connection_open:  Close connection after query?
     :param bool raw:  True returns value as JSON serialized string; False returns JSON object
     :return:  Setting value, or the provided fallback, or `None`.
@@ -113,19 +290,23 @@ def get(attribute_name, default=None, connection=None, cursor=None, keep_connect
         return attribute
     else:
         try:
-            if not connection or not cursor:
-                connection, cursor = quick_db_connect()
+            if connection and cursor:
+                query = "SELECT value FROM settings WHERE name = %s"
+                cursor.execute(query, (attribute_name,))
+                row = cursor.fetchone()
+                settings_cache.count_roundtrip()
 
-            query = "SELECT value FROM settings WHERE name = %s"
-            cursor.execute(query, (attribute_name,))
-            row = cursor.fetchone()
+                if not keep_connection_open:
+                    connection.close()
 
-            if not keep_connection_open:
-                connection.close()
+                value = row.get("value", None) if row else None
+            else:
+                value = settings_cache.get_all().get(attribute_name)
 
-            value = row.get("value", None) if row else None
             if not raw and value is not None:
                 value = json.loads(value)
+        except ConfigException:
+            raise
         except (Exception, psycopg2.DatabaseError) as error:
             raise ConfigException("Error getting setting {}: {}".format(attribute_name, repr(error)))
 
@@ -154,30 +335,32 @@ def get_all(connection=None, cursor=None, keep_connection_open=False, raw=False)
     while other attributes (part of the ConfigManager class are not directly
     editable)
 
-    :param connection: Database connection, if None then a new connection will
-    be created
-    :param cursor: Database cursor, if None then a new cursor will be created
+    :param connection: Database connection, if None then the settings cache
+    is used
+    :param cursor: Database cursor, if None then the settings cache is used
     :param keep_connection_open: Close connection after query?
     :param bool raw:  True returns values as JSON serialized strings; False returns JSON objects
     :return dict:  Settings, as setting -> value. Values are decoded from JSON
     """
     try:
-        if not connection or not cursor:
-            connection, cursor = quick_db_connect()
+        if connection and cursor:
+            query = "SELECT name, value FROM settings"
+            cursor.execute(query)
+            rows = {row["name"]: row.get("value", None) for row in cursor.fetchall()}
+            settings_cache.count_roundtrip()
 
-        query = "SELECT name, value FROM settings"
-        cursor.execute(query)
-        rows = cursor.fetchall()
-
-        if not keep_connection_open:
-            connection.close()
+            if not keep_connection_open:
+                connection.close()
+        else:
+            rows = settings_cache.get_all()
 
         values = {}
-        for row in rows:
-            value = row.get("value", None) if row else None
+        for name, value in rows.items():
             if not raw and value is not None:
                 value = json.loads(value)
-            values[row["name"]] = value
+            values[name] = value
+    except ConfigException:
+        raise
     except (Exception, psycopg2.DatabaseError) as error:
         raise ConfigException("Error getting settings: {}".format(repr(error)))
 
@@ -227,7 +410,9 @@ def set_or_create_setting(attribute_name, value, raw, overwrite_existing=True, c
             query = "INSERT INTO settings (name, value) Values (%s, %s) ON CONFLICT DO NOTHING"
         cursor.execute(query, (attribute_name, value))
         updated_rows = cursor.rowcount
+        notify_settings_changed(cursor)
         connection.commit()
+        settings_cache.count_roundtrip(3)
 
         if not keep_connection_open:
             connection.close()
@@ -249,11 +434,14 @@ def delete_setting(attribute_name):
     :poram str attribute_name:  Name of the setting to delete
     :return int:  Affected rows
     """
+    connection = None
     try:
         connection, cursor = quick_db_connect()
         cursor.execute("DELETE FROM settings WHERE name = %s", (attribute_name,))
         updated_rows = cursor.rowcount
+        notify_settings_changed(cursor)
         connection.commit()
+        settings_cache.count_roundtrip(3)
 
         return updated_rows
 
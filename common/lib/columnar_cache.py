@@ -0,0 +1,413 @@
+"""
+Caches for dataset items
+"""
+import threading
+import shutil
+import json
+import os
+
+try:
+	import pyarrow
+	import pyarrow.ipc
+except ImportError:
+	# optional; without it, datasets are always read from their result file
+	pyarrow = None
+
+from common.lib.helpers import get_file_signature
+
+
+class ColumnarCache:
+	"""
+	Cache of dataset items in the Arrow IPC file format
+
+	Reading items from the cache is faster than parsing them from the dataset
+	file, especially when only some of the item fields are needed, since only
+	those columns are then read.
+
+	Each item field is stored as a string column. For CSV-based datasets, these
+	are the CSV values as-is; for NDJSON-based datasets, values are stored
+	JSON-encoded, so nested values are preserved and fields that are not read
+	do not need to be decoded.
+
+	Requires `pyarrow`; use `ColumnarCache.is_available()` to check if it can
+	be used.
+	"""
+	path = None
+	cache_file = None
+	encoding = None
+	metadata = None
+
+	def __init__(self, path, cache_dir, name="items", encoding="text", metadata=None):
+		"""
+		Set up cache
+
+		:param Path path:  Dataset file the cache is derived from
+		:param Path cache_dir:  Folder to store the cache in
+		:param str name:  Name of the cache file, without extension
+		:param str encoding:  How to store values: `text` for string values,
+		`json` for JSON-encoded values
+		:param dict metadata:  Additional metadata that must match for the
+		cache to be considered current
+		"""
+		self.path = path
+		self.cache_file = cache_dir.joinpath("%s.arrow" % name)
+		self.encoding = encoding
+		self.metadata = metadata or {}
+
+	@staticmethod
+	def is_available():
+		"""
+		Check whether columnar caches can be used at all
+
+		:return bool:
+		"""
+		return pyarrow is not None
+
+	def get_metadata(self):
+		"""
+		Get the metadata the cache file is stored with
+
+		:return dict:
+		"""
+		return {
+			"signature": get_file_signature(self.path),
+			"encoding": self.encoding,
+			**self.metadata
+		}
+
+	def exists(self):
+		"""
+		Check if a current cache exists
+
+		:return bool:
+		"""
+		if not self.cache_file.exists():
+			return False
+
+		try:
+			with pyarrow.memory_map(str(self.cache_file)) as source:
+				schema = pyarrow.ipc.open_file(source).schema
+		except (pyarrow.ArrowInvalid, OSError):
+			return False
+
+		metadata = schema.metadata or {}
+		return json.loads(metadata.get(b"4cat", b"{}")) == self.get_metadata()
+
+	def iterate(self, columns=None):
+		"""
+		Iterate through cached items
+
+		:param list columns:  Fields to include in the items. If `None`, all
+		fields are included.
+		:return generator:  Yields items as dictionaries
+		"""
+		with pyarrow.memory_map(str(self.cache_file)) as source:
+			reader = pyarrow.ipc.open_file(source)
+			names = reader.schema.names
+			if columns is not None:
+				names = [name for name in names if name in columns]
+
+			for i in range(reader.num_record_batches):
+				batch = reader.get_batch(i)
+				values = [batch.column(name).to_pylist() for name in names]
+
+				for row in zip(*values):
+					if self.encoding == "json":
+						yield {name: json.loads(value) for name, value in zip(names, row) if value is not None}
+					else:
+						yield dict(zip(names, row))
+
+	def writer(self):
+		"""
+		Get a writer with which the cache can be (re)built
+
+		:return ColumnarCacheWriter:
+		"""
+		return ColumnarCacheWriter(self)
+
+
+class ColumnarCacheWriter:
+	"""
+	Writes items to a columnar cache
+
+	Items are written in batches. Since items may not all have the same
+	fields, each batch is written to a temporary file first; when committing,
+	all batches are combined into a single cache file with all fields. The
+	cache file only replaces an existing one once it is complete.
+	"""
+	#: Amount of items per record batch
+	batch_size = 10000
+
+	cache = None
+	temp_dir = None
+	buffer = None
+	fields = None
+	num_batches = 0
+	failed = False
+
+	def __init__(self, cache):
+		"""
+		Set up writer
+
+		:param ColumnarCache cache:  Cache to write
+		"""
+		self.cache = cache
+		self.metadata = cache.get_metadata()
+		self.temp_dir = cache.cache_file.with_name("%s.%i-%i.tmp" % (cache.cache_file.stem, os.getpid(), threading.get_ident()))
+		self.buffer = []
+		self.fields = {}
+
+	def add(self, item):
+		"""
+		Add an item
+
+		The item is encoded immediately, so it can safely be modified after
+		adding it.
+
+		:param dict item:  Item to add
+		"""
+		if self.failed:
+			return
+
+		if not all(type(field) is str for field in item):
+			# e.g. surplus values in a CSV row; these cannot be stored
+			self.failed = True
+			self.buffer = []
+			return
+
+		if self.cache.encoding == "json":
+			try:
+				self.buffer.append({field: json.dumps(value) for field, value in item.items()})
+			except (TypeError, ValueError):
+				# not serialisable as JSON, so the items cannot be cached
+				self.failed = True
+				self.buffer = []
+				return
+		else:
+			self.buffer.append({field: (str(value) if value is not None else None) for field, value in item.items()})
+
+		if len(self.buffer) >= self.batch_size:
+			self.flush()
+
+	def flush(self):
+		"""
+		Write buffered items to a temporary batch file
+		"""
+		if not self.buffer or self.failed:
+			return
+
+		batch_fields = {}
+		for item in self.buffer:
+			for field in item:
+				batch_fields[field] = True
+				self.fields[field] = True
+
+		batch = pyarrow.RecordBatch.from_arrays(
+			[pyarrow.array([item.get(field) for item in self.buffer], type=pyarrow.string()) for field in batch_fields],
+			names=list(batch_fields))
+
+		self.temp_dir.mkdir(parents=True, exist_ok=True)
+		batch_file = self.temp_dir.joinpath("batch-%i.arrow" % self.num_batches)
+		with pyarrow.OSFile(str(batch_file), "wb") as sink:
+			with pyarrow.ipc.new_file(sink, batch.schema) as writer:
+				writer.write_batch(batch)
+
+		self.num_batches += 1
+		self.buffer = []
+
+	def commit(self):
+		"""
+		Combine all batches into the cache file
+		"""
+		self.flush()
+		if self.failed:
+			self.discard()
+			return
+
+		schema = pyarrow.schema([(field, pyarrow.string()) for field in self.fields],
+								metadata={"4cat": json.dumps(self.metadata)})
+
+		self.temp_dir.mkdir(parents=True, exist_ok=True)
+		temp_file = self.temp_dir.joinpath("items.arrow")
+		with pyarrow.OSFile(str(temp_file), "wb") as sink:
+			with pyarrow.ipc.new_file(sink, schema) as writer:
+				for i in range(self.num_batches):
+					with pyarrow.memory_map(str(self.temp_dir.joinpath("batch-%i.arrow" % i))) as source:
+						batch = pyarrow.ipc.open_file(source).get_batch(0)
+						columns = [batch.column(field) if field in batch.schema.names else pyarrow.nulls(batch.num_rows, pyarrow.string()) for field in self.fields]
+						writer.write_batch(pyarrow.RecordBatch.from_arrays(columns, schema=schema))
+
+		temp_file.replace(self.cache.cache_file)
+		self.discard()
+
+	def discard(self):
+		"""
+		Remove temporary files
+		"""
+		self.buffer = []
+		if self.temp_dir.exists():
+			shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
+class NDJSONCache:
+	"""
+	Cache of dataset items as an NDJSON file
+
+	Used for caches that should also work when `pyarrow` is not available, so
+	a `ColumnarCache` cannot be used. Offers the same interface, but always
+	reads and decodes complete items.
+	"""
+	path = None
+	cache_file = None
+	meta_file = None
+	metadata = None
+
+	def __init__(self, path, cache_dir, name="items", metadata=None):
+		"""
+		Set up cache
+
+		:param Path path:  Dataset file the cache is derived from
+		:param Path cache_dir:  Folder to store the cache in
+		:param str name:  Name of the cache file, without extension
+		:param dict metadata:  Additional metadata that must match for the
+		cache to be considered current
+		"""
+		self.path = path
+		self.cache_file = cache_dir.joinpath("%s.ndjson" % name)
+		self.meta_file = cache_dir.joinpath("%s.json" % name)
+		self.metadata = metadata or {}
+
+	def get_metadata(self):
+		"""
+		Get the metadata the cache file is stored with
+
+		:return dict:
+		"""
+		return {
+			"signature": get_file_signature(self.path),
+			**self.metadata
+		}
+
+	def exists(self):
+		"""
+		Check if a current cache exists
+
+		:return bool:
+		"""
+		if not self.cache_file.exists() or not self.meta_file.exists():
+			return False
+
+		try:
+			with self.meta_file.open() as infile:
+				return json.load(infile) == self.get_metadata()
+		except (json.JSONDecodeError, OSError):
+			return False
+
+	def iterate(self, columns=None):
+		"""
+		Iterate through cached items
+
+		:param list columns:  Fields to include in the items. If `None`, all
+		fields are included.
+		:return generator:  Yields items as dictionaries
+		"""
+		with self.cache_file.open(encoding="utf-8") as infile:
+			for line in infile:
+				item = json.loads(line)
+				if columns is not None:
+					item = {column: item[column] for column in columns if column in item}
+
+				yield item
+
+	def writer(self):
+		"""
+		Get a writer with which the cache can be (re)built
+
+		:return NDJSONCacheWriter:
+		"""
+		return NDJSONCacheWriter(self)
+
+
+class NDJSONCacheWriter:
+	"""
+	Writes items to an NDJSON cache
+
+	Items are written to a temporary file, which only replaces an existing
+	cache file once it is complete.
+	"""
+	cache = None
+	temp_file = None
+	outfile = None
+	failed = False
+
+	def __init__(self, cache):
+		"""
+		Set up writer
+
+		:param NDJSONCache cache:  Cache to write
+		"""
+		self.cache = cache
+		self.metadata = cache.get_metadata()
+		self.temp_file = cache.cache_file.with_name("%s.%i-%i.tmp" % (cache.cache_file.name, os.getpid(), threading.get_ident()))
+
+	def add(self, item):
+		"""
+		Add an item
+
+		:param dict item:  Item to add
+		"""
+		if self.failed:
+			return
+
+		try:
+			line = json.dumps(item)
+		except (TypeError, ValueError):
+			# not serialisable as JSON, so the items cannot be cached
+			self.failed = True
+			self.discard()
+			return
+
+		if not self.outfile:
+			self.open()
+
+		self.outfile.write(line + "\n")
+
+	def commit(self):
+		"""
+		Replace the cache file with the written items
+
+		If not all items could be written, the cache is left as it was.
+		"""
+		if self.failed:
+			self.discard()
+			return
+
+		if not self.outfile:
+			# no items, but an empty cache is still a valid cache
+			self.open()
+
+		self.outfile.close()
+		self.temp_file.replace(self.cache.cache_file)
+
+		temp_meta = self.temp_file.with_suffix(".json.tmp")
+		with temp_meta.open("w") as outfile:
+			json.dump(self.metadata, outfile)
+		temp_meta.replace(self.cache.meta_file)
+
+	def open(self):
+		"""
+		Open the temporary file to write items to
+		"""
+		self.temp_file.parent.mkdir(parents=True, exist_ok=True)
+		self.outfile = self.temp_file.open("w", encoding="utf-8")
+
+	def discard(self):
+		"""
+		Remove temporary files
+		"""
+		if self.outfile:
+			self.outfile.close()
+			self.outfile = None
+
+		if self.temp_file.exists():
+			self.temp_file.unlink()
@@ -89,6 +89,57 @@ config_definition = {
         "max": 360,
         "coerce_type": int
     },
+    # Database connections are shared between workers (in the back-end) and
+    # between requests (in the front-end) via a connection pool. This limits
+    # the amount of connections each process opens to the database.
+    "4cat.db_pool_size": {
+        "type": UserInput.OPTION_TEXT,
+        "default": 50,
+        "coerce_type": int,
+        "help": "Back-end database connections",
+        "tooltip": "Maximum amount of database connections shared by back-end workers. Workers wait for a connection "
+                   "to become available before starting. Set to 0 to give each worker its own connection. Requires a "
+                   "restart of the back-end to take effect.",
+    },
+    # Finished datasets can be cached in a columnar format next to their result
+    # file, which is much faster to read than the original CSV or NDJSON file
+    # when processors read the same dataset repeatedly. Requires pyarrow.
+    "4cat.columnar_cache": {
+        "type": UserInput.OPTION_TOGGLE,
+        "default": False,
+        "help": "Cache datasets in columnar format",
+        "tooltip": "Store a columnar copy of finished datasets the first time they are read completely, and read "
+                   "from that copy afterwards. Uses extra disk space. Requires the pyarrow Python package to be "
+                   "installed; if it is not, this setting has no effect.",
+    },
+    "4cat.mapped_cache": {
+        "type": UserInput.OPTION_TOGGLE,
+        "default": True,
+        "help": "Cache mapped items",
+        "tooltip": "For data sources that store their data in a format that needs to be mapped before it can be "
+                   "processed (e.g. NDJSON files), store the mapped items the first time a dataset is mapped, and "
+                   "use those afterwards instead of mapping the data again. Uses extra disk space.",
+    },
+    # Media downloaded by processors (images, videos) can be stored in a
+    # shared cache, so it does not need to be downloaded again when another
+    # dataset links to the same media.
+    "4cat.media_cache_size": {
+        "type": UserInput.OPTION_TEXT,
+        "default": 10,
+        "coerce_type": int,
+        "help": "Media cache size (GB)",
+        "tooltip": "Maximum size of the cache of downloaded images and videos, in gigabytes. Media that has been "
+                   "downloaded before is taken from the cache rather than downloaded again. When the cache is full, "
+                   "the least recently used files are removed from it. Set to 0 to disable the cache.",
+    },
+    "4cat.parallel_workers": {
+        "type": UserInput.OPTION_TEXT,
+        "default": 4,
+        "coerce_type": int,
+        "help": "Worker processes per processor",
+        "tooltip": "Maximum amount of processes a single processor may use to process a dataset in parallel. Only "
+                   "applies to processors that support this.",
+    },
     # These settings control whether top-level datasets (i.e. those created via the
     # "Create dataset" page) are deleted automatically, and if so, after how much
     # time. You can also allow users to cancel this (i.e. opt out). Note that if
@@ -257,6 +308,15 @@ config_definition = {
         "help": "Auto-login name",
         "tooltip": "Username for whitelisted hosts (automatically logged in users see this name for themselves)",
     },
+    "flask.db_pool_size": {
+        "type": UserInput.OPTION_TEXT,
+        "default": 10,
+        "coerce_type": int,
+        "help": "Database connections",
+        "tooltip": "Maximum amount of database connections per front-end process, shared between requests. Set to 0 "
+                   "to share a single connection between all requests. Requires a restart of the front-end to take "
+                   "effect.",
+    },
     "flask.secret_key": {
         "type": UserInput.OPTION_TEXT,
         "default": "",
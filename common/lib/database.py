@@ -2,7 +2,11 @@
 Database wrapper
 """
 import itertools
+import io
+import threading
+import select
 import psycopg2.extras
+import psycopg2.pool
 import psycopg2
 import time
 
@@ -14,6 +18,175 @@ from common.lib.exceptions import DatabaseQueryInterruptedException
 
 import common.config_manager as config
 
+
+class DatabasePool:
+	"""
+	Bounded pool of database connections
+
+	Meant to be shared by all threads within a process (e.g. all request
+	threads of a front-end process, or all workers in the back-end), so that
+	a limited amount of connections can be re-used instead of opening a new
+	connection for every request or job. If all connections are in use,
+	checking one out blocks until one is returned to the pool, or until a
+	timeout passes, after which `Database` falls back to opening a separate
+	connection. This way a pool filled up by long-running workers cannot
+	stall everything else.
+
+	Keeps some statistics on how the pool is used, which can be retrieved via
+	`get_stats()`.
+	"""
+	pool = None
+	size = 0
+	timeout = 30
+	appname = ""
+
+	def __init__(self, size, dbname=None, user=None, password=None, host=None, port=None, appname=None, timeout=None):
+		"""
+		Set up connection pool
+
+		Connections are opened lazily, i.e. only when none are available to
+		check out and the pool is not yet at its maximum size.
+
+		:param int size:  Maximum amount of connections in the pool
+		:param dbname:  Database name
+		:param user:  Database username
+		:param password:  Database password
+		:param host:  Database server address
+		:param port:  Database port
+		:param appname:  App name, used as connection application name
+		:param int timeout:  Seconds to wait for a connection to become
+		available before giving up, when checking one out
+		"""
+		self.size = size
+		if timeout is not None:
+			self.timeout = timeout
+		self.appname = "4CAT" if not appname else "4CAT-%s" % appname
+		self.pool = psycopg2.pool.ThreadedConnectionPool(
+			0, size,
+			dbname=config.get('DB_NAME') if not dbname else dbname,
+			user=config.get('DB_USER') if not user else user,
+			password=config.get('DB_PASSWORD') if not password else password,
+			host=config.get('DB_HOST') if not host else host,
+			port=config.get('DB_PORT') if not port else port,
+			application_name=self.appname
+		)
+
+		# psycopg2's pool raises an exception when it is exhausted, we want to
+		# wait instead - so keep track of available slots separately
+		self.slots = threading.BoundedSemaphore(size)
+		self.lock = threading.Lock()
+		self.stats = {
+			"size": size,
+			"in_use": 0,
+			"max_in_use": 0,
+			"checkouts": 0,
+			"waits": 0,
+			"wait_time": 0.0,
+			"timeouts": 0
+		}
+
+	def getconn(self, appname=None):
+		"""
+		Check out a connection
+
+		Blocks until a connection is available, or the pool's timeout passes.
+
+		:param str appname:  If given, the connection's application name is
+		set to this value for as long as it is checked out, so that it can be
+		identified in `pg_stat_activity` (e.g. to cancel its queries).
+		:return:  Connection
+		:raises psycopg2.pool.PoolError:  If no connection became available
+		in time
+		"""
+		wait_start = time.time()
+		waited = not self.slots.acquire(blocking=False)
+		if waited and not self.slots.acquire(timeout=self.timeout):
+			with self.lock:
+				self.stats["timeouts"] += 1
+			raise psycopg2.pool.PoolError("No connection available after %i seconds" % self.timeout)
+
+		try:
+			connection = self.pool.getconn()
+			if connection.closed:
+				# e.g. when the database server was restarted
+				self.pool.putconn(connection, close=True)
+				connection = self.pool.getconn()
+
+			if appname and appname != self.appname:
+				cursor = connection.cursor()
+				cursor.execute("SET application_name = %s", (appname,))
+				cursor.close()
+				connection.commit()
+		except Exception:
+			self.slots.release()
+			raise
+
+		with self.lock:
+			self.stats["checkouts"] += 1
+			self.stats["in_use"] += 1
+			self.stats["max_in_use"] = max(self.stats["max_in_use"], self.stats["in_use"])
+			if waited:
+				self.stats["waits"] += 1
+				self.stats["wait_time"] += time.time() - wait_start
+
+		return connection
+
+	def putconn(self, connection):
+		"""
+		Return a connection to the pool
+
+		Any open transaction is rolled back by psycopg2 before the connection
+		is made available again. Broken connections are discarded.
+
+		:param connection:  Connection, as returned by `getconn()`
+		"""
+		try:
+			if not connection.closed and connection.get_parameter_status("application_name") != self.appname:
+				cursor = connection.cursor()
+				cursor.execute("RESET application_name")
+				cursor.close()
+				connection.commit()
+		except psycopg2.Error:
+			pass
+
+		try:
+			self.pool.putconn(connection, close=bool(connection.closed))
+		finally:
+			with self.lock:
+				self.stats["in_use"] -= 1
+
+			self.slots.release()
+
+	def available(self):
+		"""
+		Get amount of connections that can currently be checked out without
+		waiting
+
+		:return int:  Available connections
+		"""
+		with self.lock:
+			return self.size - self.stats["in_use"]
+
+	def get_stats(self):
+		"""
+		Get pool statistics
+
+		:return dict:  Pool size, connections currently in use, the maximum
+		amount of connections that was in use at the same time, number of
+		checkouts, number of and total time spent on checkouts that had to
+		wait for a connection to become available, and number of checkouts
+		that gave up waiting.
+		"""
+		with self.lock:
+			return self.stats.copy()
+
+	def close(self):
+		"""
+		Close all connections in the pool
+		"""
+		self.pool.closeall()
+
+
 class Database:
 	"""
 	Simple database handler
@@ -30,7 +203,9 @@ class Database:
 	interruptable_timeout = 86400  # if a query takes this long, it should be cancelled. see also fetchall_interruptable()
 	interruptable_job = None
 
-	def __init__(self, logger, dbname=None, user=None, password=None, host=None, port=None, appname=None):
+	pool = None
+
+	def __init__(self, logger, dbname=None, user=None, password=None, host=None, port=None, appname=None, pool=None):
 		"""
 		Set up database connection
 
@@ -41,6 +216,11 @@ class Database:
 		:param host:  Database server address
 		:param port:  Database port
 		:param appname:  App name, mostly useful to trace connections in pg_stat_activity
+		:param DatabasePool pool:  If given, the connection is checked out
+		from this pool instead of opened anew, and returned to the pool when
+		`close()` is called. Connection parameters are ignored in that case.
+		If no pooled connection becomes available in time, a separate
+		connection is opened instead.
 		"""
 		dbname = config.get('DB_NAME') if not dbname else dbname
 		user = config.get('DB_USER') if not user else user
@@ -49,8 +229,20 @@ class Database:
 		port = config.get('DB_PORT') if not port else port
 
 		self.appname = "4CAT" if not appname else "4CAT-%s" % appname
+		self.pool = pool
+
+		self.connection = None
+		if self.pool:
+			try:
+				self.connection = self.pool.getconn(appname=self.appname)
+			except psycopg2.pool.PoolError:
+				if logger:
+					logger.warning("Database connection pool exhausted, opening separate connection for %s" % self.appname)
+				self.pool = None
+
+		if not self.connection:
+			self.connection = psycopg2.connect(dbname=dbname, user=user, password=password, host=host, port=port, application_name=self.appname)
 
-		self.connection = psycopg2.connect(dbname=dbname, user=user, password=password, host=host, port=port, application_name=self.appname)
 		self.cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 		self.log = logger
 
@@ -92,7 +284,7 @@ class Database:
 
 		cursor.close()
 
-	def execute_many(self, query, commit=True, replacements=None):
+	def execute_many(self, query, commit=True, replacements=None, fetch=False):
 		"""
 		Execute a query multiple times, each time with different values
 
@@ -102,13 +294,61 @@ class Database:
 		:param string query:  Query
 		:param replacements: A list of replacement values
 		:param commit:  Commit transaction after query?
+		:param bool fetch:  Return the rows returned by the query, e.g. via a
+		`RETURNING` clause?
+		:return list:  Returned rows, as dictionaries, if `fetch` is `True`
+		"""
+		cursor = self.get_cursor()
+		result = execute_values(cursor, query, replacements, fetch=fetch)
+		cursor.close()
+		if commit:
+			self.commit()
+
+		return result
+
+	def copy_rows(self, table, columns, rows, commit=True, batch_size=100000):
+		"""
+		Bulk-load rows into a table with COPY
+
+		Much faster than INSERTing rows for large amounts of rows, since the
+		data is streamed to the server without needing to be parsed as SQL.
+		Rows are sent in batches, so `rows` can be a generator of any size.
+
+		:param str table:  Table to copy rows into
+		:param list columns:  Columns to copy values into
+		:param Iterable rows:  Rows, each a tuple of values for the columns
+		:param commit:  Commit transaction after copying?
+		:param int batch_size:  Amount of rows to send per batch
+		:return int:  Amount of rows copied
 		"""
+		def copy_value(value):
+			# text format: \N is NULL, and backslashes and delimiters escaped
+			if value is None:
+				return "\\N"
+
+			return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+		copy_query = sql.SQL("COPY {} ({}) FROM STDIN").format(
+			sql.Identifier(table), sql.SQL(", ").join([sql.Identifier(column) for column in columns]))
+
 		cursor = self.get_cursor()
-		execute_values(cursor, query, replacements)
+		num_rows = 0
+		rows = iter(rows)
+		while True:
+			batch = list(itertools.islice(rows, batch_size))
+			if not batch:
+				break
+
+			buffer = io.StringIO("".join(["\t".join([copy_value(value) for value in row]) + "\n" for row in batch]))
+			cursor.copy_expert(copy_query, buffer)
+			num_rows += len(batch)
+
 		cursor.close()
 		if commit:
 			self.commit()
 
+		return num_rows
+
 	def update(self, table, data, where=None, commit=True):
 		"""
 		Update a database record
@@ -387,6 +627,105 @@ class Database:
 
 		return result
 
+	def iterate_interruptable(self, queue, query, *args, itersize=10000):
+		"""
+		Iterate over rows for a query, allowing for interruption
+
+		Like `fetchall_interruptable()`, but rows are fetched from a
+		server-side cursor in batches of `itersize` rows rather than all at
+		once, so memory use does not depend on the size of the result set.
+
+		The query is only run once iteration starts. Each batch is fetched
+		with a separate query, which the cancellation job can cancel like any
+		other; in that case, a DatabaseQueryInterruptedException is raised
+		while iterating. The cursor keeps a transaction open until all rows
+		have been read (or the generator is closed), so no other queries
+		should be run with this database object in the meantime.
+
+		:param JobQueue queue:  A job queue object, required to schedule the
+		query cancellation job
+		:param str query:  SQL query
+		:param list args:  Replacement variables
+		:param int itersize:  Amount of rows to fetch per batch
+		:return generator:  Yields rows, as dictionaries
+		"""
+		# schedule a job that will cancel the query we're about to make
+		self.interruptable_job = queue.add_job("cancel-pg-query", details={}, remote_id=self.appname, claim_after=time.time() + self.interruptable_timeout)
+
+		# a named cursor is a server-side cursor
+		cursor = self.connection.cursor(name="interruptable_stream", cursor_factory=psycopg2.extras.RealDictCursor)
+		cursor.itersize = itersize
+
+		try:
+			self.query(query, cursor=cursor, *args)
+			yield from cursor
+
+		except psycopg2.extensions.QueryCanceledError:
+			# interrupted with cancellation worker (or manually)
+			self.log.debug("Query in connection %s was interrupted..." % self.appname)
+			self.rollback()
+			raise DatabaseQueryInterruptedException("Interrupted while querying database")
+
+		finally:
+			# clean up cancelling job when we have all the data, or when
+			# whoever was reading it stopped doing so
+			cursor.close()
+			if self.interruptable_job:
+				self.interruptable_job.finish()
+				self.interruptable_job = None
+
+			self.commit()
+
+
+	def listen(self, channel):
+		"""
+		Subscribe to notifications on a channel
+
+		Notifications can subsequently be retrieved with
+		`wait_for_notifications()`. The connection should not be used for
+		anything else while waiting for notifications.
+
+		:param str channel:  Channel name
+		"""
+		self.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+
+	def notify(self, channel, payload="", commit=True):
+		"""
+		Send a notification on a channel
+
+		The notification is delivered to listening connections when the
+		transaction is committed.
+
+		:param str channel:  Channel name
+		:param str payload:  Notification payload
+		:param bool commit:  Commit transaction after sending?
+		"""
+		cursor = self.get_cursor()
+		cursor.execute("SELECT pg_notify(%s, %s)", (channel, str(payload)))
+		cursor.close()
+
+		if commit:
+			self.commit()
+
+	def wait_for_notifications(self, timeout):
+		"""
+		Wait for notifications on channels listened to
+
+		Returns immediately if notifications have been received already;
+		otherwise, blocks until one arrives or the timeout has passed.
+
+		:param float timeout:  Maximum time to wait, in seconds
+		:return list:  Notifications received, as `psycopg2.extensions.Notify`
+		objects. May be empty.
+		"""
+		if not self.connection.notifies:
+			readable, writable, failed = select.select([self.connection], [], [], timeout)
+			if readable:
+				self.connection.poll()
+
+		notifications = list(self.connection.notifies)
+		self.connection.notifies.clear()
+		return notifications
 
 	def commit(self):
 		"""
@@ -406,9 +745,15 @@ class Database:
 		"""
 		Close connection
 
-		Running queries after this is probably a bad idea!
+		If the connection was checked out from a pool, it is returned to the
+		pool instead. Running queries after this is probably a bad idea!
 		"""
-		self.connection.close()
+		if self.pool:
+			if self.connection is not None:
+				self.pool.putconn(self.connection)
+				self.connection = None
+		else:
+			self.connection.close()
 
 	def get_cursor(self):
 		"""
@@ -1,7 +1,10 @@
+import multiprocessing
 import collections
+import functools
 import datetime
 import hashlib
 import fnmatch
+import inspect
 import shutil
 import json
 import time
@@ -13,7 +16,10 @@ from pathlib import Path
 import common.config_manager as config
 import backend
 from common.lib.job import Job, JobNotFoundException
-from common.lib.helpers import get_software_version, NullAwareTextIOWrapper
+from common.lib.helpers import get_software_version, NullAwareTextIOWrapper, convert_to_int
+from common.lib.columnar_cache import ColumnarCache, NDJSONCache
+from common.lib.dataset_index import DatasetIndex
+from common.lib.parallel import can_spawn_processes, get_csv_chunks, get_ndjson_chunks, process_chunk
 from common.lib.fourcat_module import FourcatModule
 from common.lib.exceptions import ProcessorInterruptedException
 
@@ -35,7 +41,7 @@ class DataSet(FourcatModule):
 	data = {}
 	key = ""
 
-	children = []
+	_children = None
 	available_processors = {}
 	genealogy = []
 	preset_parent = None
@@ -134,10 +140,170 @@ class DataSet(FourcatModule):
 			# Reserve filename and update data['result_file']
 			self.reserve_result_file(parameters, extension)
 
-		# retrieve analyses and processors that may be run for this dataset
-		analyses = self.db.fetchall("SELECT * FROM datasets WHERE key_parent = %s ORDER BY timestamp ASC", (self.key,))
-		self.children = sorted([DataSet(data=analysis, db=self.db) for analysis in analyses],
-							   key=lambda dataset: dataset.is_finished(), reverse=True)
+			# a new dataset cannot have children yet
+			self._children = []
+
+	@property
+	def children(self):
+		"""
+		Get child datasets
+
+		Children are only retrieved from the database when first accessed,
+		unless they were already loaded, e.g. via `DataSet.load_tree()`.
+		Finished children are listed first; otherwise, they are sorted by
+		creation time.
+
+		:return list:  Child datasets
+		"""
+		if self._children is None:
+			analyses = self.db.fetchall("SELECT * FROM datasets WHERE key_parent = %s ORDER BY timestamp ASC", (self.key,))
+			self._children = DataSet.sort_children([DataSet(data=analysis, db=self.db) for analysis in analyses])
+
+		return self._children
+
+	@children.setter
+	def children(self, children):
+		"""
+		Set child datasets
+
+		:param list children:  Child datasets
+		"""
+		self._children = children
+
+	@staticmethod
+	def sort_children(children):
+		"""
+		Sort child datasets the way they are displayed
+
+		:param list children:  Child datasets, sorted by creation time
+		:return list:  Child datasets, finished ones first
+		"""
+		return sorted(children, key=lambda dataset: dataset.is_finished(), reverse=True)
+
+	@staticmethod
+	def load_many(keys, db):
+		"""
+		Instantiate multiple datasets with a single query
+
+		Keys for which no dataset exists are skipped.
+
+		:param list keys:  Dataset keys
+		:param db:  Database connection
+		:return list:  Datasets, in the order of the given keys
+		"""
+		if not keys:
+			return []
+
+		records = {record["key"]: record for record in db.fetchall("SELECT * FROM datasets WHERE key IN %s", (tuple(keys),))}
+		return [DataSet(data=records[key], db=db) for key in keys if key in records]
+
+	@staticmethod
+	def load_tree(keys, db):
+		"""
+		Instantiate datasets including all their descendants
+
+		The datasets and all their children, grandchildren, et cetera are
+		retrieved with a single recursive query, and the `children` of every
+		dataset in the tree are set so that no further queries are needed to
+		traverse it. The genealogy of all datasets in the tree is set as
+		well, with one more query for the ancestors of the top datasets.
+
+		:param list keys:  Keys of datasets at the top of the trees to load
+		:param db:  Database connection
+		:return list:  Datasets, in the order of the given keys
+		"""
+		if not keys:
+			return []
+
+		records = db.fetchall("""
+			WITH RECURSIVE tree AS (
+				SELECT * FROM datasets WHERE key IN %s
+				UNION ALL
+				SELECT d.* FROM datasets AS d INNER JOIN tree AS t ON d.key_parent = t.key
+			)
+			SELECT * FROM tree ORDER BY timestamp ASC
+		""", (tuple(keys),))
+
+		# a dataset may be a descendant of another requested dataset, so
+		# make sure each dataset is only instantiated once
+		datasets = {}
+		for record in records:
+			if record["key"] not in datasets:
+				datasets[record["key"]] = DataSet(data=record, db=db)
+
+		children = {key: [] for key in datasets}
+		for dataset in datasets.values():
+			if dataset.key_parent in children:
+				children[dataset.key_parent].append(dataset)
+
+		for key, dataset in datasets.items():
+			dataset.children = DataSet.sort_children(children[key])
+
+		# genealogy can be derived for trees that start at the top; for other
+		# trees, the ancestors of the top dataset are loaded separately
+		tops = [datasets[key] for key in keys if key in datasets]
+		DataSet.load_genealogies([dataset for dataset in tops if dataset.key_parent], db=db)
+		for dataset in tops:
+			if not dataset.key_parent:
+				DataSet.set_genealogy(dataset, [])
+
+		return tops
+
+	@staticmethod
+	def load_genealogies(datasets, db):
+		"""
+		Set the genealogy of multiple datasets with a single query
+
+		The ancestors of all datasets are retrieved with one recursive query.
+		If the children of a dataset were already loaded, e.g. via
+		`DataSet.load_tree()`, their genealogy is set as well.
+
+		:param list datasets:  Datasets to set the genealogy of
+		:param db:  Database connection
+		"""
+		parent_keys = {dataset.key_parent for dataset in datasets if dataset.key_parent}
+		ancestors = {}
+		if parent_keys:
+			# the depth limit guards against (unlikely) cycles in the hierarchy
+			records = db.fetchall("""
+				WITH RECURSIVE ancestors AS (
+					SELECT *, key AS descendant, 0 AS depth FROM datasets WHERE key IN %s
+					UNION ALL
+					SELECT d.*, a.descendant, a.depth + 1 FROM datasets AS d INNER JOIN ancestors AS a ON d.key = a.key_parent
+					WHERE a.key_parent != '' AND a.depth < 100
+				)
+				SELECT * FROM ancestors ORDER BY depth DESC
+			""", (tuple(parent_keys),))
+
+			# datasets that are an ancestor of more than one dataset are only
+			# instantiated once
+			instances = {}
+			for record in records:
+				descendant = record.pop("descendant")
+				del record["depth"]
+				if record["key"] not in instances:
+					instances[record["key"]] = DataSet(data=record, db=db)
+
+				ancestors.setdefault(descendant, []).append(instances[record["key"]])
+
+			for genealogy in ancestors.values():
+				for index, ancestor in enumerate(genealogy):
+					ancestor.genealogy = genealogy[:index + 1]
+
+		for dataset in datasets:
+			DataSet.set_genealogy(dataset, ancestors.get(dataset.key_parent, []))
+
+	@staticmethod
+	def set_genealogy(dataset, ancestors):
+		"""
+		Set the genealogy of a dataset and its loaded descendants
+
+		:param DataSet dataset:  Dataset
+		:param list ancestors:  Ancestors of the dataset, oldest first
+		"""
+		dataset.genealogy = [*ancestors, dataset]
+		for child in (dataset._children or []):
+			DataSet.set_genealogy(child, dataset.genealogy)
 
 	def check_dataset_finished(self):
 		"""
@@ -237,7 +403,7 @@ class DataSet(FourcatModule):
 				logmsg = ":".join(line.split(":")[1:])
 				yield (logtime, logmsg)
 
-	def iterate_items(self, processor=None, bypass_map_item=False):
+	def iterate_items(self, processor=None, bypass_map_item=False, columns=None):
 		"""
 		A generator that iterates through a CSV or NDJSON file
 
@@ -255,46 +421,118 @@ class DataSet(FourcatModule):
 		it would be a shame to throw away that data.
 
 		There are two file types that can be iterated (currently): CSV files
-		and NDJSON (newline-delimited JSON) files. In the future, one could
-		envision adding a pathway to retrieve items from e.g. a MongoDB
-		collection directly instead of from a static file
+		and NDJSON (newline-delimited JSON) files. If the columnar cache is
+		enabled, finished datasets are additionally stored in a columnar
+		format the first time they are read completely, and read from there
+		afterwards. Likewise, mapped items are cached the first time all
+		items are mapped, so `map_item` only needs to run once per dataset.
 
 		:param BasicProcessor processor:  A reference to the processor
 		iterating the dataset.
 		:param bool bypass_map_item:  If set to `True`, this ignores any
 		`map_item` method of the datasource when returning items.
+		:param list columns:  If given, only include these fields in the
+		returned items. When reading from the columnar cache, other fields
+		are then not read at all.
 		:return generator:  A generator that yields each item as a dictionary
 		"""
 		path = self.get_results_path()
 
 		# see if an item mapping function has been defined
+		item_mapper = self.get_item_mapper() if not bypass_map_item else None
+
+		# if the items have been mapped before, use those
+		mapped_cache = self.get_mapped_cache() if item_mapper else None
+		if mapped_cache and mapped_cache.exists():
+			for item in mapped_cache.iterate(columns=columns):
+				if hasattr(processor, "interrupted") and processor.interrupted:
+					raise ProcessorInterruptedException("Processor interrupted while iterating through mapped items")
+
+				yield item
+
+			return
+
+		# the item mapper may need any field, so only the mapped item can be
+		# reduced to the requested columns
+		read_columns = columns if not item_mapper else None
+
+		# if there is no cache yet, write it while reading the file
+		cache = self.get_columnar_cache()
+		cache_writer = None
+		mapped_writer = mapped_cache.writer() if mapped_cache else None
+
+		if cache and cache.exists():
+			items = cache.iterate(columns=read_columns)
+			source = "cached items"
+		else:
+			cache_writer = cache.writer() if cache else None
+			items = self.iterate_file_items(path)
+			source = "%s file" % path.suffix[1:].upper()
+
+		try:
+			for item in items:
+				if hasattr(processor, "interrupted") and processor.interrupted:
+					raise ProcessorInterruptedException("Processor interrupted while iterating through %s" % source)
+
+				if cache_writer:
+					cache_writer.add(item)
+
+				if item_mapper:
+					item = item_mapper(item)
+					if mapped_writer:
+						mapped_writer.add(item)
+
+				yield self.project_item(item, columns)
+
+			# only store the caches if all items have been read
+			for writer in (cache_writer, mapped_writer):
+				if writer:
+					writer.commit()
+
+			cache_writer = None
+			mapped_writer = None
+
+		finally:
+			for writer in (cache_writer, mapped_writer):
+				if writer:
+					writer.discard()
+
+	def get_item_mapper(self):
+		"""
+		Get the function with which items in this dataset should be mapped
+
+		:return callable:  The `map_item` method of the dataset's processor,
+		or `None` if items should not be mapped.
+		"""
 		# open question if 'source_dataset' shouldn't be an attribute of the dataset
 		# instead of the processor...
-		item_mapper = None
+		own_processor = self.get_own_processor()
+
+		# only run item mapper if extension of processor == extension of
+		# data file, for the scenario where a csv file was uploaded and
+		# converted to an ndjson-based data source, for example
+		# todo: this is kind of ugly, and a better fix may be possible
+		extension_fits = hasattr(own_processor, "extension") and own_processor.extension == self.get_extension()
+		if hasattr(own_processor, "map_item") and extension_fits:
+			return own_processor.map_item
+
+		return None
+
+	@staticmethod
+	def iterate_file_items(path):
+		"""
+		Iterate through the items in a CSV or NDJSON file
 
-		if not bypass_map_item:
-			own_processor = self.get_own_processor()
-			# only run item mapper if extension of processor == extension of
-			# data file, for the scenario where a csv file was uploaded and
-			# converted to an ndjson-based data source, for example
-			# todo: this is kind of ugly, and a better fix may be possible
-			extension_fits = hasattr(own_processor, "extension") and own_processor.extension == self.get_extension()
-			if hasattr(own_processor, "map_item") and extension_fits:
-				item_mapper = own_processor.map_item
-
-		# go through items one by one, optionally mapping them
+		:param Path path:  Path to the file
+		:return generator:  A generator that yields each item as a dictionary
+		"""
+		# go through items one by one
 		if path.suffix.lower() == ".csv":
 			with path.open("rb") as infile:
 				wrapped_infile = NullAwareTextIOWrapper(infile, encoding="utf-8")
 				reader = csv.DictReader(wrapped_infile)
 
 				for item in reader:
-					if hasattr(processor, "interrupted") and processor.interrupted:
-						raise ProcessorInterruptedException("Processor interrupted while iterating through CSV file")
-
-					if item_mapper:
-						item = item_mapper(item)
-
 					yield item
 
 		elif path.suffix.lower() == ".ndjson":
@@ -302,17 +540,160 @@ class DataSet(FourcatModule):
 			# file
 			with path.open(encoding="utf-8") as infile:
 				for line in infile:
-					if hasattr(processor, "interrupted") and processor.interrupted:
-						raise ProcessorInterruptedException("Processor interrupted while iterating through NDJSON file")
+					yield json.loads(line)
 
-					item = json.loads(line)
-					if item_mapper:
-						item = item_mapper(item)
+		else:
+			raise NotImplementedError("Cannot iterate through %s file" % path.suffix)
 
-					yield item
+	@staticmethod
+	def project_item(item, columns=None):
+		"""
+		Reduce an item to the given fields
+
+		:param dict item:  Item
+		:param list columns:  Fields to keep, or `None` to keep all
+		:return dict:  Item with only the given fields
+		"""
+		if columns is None:
+			return item
+
+		return {column: item[column] for column in columns if column in item}
+
+	def get_columnar_cache(self):
+		"""
+		Get the columnar cache for this dataset
+
+		:return ColumnarCache:  Cache, or `None` if the dataset cannot be
+		cached, e.g. because it is not finished or caching is disabled.
+		"""
+		if not config.get("4cat.columnar_cache") or not ColumnarCache.is_available() or not self.is_finished():
+			return None
 
+		path = self.get_results_path()
+		suffix = path.suffix.lower()
+		if suffix not in (".csv", ".ndjson") or not path.exists():
+			return None
+
+		return ColumnarCache(path, self.get_cache_area(), encoding="json" if suffix == ".ndjson" else "text")
+
+	def get_mapped_cache(self):
+		"""
+		Get the cache of mapped items for this dataset
+
+		Mapping items with the `map_item` method of the dataset's processor
+		can be slow, so the mapped items are cached the first time they are
+		all mapped. The cache is versioned against the source code that maps
+		the items (see `get_mapper_version()`), so it is rebuilt when that
+		changes.
+
+		The cache is a columnar cache if possible, or an NDJSON file
+		otherwise.
+
+		:return:  `ColumnarCache` or `NDJSONCache`, or `None` if the dataset's
+		items cannot be cached, e.g. because it is not finished, caching is
+		disabled, or there is no `map_item` method.
+		"""
+		own_processor = self.get_own_processor()
+		if not config.get("4cat.mapped_cache") or not hasattr(own_processor, "map_item") or not self.is_finished():
+			return None
+
+		path = self.get_results_path()
+		if path.suffix.lower() not in (".csv", ".ndjson") or not path.exists():
+			return None
+
+		version = self.get_mapper_version(own_processor)
+		if not version:
+			# cannot determine which version of the code mapped the items
+			return None
+
+		metadata = {"map_item": "%s:%s" % (own_processor.type, version)}
+		if ColumnarCache.is_available():
+			return ColumnarCache(path, self.get_cache_area(), name="mapped", encoding="json", metadata=metadata)
 		else:
-			raise NotImplementedError("Cannot iterate through %s file" % path.suffix)
+			return NDJSONCache(path, self.get_cache_area(), name="mapped", metadata=metadata)
+
+	@staticmethod
+	@functools.lru_cache(maxsize=None)
+	def get_mapper_version(processor):
+		"""
+		Get a version identifier for the code that maps a processor's items
+
+		This is a hash of the source files of the code involved: the file
+		defining `map_item`, the files defining the functions and classes it
+		refers to, and so on, as far as they are part of 4CAT. A `map_item`
+		that calls the `map_item` of another data source is thus also
+		versioned against that data source's code.
+
+		The code that runs does not change while 4CAT is running, so the
+		result is cached.
+
+		:param processor:  Processor class with a `map_item` method
+		:return str:  Version, or `None` if it cannot be determined
+		"""
+		root = str(Path(config.get("PATH_ROOT")).resolve())
+
+		def get_source_file(obj):
+			try:
+				source_file = str(Path(inspect.getsourcefile(obj)).resolve())
+			except TypeError:
+				return None
+
+			return source_file if source_file.startswith(root) else None
+
+		mapper = inspect.unwrap(getattr(processor.map_item, "__func__", processor.map_item))
+		if not get_source_file(mapper):
+			return None
+
+		source_files = set()
+		seen = set()
+		queue = [(mapper, processor)]
+		while queue:
+			function, owner = queue.pop()
+			function = inspect.unwrap(getattr(function, "__func__", function))
+			if not inspect.isfunction(function) or function in seen:
+				continue
+
+			seen.add(function)
+			source_file = get_source_file(function)
+			if not source_file:
+				continue
+
+			source_files.add(source_file)
+
+			# names the function refers to, including in nested functions
+			names = set()
+			code_objects = [function.__code__]
+			while code_objects:
+				code = code_objects.pop()
+				names.update(code.co_names)
+				code_objects.extend([const for const in code.co_consts if inspect.iscode(const)])
+
+			# methods of the class the function is part of, e.g. via `self`,
+			# and functions and classes from the module it is defined in
+			classes = [owner] if owner else []
+			for name in names:
+				value = function.__globals__.get(name)
+				if inspect.isfunction(value) and get_source_file(value):
+					queue.append((value, None))
+				elif inspect.isclass(value) and get_source_file(value):
+					source_files.add(get_source_file(value))
+					classes.append(value)
+
+			for cls in classes:
+				for name in names:
+					attribute = inspect.getattr_static(cls, name, None)
+					if attribute is not None:
+						queue.append((attribute, cls))
+
+		version = hashlib.md5()
+		for source_file in sorted(source_files):
+			try:
+				with open(source_file, "rb") as infile:
+					version.update(infile.read())
+			except OSError:
+				return None
+
+		return version.hexdigest()
 
 	def iterate_mapped_items(self, processor=None):
 		"""
@@ -330,19 +711,117 @@ class DataSet(FourcatModule):
 		if hasattr(own_processor, "map_item"):
 			item_mapper = own_processor.map_item
 
-		# Loop through items
-		for item in self.iterate_items(processor=processor, bypass_map_item=True):
-			# Save original to yield
-			original_item = item.copy()
+		# If the items have been mapped before, read the mapped items
+		# alongside the original ones
+		mapped_cache = self.get_mapped_cache() if item_mapper else None
+		if mapped_cache and mapped_cache.exists():
+			yield from zip(self.iterate_items(processor=processor, bypass_map_item=True), mapped_cache.iterate())
+			return
 
-			# Map item for filter
-			if item_mapper:
-				mapped_item = item_mapper(item)
-			else:
-				mapped_item = original_item
+		mapped_writer = mapped_cache.writer() if mapped_cache else None
 
-			# Yield the two items
-			yield original_item, mapped_item
+		try:
+			# Loop through items
+			for item in self.iterate_items(processor=processor, bypass_map_item=True):
+				# Save original to yield
+				original_item = item.copy()
+
+				# Map item for filter
+				if item_mapper:
+					mapped_item = item_mapper(item)
+					if mapped_writer:
+						mapped_writer.add(mapped_item)
+				else:
+					mapped_item = original_item
+
+				# Yield the two items
+				yield original_item, mapped_item
+
+			if mapped_writer:
+				mapped_writer.commit()
+				mapped_writer = None
+
+		finally:
+			if mapped_writer:
+				mapped_writer.discard()
+
+	def map_chunks(self, function, processor=None, reducer=None, initial=None, columns=None):
+		"""
+		Apply a function to all items in the dataset, in parallel
+
+		The dataset file is split in chunks, and the function is called once
+		per chunk with an iterator of the (mapped) items in that chunk. Chunks
+		are processed in separate processes, so this is useful for CPU-bound
+		passes over the dataset, such as counting.
+
+		Because of this, the function (and the reducer) must be something that
+		can be pickled, i.e. a module-level function or a static method, and
+		cannot rely on the state of the calling processor. Worker processes
+		can only be spawned if the processor runs in its own process (see
+		`BasicWorker.run_in_process`); if not, the chunks are processed one by
+		one in the current process instead, with the same result.
+
+		The processor's `interrupted` flag is checked between chunks.
+
+		:param callable function:  Function to apply to each chunk; receives
+		an iterator of items and returns a result for that chunk
+		:param BasicProcessor processor:  A reference to the processor
+		iterating the dataset.
+		:param callable reducer:  Function to combine two chunk results with,
+		e.g. `operator.add` to merge `Counter`s. If not given, a list of chunk
+		results is returned, in dataset order.
+		:param initial:  Initial value for the reducer
+		:param list columns:  If given, only include these fields in the
+		items passed to the function, as with `iterate_items()`.
+		:return:  List of chunk results, or the reduced result
+		"""
+		path = self.get_results_path()
+		suffix = path.suffix.lower()
+
+		if suffix == ".csv":
+			index = DatasetIndex(path, self.get_cache_area())
+			fieldnames = index.meta["columns"]
+			chunks = get_csv_chunks(index)
+		elif suffix == ".ndjson":
+			fieldnames = None
+			chunks = get_ndjson_chunks(path)
+		else:
+			raise NotImplementedError("Cannot iterate through %s file" % path.suffix)
+
+		item_mapper = self.get_item_mapper()
+		tasks = [(function, item_mapper, path, start, end, fieldnames, columns) for start, end in chunks]
+		num_workers = min(convert_to_int(config.get("4cat.parallel_workers"), 4), len(tasks))
+		results = []
+
+		def check_interrupted():
+			if hasattr(processor, "interrupted") and processor.interrupted:
+				raise ProcessorInterruptedException("Processor interrupted while processing dataset chunks")
+
+			if hasattr(processor, "dataset") and processor.dataset and tasks:
+				processor.dataset.update_progress(len(results) / len(tasks))
+
+		if num_workers > 1 and can_spawn_processes():
+			with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+				pending = pool.imap(process_chunk, tasks)
+				while True:
+					check_interrupted()
+					try:
+						results.append(pending.next(timeout=1))
+					except multiprocessing.TimeoutError:
+						continue
+					except StopIteration:
+						break
+		else:
+			for task in tasks:
+				check_interrupted()
+				results.append(process_chunk(task))
+
+		if not reducer:
+			return results
+		elif initial is not None:
+			return functools.reduce(reducer, results, initial)
+		else:
+			return functools.reduce(reducer, results) if results else None
 
 	def get_item_keys(self, processor=None):
 		"""
@@ -408,6 +887,19 @@ class DataSet(FourcatModule):
 				if staging_area.is_dir():
 					shutil.rmtree(staging_area)
 
+	def get_cache_area(self):
+		"""
+		Get path to a folder in which derived data for the dataset is cached
+
+		Unlike a staging area, this folder is not removed when the dataset is
+		finished, but only when it is deleted. It is shared between datasets
+		that use the same result file. It does not necessarily exist yet.
+
+		:return Path:  Path to folder
+		"""
+		results_file = self.get_results_path()
+		return results_file.parent.joinpath(results_file.name.replace(".", "") + "-cache")
+
 	def get_results_dir(self):
 		"""
 		Get path to results directory
@@ -526,6 +1018,10 @@ class DataSet(FourcatModule):
 			# already deleted, apparently
 			pass
 
+		cache_area = self.get_cache_area()
+		if cache_area.is_dir():
+			shutil.rmtree(cache_area, ignore_errors=True)
+
 	def update_children(self, **kwargs):
 		"""
 		Update an attribute for all child datasets
@@ -968,20 +1464,23 @@ class DataSet(FourcatModule):
 		if self.genealogy and not inclusive:
 			return self.genealogy
 
-		key_parent = self.key_parent
 		genealogy = []
-
-		while key_parent:
-			try:
-				parent = DataSet(key=key_parent, db=self.db)
-			except TypeError:
-				break
-
-			genealogy.append(parent)
-			if parent.key_parent:
-				key_parent = parent.key_parent
-			else:
-				break
+		if self.key_parent:
+			# all ancestors are retrieved in one go; the depth limit guards
+			# against (unlikely) cycles in the hierarchy
+			ancestors = self.db.fetchall("""
+				WITH RECURSIVE ancestors AS (
+					SELECT *, 0 AS depth FROM datasets WHERE key = %s
+					UNION ALL
+					SELECT d.*, a.depth + 1 FROM datasets AS d INNER JOIN ancestors AS a ON d.key = a.key_parent
+					WHERE a.key_parent != '' AND a.depth < 100
+				)
+				SELECT * FROM ancestors ORDER BY depth ASC
+			""", (self.key_parent,))
+
+			for ancestor in ancestors:
+				del ancestor["depth"]
+				genealogy.append(DataSet(data=ancestor, db=self.db))
 
 		genealogy.reverse()
 		genealogy.append(self)
@@ -999,11 +1498,19 @@ class DataSet(FourcatModule):
 
 		:return list:  List of DataSets
 		"""
-		children = [DataSet(data=record, db=self.db) for record in self.db.fetchall("SELECT * FROM datasets WHERE key_parent = %s", (self.key,))]
-		results = children.copy()
-		if recursive:
-			for child in children:
-				results += child.get_all_children(recursive)
+		if not recursive:
+			return [DataSet(data=record, db=self.db) for record in self.db.fetchall("SELECT * FROM datasets WHERE key_parent = %s", (self.key,))]
+
+		tree = DataSet.load_tree([self.key], db=self.db)
+		if not tree:
+			return []
+
+		results = []
+		queue = [*tree[0].children]
+		while queue:
+			child = queue.pop(0)
+			results.append(child)
+			queue.extend(child.children)
 
 		return results
 
@@ -0,0 +1,272 @@
+"""
+Sidecar index for dataset result files
+"""
+import threading
+import hashlib
+import json
+import csv
+import os
+
+import numpy
+
+from common.lib.helpers import remove_nuls, get_file_signature
+
+
+class DatasetIndex:
+	"""
+	Byte-offset index for a CSV or NDJSON dataset file
+
+	Stores the position of each item in the file, so any item can be read with
+	a seek instead of reading the file from the start. Sort orders can be
+	stored alongside it as permutations of item numbers, so a sorted page of
+	items also only needs a seek per item.
+
+	The index is stored in the dataset's cache area and rebuilt automatically
+	when the dataset file has changed since the index was made.
+	"""
+	path = None
+	index_dir = None
+	meta = None
+
+	def __init__(self, path, index_dir):
+		"""
+		Set up index
+
+		:param Path path:  Dataset file to index
+		:param Path index_dir:  Folder to store index files in
+		"""
+		self.path = path
+		self.index_dir = index_dir
+		self.suffix = path.suffix.lower()
+
+		if self.suffix not in (".csv", ".ndjson"):
+			raise NotImplementedError("Cannot index %s file" % self.suffix)
+
+		self.meta = self.load_meta()
+		if not self.meta:
+			self.meta = self.build()
+
+	@property
+	def num_items(self):
+		"""
+		Number of items in the indexed file
+
+		:return int:
+		"""
+		return self.meta["num_items"]
+
+	def load_meta(self):
+		"""
+		Load index metadata, if the index exists and is current
+
+		If the index is outdated, its files are removed.
+
+		:return dict:  Metadata, or `None` if there is no usable index
+		"""
+		meta_file = self.index_dir.joinpath("index.json")
+		if not meta_file.exists():
+			return None
+
+		try:
+			with meta_file.open() as infile:
+				meta = json.load(infile)
+		except (json.JSONDecodeError, OSError):
+			meta = None
+
+		if not meta or meta.get("signature") != get_file_signature(self.path):
+			for index_file in self.index_dir.glob("*.npy"):
+				try:
+					index_file.unlink()
+				except FileNotFoundError:
+					# removed by a concurrent request
+					pass
+			return None
+
+		return meta
+
+	def save(self, filename, write):
+		"""
+		Atomically write an index file
+
+		Concurrent requests may build the same index; writing to a temporary
+		file first makes sure nobody ever reads a half-written one.
+
+		:param str filename:  File name within the index folder
+		:param callable write:  Function that writes to a given file object
+		"""
+		self.index_dir.mkdir(parents=True, exist_ok=True)
+		target = self.index_dir.joinpath(filename)
+		temporary = self.index_dir.joinpath("%s.%i-%i.tmp" % (filename, os.getpid(), threading.get_ident()))
+		with temporary.open("wb") as outfile:
+			write(outfile)
+
+		temporary.replace(target)
+
+	def read_records(self, infile):
+		"""
+		Read records from the dataset file, with their position
+
+		Quoted CSV values can contain line breaks, so CSV records may span
+		multiple lines; the position of each record is that of its first line.
+
+		:param infile:  Dataset file, opened in binary mode, positioned at the
+		start of a record
+		:return generator:  Yields `(offset, record)` tuples, where a record is
+		a list of values for CSV files and a dictionary for NDJSON files
+		"""
+		position = infile.tell()
+
+		if self.suffix == ".ndjson":
+			for line in iter(infile.readline, b""):
+				offset = position
+				position += len(line)
+				if line.strip():
+					yield offset, json.loads(line)
+			return
+
+		def lines():
+			nonlocal position
+			for line in iter(infile.readline, b""):
+				position += len(line)
+				yield remove_nuls(line.decode("utf-8"))
+
+		# the reader only reads as many lines as it needs for the next record,
+		# so the position before reading is where that record starts
+		reader = csv.reader(lines())
+		while True:
+			offset = position
+			try:
+				record = next(reader)
+			except StopIteration:
+				return
+
+			if record:
+				yield offset, record
+
+	def build(self):
+		"""
+		Index the dataset file
+
+		:return dict:  Index metadata
+		"""
+		signature = get_file_signature(self.path)
+		columns = None
+		offsets = []
+
+		with self.path.open("rb") as infile:
+			records = self.read_records(infile)
+			if self.suffix == ".csv":
+				columns = next(records, (0, []))[1]
+
+			for offset, record in records:
+				offsets.append(offset)
+
+		self.save("offsets.npy", lambda outfile: numpy.save(outfile, numpy.array(offsets, dtype=numpy.int64)))
+
+		meta = {"signature": signature, "num_items": len(offsets), "columns": columns}
+		self.save("index.json", lambda outfile: outfile.write(json.dumps(meta).encode("utf-8")))
+
+		return meta
+
+	def to_item(self, record):
+		"""
+		Convert a record to a dataset item
+
+		:param record:  Record as yielded by `read_records()`
+		:return dict:  Item
+		"""
+		if self.suffix == ".csv":
+			columns = self.meta["columns"]
+			return {columns[i]: record[i] for i in range(min(len(columns), len(record)))}
+
+		return record
+
+	def get_offsets(self):
+		"""
+		Get the byte offset of each item in the file
+
+		:return numpy.ndarray:  Offsets, memory-mapped
+		"""
+		return numpy.load(self.index_dir.joinpath("offsets.npy"), mmap_mode="r")
+
+	def iterate_items(self, max_items=None):
+		"""
+		Iterate through items in the file, in dataset order
+
+		:param int max_items:  Stop after this many items
+		:return generator:
+		"""
+		if not self.num_items:
+			return
+
+		offsets = self.get_offsets()
+		with self.path.open("rb") as infile:
+			infile.seek(int(offsets[0]))
+			for i, (offset, record) in enumerate(self.read_records(infile)):
+				if max_items is not None and i >= max_items:
+					break
+
+				yield self.to_item(record)
+
+	def get_order(self, name, sort_value, descending=False, max_items=None):
+		"""
+		Get item numbers in a given sort order
+
+		The order is computed once, by reading the sort value of each item,
+		and then stored with the index.
+
+		:param str name:  Unique name for the sort value, used to identify the
+		stored order
+		:param callable sort_value:  Function that returns the value to sort an
+		item by. May raise a `ValueError` or `TypeError` if an item cannot be
+		sorted, in which case dataset order is used.
+		:param bool descending:  Sort descending rather than ascending?
+		:param int max_items:  Only sort the first this many items
+		:return numpy.ndarray:  Item numbers, in order
+		"""
+		order_id = hashlib.md5(json.dumps([name, descending, max_items]).encode("utf-8")).hexdigest()
+		order_file = self.index_dir.joinpath("order-%s.npy" % order_id)
+
+		if not order_file.exists():
+			try:
+				values = [sort_value(item) for item in self.iterate_items(max_items=max_items)]
+				order = sorted(range(len(values)), key=values.__getitem__, reverse=descending)
+			except (ValueError, TypeError):
+				order = range(min(self.num_items, max_items) if max_items is not None else self.num_items)
+
+			self.save(order_file.name, lambda outfile: numpy.save(outfile, numpy.array(order, dtype=numpy.int64)))
+
+		return numpy.load(order_file, mmap_mode="r")
+
+	def get_items(self, start, amount, order=None):
+		"""
+		Get a page of items
+
+		:param int start:  Position of the first item to get
+		:param int amount:  Amount of items to get
+		:param numpy.ndarray order:  Item numbers in the order to page
+		through, as returned by `get_order()`. If `None`, dataset order is
+		used.
+		:return list:  Items
+		"""
+		total = self.num_items if order is None else len(order)
+		if start >= total or amount <= 0:
+			return []
+
+		end = min(start + amount, total)
+		offsets = self.get_offsets()
+		items = []
+
+		with self.path.open("rb") as infile:
+			if order is None:
+				# consecutive items, so one seek will do
+				infile.seek(int(offsets[start]))
+				records = self.read_records(infile)
+				for i in range(start, end):
+					items.append(self.to_item(next(records)[1]))
+			else:
+				for item_number in order[start:end]:
+					infile.seek(int(offsets[item_number]))
+					items.append(self.to_item(next(self.read_records(infile))[1]))
+
+		return items
@@ -721,6 +721,21 @@ def get_last_line(filepath):
     return last_line
 
 
+def get_file_signature(path):
+    """
+    Get a signature of a file's current contents
+
+    Based on the file's size and modification time, so it is cheap to
+    compute; used to check whether data derived from the file is still
+    current.
+
+    :param Path path:  Path to file
+    :return dict:  Signature, can be serialised as JSON
+    """
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
 def add_notification(db, user, notification, expires=None, allow_dismiss=True):
     db.insert("users_notifications", {
         "username": user,
@@ -17,6 +17,7 @@ class Job:
 
 	is_finished = False
 	is_claimed = False
+	is_new = False
 
 	def __init__(self, data, database=None):
 		"""
@@ -154,6 +154,44 @@ class SlackLogHandler(WebHookLogHandler):
         }
 
 
+class PipeLogHandler(logging.Handler):
+    """
+    Log handler that passes log records to another process
+
+    Used by workers running in a child process, which cannot safely write to
+    the back-end's log file themselves since rotating the file is not safe
+    across processes. Records are written as JSON, one per line, to a pipe;
+    the other process reads them and logs them with its own logger.
+    """
+    def __init__(self, pipe):
+        """
+        Set up handler
+
+        :param pipe:  File object to write records to, opened in text mode
+        """
+        super().__init__()
+        self.pipe = pipe
+
+    def emit(self, record):
+        """
+        Write a record to the pipe
+
+        :param logging.LogRecord record:  Log record to pass on
+        """
+        try:
+            frame = getattr(record, "frame", None)
+            self.pipe.write(json.dumps({
+                "level": record.levelno,
+                "message": record.getMessage(),
+                "filename": frame.filename if frame else record.pathname,
+                "lineno": frame.lineno if frame else record.lineno,
+                "name": frame.name if frame else record.funcName
+            }) + "\n")
+            self.pipe.flush()
+        except Exception:
+            self.handleError(record)
+
+
 class Logger:
     """
     Logger
@@ -175,11 +213,15 @@ class Logger:
     }
     alert_level = "FATAL"
 
-    def __init__(self, output=False, filename='4cat.log'):
+    def __init__(self, output=False, filename='4cat.log', pipe=None):
         """
         Set up log handler
 
         :param bool output:  Whether to print logs to output
+        :param str filename:  Name of the log file
+        :param pipe:  If given, log records are not written to the log file
+        but passed to another process via this file object (see
+        `PipeLogHandler`), which is then responsible for logging them
         """
         if self.logger:
             return
@@ -195,6 +237,12 @@ class Logger:
         self.logger = logging.getLogger("4cat-backend")
         self.logger.setLevel(logging.INFO)
 
+        if pipe:
+            pipe_handler = PipeLogHandler(pipe)
+            pipe_handler.setLevel(logging.INFO)
+            self.logger.addHandler(pipe_handler)
+            return
+
         # this handler manages the text log files
         handler = RotatingFileHandler(self.log_path, maxBytes=(50 * 1024 * 1024), backupCount=1)
         handler.setLevel(logging.INFO)
@@ -0,0 +1,311 @@
+"""
+Content-addressed cache for downloaded media files
+"""
+import threading
+import hashlib
+import shutil
+import json
+import os
+
+from pathlib import Path
+
+from common.lib.helpers import convert_to_int
+
+import common.config_manager as config
+
+
+class MediaCache:
+	"""
+	Media file cache, shared between datasets
+
+	Processors that download media (images, videos) can store what they
+	downloaded here, and check the cache before downloading something again.
+	Files are stored by the hash of their content, so identical files
+	downloaded via different URLs are only stored once. A separate index maps
+	each URL to the file(s) downloaded from it, with optional metadata about
+	the download.
+
+	Cached files can be hard-linked into a staging area, so using them costs
+	no extra disk space. The cache is bounded in size; when it grows too large,
+	`trim()` removes the least recently used files. Since files are only
+	removed from the cache itself, this never affects datasets the files were
+	linked into.
+
+	Files are written atomically, so the cache can be used by multiple
+	processors (and threads) at the same time.
+	"""
+	path = None
+	max_size = 0
+
+	def __init__(self, path=None, max_size=None):
+		"""
+		Set up cache
+
+		:param Path path:  Folder to store cached files in. By default, the
+		`media-cache` folder in the data folder.
+		:param int max_size:  Maximum size of the cache, in bytes. By default,
+		as configured with the `4cat.media_cache_size` setting. If 0, the
+		cache is disabled: nothing is cached and nothing is found.
+		"""
+		if path is None:
+			path = config.get("PATH_ROOT").joinpath(config.get("PATH_DATA"), "media-cache")
+
+		if max_size is None:
+			max_size = convert_to_int(config.get("4cat.media_cache_size"), 10) * 1024 * 1024 * 1024
+
+		self.path = Path(path)
+		self.max_size = max_size
+
+	@property
+	def enabled(self):
+		"""
+		Whether the cache is enabled
+
+		:return bool:
+		"""
+		return self.max_size > 0
+
+	def get_entry_path(self, url):
+		"""
+		Get path of index entry for a URL
+
+		:param str url:  URL
+		:return Path:
+		"""
+		url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+		return self.path.joinpath("urls", url_hash[:2], url_hash + ".json")
+
+	def get_object_path(self, content_hash, suffix):
+		"""
+		Get path of cached file with a given content hash
+
+		:param str content_hash:  SHA-256 hash of file content
+		:param str suffix:  File extension, including the dot
+		:return Path:
+		"""
+		return self.path.joinpath("objects", content_hash[:2], content_hash + suffix)
+
+	def get_temporary_path(self, path):
+		"""
+		Get path to write a file to before moving it to its final location
+
+		:param Path path:  Final location
+		:return Path:
+		"""
+		return path.with_name("%s.%i-%i.tmp" % (path.name, os.getpid(), threading.get_ident()))
+
+	def get(self, url):
+		"""
+		Get cached files for a URL
+
+		Marks the files as recently used.
+
+		:param str url:  URL the files were downloaded from
+		:return dict:  `None` if nothing is cached for the URL. Else, a
+		dictionary with a `files` key containing a list of `{"path": Path,
+		"filename": str}` dictionaries (one for each cached file, with the
+		original file name), and a `metadata` key with the metadata stored
+		with the files.
+		"""
+		if not self.enabled:
+			return None
+
+		entry_path = self.get_entry_path(url)
+		try:
+			with entry_path.open() as infile:
+				entry = json.load(infile)
+		except (FileNotFoundError, json.JSONDecodeError):
+			return None
+
+		files = []
+		for file in entry["files"]:
+			object_path = self.path.joinpath("objects", file["object"])
+			try:
+				os.utime(object_path)
+			except FileNotFoundError:
+				# evicted - so the entry is no longer of use either
+				try:
+					entry_path.unlink()
+				except FileNotFoundError:
+					pass
+				return None
+
+			files.append({"path": object_path, "filename": file["filename"]})
+
+		return {"files": files, "metadata": entry.get("metadata", {})}
+
+	def add(self, url, files, metadata=None):
+		"""
+		Add files downloaded from a URL to the cache
+
+		:param str url:  URL the files were downloaded from
+		:param list files:  Files to cache, either as paths or as `(file
+		object, file name)` tuples. Paths are hard-linked into the cache where
+		possible, so they should not be modified afterwards. File objects are
+		read from their current position; they are rewound to that position
+		afterwards.
+		:param dict metadata:  Metadata to store with the files, e.g.
+		information about how they were downloaded. Should be serialisable as
+		JSON; values that are not are stored as strings.
+		"""
+		if not self.enabled:
+			return
+
+		cached_files = []
+		for file in files:
+			if type(file) is tuple:
+				file, filename = file
+				object_path = self.add_file_object(file, Path(filename).suffix.lower())
+			else:
+				filename = file.name
+				object_path = self.add_path(file)
+
+			cached_files.append({
+				"object": str(object_path.relative_to(self.path.joinpath("objects"))),
+				"filename": filename
+			})
+
+		entry_path = self.get_entry_path(url)
+		entry_path.parent.mkdir(parents=True, exist_ok=True)
+		temporary_path = self.get_temporary_path(entry_path)
+		with temporary_path.open("w") as outfile:
+			json.dump({"url": url, "files": cached_files, "metadata": metadata if metadata else {}}, outfile,
+					  default=str)
+
+		temporary_path.replace(entry_path)
+
+	def add_path(self, path):
+		"""
+		Add a file on disk to the cached files
+
+		:param Path path:  File to add
+		:return Path:  Path of cached file
+		"""
+		content_hash = hashlib.sha256()
+		with path.open("rb") as infile:
+			for chunk in iter(lambda: infile.read(1024 * 1024), b""):
+				content_hash.update(chunk)
+
+		object_path = self.get_object_path(content_hash.hexdigest(), path.suffix.lower())
+		if object_path.exists():
+			os.utime(object_path)
+			return object_path
+
+		object_path.parent.mkdir(parents=True, exist_ok=True)
+		temporary_path = self.get_temporary_path(object_path)
+		self.link(path, temporary_path)
+		temporary_path.replace(object_path)
+
+		return object_path
+
+	def add_file_object(self, file, suffix):
+		"""
+		Add the contents of a file object to the cached files
+
+		:param file:  File object, opened in binary mode
+		:param str suffix:  File extension for the cached file
+		:return Path:  Path of cached file
+		"""
+		self.path.joinpath("objects").mkdir(parents=True, exist_ok=True)
+		temporary_path = self.get_temporary_path(self.path.joinpath("objects", "new"))
+		content_hash = hashlib.sha256()
+		position = file.tell()
+		with temporary_path.open("wb") as outfile:
+			for chunk in iter(lambda: file.read(1024 * 1024), b""):
+				content_hash.update(chunk)
+				outfile.write(chunk)
+
+		file.seek(position)
+
+		object_path = self.get_object_path(content_hash.hexdigest(), suffix)
+		if object_path.exists():
+			temporary_path.unlink()
+			os.utime(object_path)
+		else:
+			object_path.parent.mkdir(parents=True, exist_ok=True)
+			temporary_path.replace(object_path)
+
+		return object_path
+
+	def link_files(self, cached, directory):
+		"""
+		Hard-link cached files into a folder
+
+		Files are given their original file names, unless a file with that
+		name already exists in the folder, in which case a number is added to
+		the name.
+
+		:param dict cached:  Cached files, as returned by `get()`
+		:param Path directory:  Folder to link files into, e.g. a staging area
+		:return list:  File names of the files in the folder, in the same order
+		as the files in `cached`
+		"""
+		filenames = []
+		for file in cached["files"]:
+			filename = Path(file["filename"]).name
+			destination = directory.joinpath(filename)
+			index = 0
+			while destination.exists():
+				destination = directory.joinpath(Path(filename).stem + "-" + str(index) + Path(filename).suffix)
+				index += 1
+
+			self.link(file["path"], destination)
+			filenames.append(destination.name)
+
+		return filenames
+
+	@staticmethod
+	def link(source, destination):
+		"""
+		Hard-link a file, or copy it if it cannot be linked
+
+		Hard links are not possible across file systems, for example.
+
+		:param Path source:  File to link
+		:param Path destination:  Path of the link
+		"""
+		try:
+			os.link(source, destination)
+		except OSError:
+			shutil.copyfile(source, destination)
+
+	def trim(self):
+		"""
+		Remove least recently used files until the cache is within its size
+		limit
+
+		Index entries for URLs of which the files are removed are cleaned up
+		when they are next looked up.
+		"""
+		if not self.enabled or not self.path.joinpath("objects").exists():
+			return
+
+		cached_files = []
+		total_size = 0
+		for object_path in self.path.joinpath("objects").glob("*/*"):
+			if object_path.suffix == ".tmp":
+				# still being written
+				continue
+
+			try:
+				stat = object_path.stat()
+			except FileNotFoundError:
+				continue
+
+			cached_files.append((stat.st_mtime, stat.st_size, object_path))
+			total_size += stat.st_size
+
+		if total_size <= self.max_size:
+			return
+
+		for last_used, size, object_path in sorted(cached_files, key=lambda file: file[0]):
+			if total_size <= self.max_size:
+				break
+
+			try:
+				object_path.unlink()
+			except FileNotFoundError:
+				# removed by another processor trimming the cache
+				pass
+
+			total_size -= size
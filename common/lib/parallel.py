@@ -0,0 +1,130 @@
+"""
+Process dataset files in parallel, in chunks
+"""
+import json
+import csv
+import sys
+
+from common.lib.helpers import remove_nuls
+
+#: Approximate size of a chunk, in bytes
+CHUNK_SIZE = 32 * 1024 * 1024
+
+
+def can_spawn_processes():
+	"""
+	Check whether worker processes can be spawned from this process
+
+	Spawned processes import the main module of the parent process. This is
+	only safe if the main module was run as a module (e.g. the separate
+	process a worker with `run_in_process` runs in), since scripts like
+	`4cat-daemon.py` would otherwise run again in each child process.
+
+	:return bool:
+	"""
+	return getattr(sys.modules["__main__"], "__spec__", None) is not None
+
+
+def get_ndjson_chunks(path, chunk_size=CHUNK_SIZE):
+	"""
+	Split an NDJSON file in chunks
+
+	Chunks always start at the start of a line.
+
+	:param Path path:  File to split
+	:param int chunk_size:  Approximate size of each chunk, in bytes
+	:return list:  List of `(start, end)` byte ranges
+	"""
+	size = path.stat().st_size
+	boundaries = [0]
+
+	with path.open("rb") as infile:
+		while boundaries[-1] + chunk_size < size:
+			# continue to the start of the next line
+			infile.seek(boundaries[-1] + chunk_size)
+			infile.readline()
+			if infile.tell() >= size:
+				break
+
+			boundaries.append(infile.tell())
+
+	boundaries.append(size)
+	return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def get_csv_chunks(index, chunk_size=CHUNK_SIZE):
+	"""
+	Split a CSV file in chunks
+
+	CSV values may contain line breaks, so the file cannot simply be split at
+	line boundaries; instead, the record offsets in the dataset index are
+	used to find where records start.
+
+	:param DatasetIndex index:  Index of the file to split
+	:param int chunk_size:  Approximate size of each chunk, in bytes
+	:return list:  List of `(start, end)` byte ranges
+	"""
+	if not index.num_items:
+		return []
+
+	offsets = index.get_offsets()
+	size = index.path.stat().st_size
+	num_chunks = max(1, round((size - offsets[0]) / chunk_size))
+	boundaries = sorted(set([int(offsets[round(i * index.num_items / num_chunks)]) for i in range(num_chunks)]))
+
+	boundaries.append(size)
+	return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def iterate_chunk(path, start, end, columns=None):
+	"""
+	Iterate through the items in a chunk of a dataset file
+
+	:param Path path:  Dataset file
+	:param int start:  Byte offset of the start of the chunk
+	:param int end:  Byte offset of the end of the chunk
+	:param list columns:  For CSV files, the column names
+	:return generator:  Yields items as dictionaries
+	"""
+	with path.open("rb") as infile:
+		infile.seek(start)
+
+		def lines():
+			while infile.tell() < end:
+				line = infile.readline()
+				if not line:
+					break
+
+				yield line
+
+		if columns is None:
+			for line in lines():
+				if line.strip():
+					yield json.loads(line)
+		else:
+			reader = csv.DictReader((remove_nuls(line.decode("utf-8")) for line in lines()), fieldnames=columns)
+			for item in reader:
+				yield item
+
+
+def process_chunk(task):
+	"""
+	Process a single chunk
+
+	This is what runs in the worker processes.
+
+	:param tuple task:  Tuple of function to run, item mapper (or `None`),
+	dataset file path, start and end of the chunk, CSV columns and the
+	fields to include in the items (or `None` for all fields).
+	:return:  Whatever the function returns for the chunk
+	"""
+	function, item_mapper, path, start, end, fieldnames, columns = task
+
+	items = iterate_chunk(path, start, end, fieldnames)
+	if item_mapper:
+		items = map(item_mapper, items)
+
+	if columns is not None:
+		items = ({column: item[column] for column in columns if column in item} for item in items)
+
+	return function(items)
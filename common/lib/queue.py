@@ -19,6 +19,9 @@ class JobQueue:
 	db = None
 	log = None
 
+	#: Channel on which a notification is sent when a job is added
+	CHANNEL = "jobs_added"
+
 	def __init__(self, logger, database):
 		"""
 		Set up database handler
@@ -101,6 +104,56 @@ class JobQueue:
 
 		return [Job.get_by_data(job, self.db) for job in jobs if job]
 
+	def claim_jobs(self, slots, limit=None):
+		"""
+		Claim claimable jobs, up to a given amount per job type
+
+		Jobs are selected and claimed in a single query. Rows that are locked
+		by another transaction (e.g. another process claiming jobs at the same
+		time) are skipped, so a job can never be claimed twice. Within a job
+		type, jobs are claimed oldest first.
+
+		The claim time is calculated like in `Job.claim()`: for jobs with an
+		interval, it is rounded down to a multiple of the interval.
+
+		:param dict slots:  Job types to claim jobs for, with the maximum
+		amount of jobs to claim for each type as value
+		:param int limit:  Maximum amount of jobs to claim in total. If `None`,
+		only the amounts per type are considered.
+		:return list:  Claimed jobs, oldest first
+		"""
+		slots = {jobtype: amount for jobtype, amount in slots.items() if amount > 0}
+		if not slots or (limit is not None and limit < 1):
+			return []
+
+		now = int(time.time())
+		claim_time = "CASE WHEN interval = 0 THEN %(now)s ELSE (%(now)s / interval) * interval END"
+		jobs = self.db.fetchall((
+			"UPDATE jobs SET timestamp_claimed = " + claim_time + ", timestamp_lastclaimed = " + claim_time +
+			"      WHERE timestamp_claimed = 0 AND id IN ("
+			"         SELECT claimable.id FROM unnest(%(jobtypes)s::text[], %(amounts)s::integer[]) AS slots(jobtype, amount)"
+			"         CROSS JOIN LATERAL ("
+			"             SELECT id, timestamp FROM jobs"
+			"              WHERE jobs.jobtype = slots.jobtype"
+			"                AND timestamp_claimed = 0"
+			"                AND timestamp_after < %(now)s"
+			"                AND (interval = 0 OR timestamp_lastclaimed + interval < %(now)s)"
+			"           ORDER BY timestamp ASC"
+			"              LIMIT slots.amount"
+			"                FOR UPDATE SKIP LOCKED"
+			"         ) AS claimable"
+			"      ORDER BY claimable.timestamp ASC"
+			"         LIMIT %(limit)s"
+			"      )"
+			"  RETURNING *"
+		), {"now": now, "jobtypes": list(slots.keys()), "amounts": list(slots.values()), "limit": limit})
+
+		jobs = sorted([Job.get_by_data(job, self.db) for job in jobs if job], key=lambda job: job.data["timestamp"])
+		for job in jobs:
+			job.is_claimed = True
+
+		return jobs
+
 	def get_job_count(self, jobtype="*"):
 		"""
 		Get total number of jobs
@@ -133,7 +186,8 @@ class JobQueue:
 		             be a newly added job or an existing that matched the same
 		             combination (which is required to be unique, so no new job
 		             with those parameters could be queued, and the old one is
-		             just as valid).
+		             just as valid). Its `is_new` attribute is `True` if the
+		             job was actually added.
 		"""
 		data =  data={
 			"jobtype": jobtype,
@@ -147,9 +201,35 @@ class JobQueue:
 			"attempts": 0
 		}
 
-		self.db.insert("jobs", data, safe=True, constraints=("jobtype", "remote_id"))
+		# let the manager know there is something to do, so it does not need
+		# to wait until it checks the queue again
+		inserted = self.db.insert("jobs", data, safe=True, constraints=("jobtype", "remote_id"), commit=False)
+		self.db.notify(self.CHANNEL, jobtype)
+
+		job = Job.get_by_data(data, database=self.db)
+		job.is_new = inserted > 0
+		return job
+
+	def advance_job(self, jobtype, remote_id, claim_after):
+		"""
+		Allow a queued job to be claimed sooner
+
+		Only affects jobs that have not been claimed yet and that could
+		otherwise only be claimed later than the given time.
+
+		:param jobtype:  Job type
+		:param remote_id:  Remote ID of the job
+		:param int claim_after:  Timestamp after which the job may be claimed
+		:return bool:  Whether the job was advanced
+		"""
+		advanced = self.db.fetchone(
+			"UPDATE jobs SET timestamp_after = %s WHERE jobtype = %s AND remote_id = %s AND timestamp_claimed = 0 "
+			"AND timestamp_after > %s RETURNING id", (claim_after, jobtype, str(remote_id), claim_after))
+
+		if advanced:
+			self.db.notify(self.CHANNEL, jobtype)
 
-		return Job.get_by_data(data, database=self.db)
+		return bool(advanced)
 
 	def release_all(self):
 		"""
@@ -0,0 +1,137 @@
+"""
+Throttle requests per domain
+"""
+import threading
+import time
+
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from common.lib.exceptions import ProcessorInterruptedException
+
+
+class DomainThrottle:
+	"""
+	Limit concurrent requests per domain
+
+	For each domain, both the amount of simultaneous requests and the time
+	between the start of subsequent requests can be limited. This allows
+	downloading from many hosts in parallel while staying polite to each of
+	them. The throttle is thread-safe; it is meant to be shared by all threads
+	of a processor that make requests.
+
+	A limit for a domain also applies to its subdomains, unless they have a
+	limit of their own; i.e. a limit for 'imgur.com' also applies to
+	'i.imgur.com'. Each (sub)domain without a configured limit gets the
+	default limit separately.
+	"""
+	limits = None
+	default = None
+	is_interrupted = None
+
+	def __init__(self, limits=None, default=(4, 0), is_interrupted=None):
+		"""
+		Set up throttle
+
+		:param dict limits:  Limits per domain, as `(max simultaneous
+		requests, minimum seconds between requests)` tuples
+		:param tuple default:  Limit for domains not in `limits`
+		:param callable is_interrupted:  Function that returns `True` if
+		waiting should be aborted, e.g. a check for a processor's
+		`interrupted` flag. When it does, waiting raises a
+		`ProcessorInterruptedException`.
+		"""
+		self.limits = limits if limits else {}
+		self.default = default
+		self.is_interrupted = is_interrupted if is_interrupted else lambda: False
+
+		self.lock = threading.Lock()
+		self.slots = {}
+		self.next_request = {}
+
+	def get_limit(self, url):
+		"""
+		Get the limit that applies to a URL
+
+		:param str url:  URL to get the limit for
+		:return tuple:  Domain the limit is tracked for, and the limit as a
+		`(max simultaneous requests, minimum seconds between requests)` tuple
+		"""
+		domain = (urlparse(url).hostname or "").lower()
+		parts = domain.split(".")
+		for i in range(len(parts)):
+			parent_domain = ".".join(parts[i:])
+			if parent_domain in self.limits:
+				return parent_domain, self.limits[parent_domain]
+
+		return domain, self.default
+
+	@contextmanager
+	def request(self, url):
+		"""
+		Wait until a request to a URL may be made
+
+		Use as a context manager; the request counts towards the domain's
+		simultaneous requests until the context is exited.
+
+		:param str url:  URL that will be requested
+		"""
+		domain, (max_requests, interval) = self.get_limit(url)
+		with self.lock:
+			if domain not in self.slots:
+				self.slots[domain] = threading.BoundedSemaphore(max_requests)
+				self.next_request.setdefault(domain, 0)
+
+		slots = self.slots[domain]
+		while not slots.acquire(timeout=1):
+			self.check_interrupted()
+
+		try:
+			while True:
+				with self.lock:
+					wait = self.next_request[domain] - time.time()
+					if wait <= 0:
+						self.next_request[domain] = time.time() + interval
+						break
+
+				self.sleep(wait)
+
+			yield
+		finally:
+			slots.release()
+
+	def defer(self, url, seconds):
+		"""
+		Postpone further requests to a URL's domain
+
+		Useful when the host indicates requests are made too quickly, e.g. with
+		a 429 response.
+
+		:param str url:  URL on the domain to postpone requests to
+		:param float seconds:  Seconds to wait before the next request
+		"""
+		domain = self.get_limit(url)[0]
+		with self.lock:
+			self.next_request[domain] = max(self.next_request.get(domain, 0), time.time() + seconds)
+
+	def sleep(self, seconds):
+		"""
+		Sleep, unless interrupted
+
+		:param float seconds:  Seconds to sleep
+		"""
+		end = time.time() + seconds
+		while True:
+			self.check_interrupted()
+			remaining = end - time.time()
+			if remaining <= 0:
+				return
+
+			time.sleep(min(remaining, 1))
+
+	def check_interrupted(self):
+		"""
+		Raise an exception if waiting should be aborted
+		"""
+		if self.is_interrupted():
+			raise ProcessorInterruptedException("Interrupted while waiting to make request")
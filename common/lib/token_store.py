@@ -0,0 +1,587 @@
+"""
+Compact storage for tokenised documents
+"""
+import numbers
+import pickle
+import json
+
+from array import array
+from collections import Counter
+
+import numpy as np
+import scipy.sparse
+
+
+class TokenStore:
+	"""
+	Token set stored as integer token IDs
+
+	A token set consists of one or more intervals (e.g. months, or threads),
+	each containing a number of documents, which in turn are lists of tokens.
+	Rather than storing the tokens themselves, each token is assigned an
+	integer ID and documents are stored as arrays of these IDs, with one
+	vocabulary for the whole token set that maps the IDs back to tokens.
+
+	Per interval, two NumPy files are stored: one with the token IDs of all
+	documents in the interval concatenated, and one with the offsets at which
+	each document starts (plus the offset of the end of the last document).
+	These files can be memory-mapped, so documents can be read without loading
+	the whole token set into memory.
+
+	Additionally, a document-term matrix is stored per interval: a sparse
+	matrix with a row per document and a column per token ID, containing the
+	amount of times the token occurs in the document. This is what most
+	analyses of token sets start with, so it is computed once, when the token
+	set is created, rather than by each of them.
+
+	The token set's metadata is stored alongside it in `.token_metadata.json`;
+	this is written by the tokeniser, not by the token store itself.
+	"""
+	path = None
+
+	vocabulary_file = ".token_vocabulary.json"
+	metadata_file = ".token_metadata.json"
+
+	token_dtype = np.uint32
+	offset_dtype = np.int64
+	count_dtype = np.int32
+
+	#: Amount of tokens to process at a time when copying or counting tokens
+	block_size = 4 * 1024 * 1024
+
+	def __init__(self, path):
+		"""
+		Set up token store
+
+		:param Path path:  Folder the token set is stored in
+		"""
+		self.path = path
+
+	@staticmethod
+	def get_token_filename(interval):
+		"""
+		Get name of the file containing the token IDs for an interval
+
+		This is also the file name the token metadata refers to for the
+		interval.
+
+		:param str interval:  Interval
+		:return str:
+		"""
+		return "%s.tokens.npy" % interval
+
+	@staticmethod
+	def get_offsets_filename(interval):
+		"""
+		Get name of the file containing the document offsets for an interval
+
+		:param str interval:  Interval
+		:return str:
+		"""
+		return "%s.offsets.npy" % interval
+
+	@staticmethod
+	def get_matrix_filename(interval):
+		"""
+		Get name of the file containing the document-term matrix for an
+		interval
+
+		:param str interval:  Interval
+		:return str:
+		"""
+		return "%s.matrix.npz" % interval
+
+	@classmethod
+	def build_matrix(cls, tokens, offsets, num_columns):
+		"""
+		Build a document-term matrix from token IDs
+
+		The matrix is built in blocks of documents, so memory use stays
+		proportional to the amount of distinct tokens per document rather than
+		the total amount of tokens.
+
+		:param tokens:  Array of token IDs
+		:param offsets:  Array of document offsets
+		:param int num_columns:  Amount of columns, i.e. the vocabulary size
+		:return scipy.sparse.csr_matrix:  Matrix with a row per document and a
+		column per token ID
+		"""
+		num_documents = len(offsets) - 1
+		blocks = []
+		first_document = 0
+		while first_document < num_documents:
+			# as many documents as fit in a block, but at least one
+			last_document = np.searchsorted(offsets, offsets[first_document] + cls.block_size, side="right") - 1
+			last_document = min(num_documents, max(first_document + 1, last_document))
+
+			block_tokens = np.asarray(tokens[offsets[first_document]:offsets[last_document]], dtype=np.int64)
+			block = scipy.sparse.csr_matrix(
+				(np.ones(len(block_tokens), dtype=cls.count_dtype), block_tokens,
+				 offsets[first_document:last_document + 1] - offsets[first_document]),
+				shape=(last_document - first_document, num_columns))
+			block.sum_duplicates()
+			blocks.append(block)
+
+			first_document = last_document
+
+		if not blocks:
+			return scipy.sparse.csr_matrix((0, num_columns), dtype=cls.count_dtype)
+
+		return scipy.sparse.vstack(blocks, format="csr")
+
+
+class TokenWriter(TokenStore):
+	"""
+	Write a token set
+
+	Documents can be added for intervals in any order. Token IDs are buffered
+	in memory and appended to a raw file per interval as the buffers grow;
+	when the writer is closed, these are converted to NumPy files.
+	"""
+
+	def __init__(self, path):
+		"""
+		Set up token writer
+
+		:param Path path:  Folder to write the token set to
+		"""
+		super().__init__(path)
+
+		self.vocabulary = {}
+		self.offsets = {}
+		self.buffers = {}
+		self.buffered = 0
+
+		# document-term matrices of token sets added with append(), per
+		# interval, as long as no documents are added to it otherwise
+		self.matrix_blocks = {}
+
+	def add_interval(self, interval):
+		"""
+		Prepare an interval for writing documents to, if not done yet
+
+		:param str interval:  Interval
+		"""
+		if interval not in self.offsets:
+			self.offsets[interval] = array("q", [0])
+			self.buffers[interval] = array("I")
+			self.matrix_blocks[interval] = []
+			self.get_raw_path(interval).write_bytes(b"")
+
+	def add_document(self, interval, tokens):
+		"""
+		Add a document to the token set
+
+		:param str interval:  Interval the document belongs to
+		:param list tokens:  Tokens in the document
+		:return int:  Document number, i.e. the index of the document within
+		the interval
+		"""
+		self.add_interval(interval)
+
+		vocabulary = self.vocabulary
+		token_ids = [vocabulary.setdefault(token, len(vocabulary)) for token in tokens]
+
+		offsets = self.offsets[interval]
+		offsets.append(offsets[-1] + len(token_ids))
+		self.buffers[interval].extend(token_ids)
+
+		# the matrix for this interval will need to be built from scratch
+		self.discard_matrix_blocks(interval)
+
+		self.buffered += len(token_ids)
+		if self.buffered > self.block_size:
+			self.flush()
+
+		return len(offsets) - 2
+
+	def append(self, token_reader):
+		"""
+		Add all documents in another token set to this one
+
+		Documents are added in the order they have in the other token set,
+		after the documents already in this one. Tokens are copied as arrays
+		of token IDs, mapped to the IDs in this token set, so this is a lot
+		faster than adding the documents one by one. The other token set's
+		document-term matrices are re-used as well.
+
+		:param TokenReader token_reader:  Reader for the token set to add
+		:return dict:  For each interval in the added token set, the document
+		number its first document was given in this token set
+		"""
+		self.flush()
+
+		vocabulary = self.vocabulary
+		id_map = np.array([vocabulary.setdefault(token, len(vocabulary)) for token in token_reader.vocabulary],
+						  dtype=self.token_dtype)
+
+		first_documents = {}
+		for interval in token_reader.intervals:
+			tokens, offsets = token_reader.get_arrays(interval)
+			self.add_interval(interval)
+
+			interval_offsets = self.offsets[interval]
+			first_documents[interval] = len(interval_offsets) - 1
+			interval_offsets.extend((offsets[1:] + interval_offsets[-1]).tolist())
+
+			with self.get_raw_path(interval).open("ab") as outfile:
+				for start in range(0, len(tokens), self.block_size):
+					id_map[tokens[start:start + self.block_size]].tofile(outfile)
+
+			del tokens
+
+			# store the matrix with its columns mapped to our token IDs; it
+			# is added to the rest when the writer is closed
+			if self.matrix_blocks[interval] is not None:
+				matrix = token_reader.get_matrix(interval)
+				matrix = scipy.sparse.csr_matrix((matrix.data, id_map[matrix.indices].astype(np.int64), matrix.indptr),
+												 shape=(matrix.shape[0], len(vocabulary)))
+				matrix.has_sorted_indices = False
+
+				block_path = self.path.joinpath(".%s.matrix-%i.npz" % (interval, len(self.matrix_blocks[interval])))
+				scipy.sparse.save_npz(block_path, matrix, compressed=False)
+				self.matrix_blocks[interval].append(block_path)
+
+		return first_documents
+
+	def discard_matrix_blocks(self, interval):
+		"""
+		Discard stored document-term matrices for an interval
+
+		:param str interval:  Interval
+		"""
+		if self.matrix_blocks[interval] is None:
+			return
+
+		for block_path in self.matrix_blocks[interval]:
+			block_path.unlink()
+
+		self.matrix_blocks[interval] = None
+
+	def get_raw_path(self, interval):
+		"""
+		Get path of the raw token ID file used while writing
+
+		:param str interval:  Interval
+		:return Path:
+		"""
+		return self.path.joinpath(".%s.tokens.raw" % interval)
+
+	def flush(self):
+		"""
+		Append buffered token IDs to the raw token ID files
+		"""
+		for interval, buffer in self.buffers.items():
+			if buffer:
+				with self.get_raw_path(interval).open("ab") as outfile:
+					buffer.tofile(outfile)
+
+				self.buffers[interval] = array("I")
+
+		self.buffered = 0
+
+	def close(self):
+		"""
+		Write the token set to disk
+
+		Converts the raw token ID files to NumPy files, and writes the offsets,
+		document-term matrices and vocabulary.
+
+		:return list:  Intervals in the token set
+		"""
+		self.flush()
+
+		for interval, offsets in self.offsets.items():
+			raw_path = self.get_raw_path(interval)
+			num_tokens = offsets[-1]
+			tokens = np.lib.format.open_memmap(self.path.joinpath(self.get_token_filename(interval)), mode="w+",
+											   dtype=self.token_dtype, shape=(num_tokens,))
+			if num_tokens > 0:
+				raw_tokens = np.memmap(raw_path, dtype=self.token_dtype, mode="r", shape=(num_tokens,))
+				for start in range(0, num_tokens, self.block_size):
+					tokens[start:start + self.block_size] = raw_tokens[start:start + self.block_size]
+				del raw_tokens
+
+			tokens.flush()
+			raw_path.unlink()
+
+			offsets = np.frombuffer(offsets, dtype=self.offset_dtype)
+			np.save(self.path.joinpath(self.get_offsets_filename(interval)), offsets)
+
+			if self.matrix_blocks[interval]:
+				blocks = []
+				for block_path in self.matrix_blocks[interval]:
+					block = scipy.sparse.load_npz(block_path)
+					block.resize(block.shape[0], len(self.vocabulary))
+					blocks.append(block)
+					block_path.unlink()
+
+				matrix = scipy.sparse.vstack(blocks, format="csr")
+				matrix.sort_indices()
+			else:
+				matrix = self.build_matrix(tokens, offsets, len(self.vocabulary))
+
+			scipy.sparse.save_npz(self.path.joinpath(self.get_matrix_filename(interval)), matrix, compressed=False)
+			del tokens, matrix
+
+		with self.path.joinpath(self.vocabulary_file).open("w", encoding="utf-8") as outfile:
+			json.dump(list(self.vocabulary), outfile)
+
+		return list(self.offsets)
+
+
+class TokenReader(TokenStore):
+	"""
+	Read a token set
+
+	Reads token sets written by `TokenWriter`. Token sets created by earlier
+	versions of the tokeniser, which are stored as a JSON (or pickle) dump of
+	a list of token lists per interval, can be read as well; these are
+	converted when the reader is set up.
+	"""
+	_vocabulary = None
+	_metadata = None
+
+	def __init__(self, path):
+		"""
+		Set up token reader
+
+		:param Path path:  Folder containing the token set, e.g. a staging
+		area the token set archive was unpacked to
+		"""
+		super().__init__(path)
+
+		self.legacy_filenames = {}
+		if not path.joinpath(self.vocabulary_file).exists():
+			self.convert_legacy()
+
+	@property
+	def vocabulary(self):
+		"""
+		Vocabulary of the token set
+
+		:return list:  Tokens, with their ID as index
+		"""
+		if self._vocabulary is None:
+			with self.path.joinpath(self.vocabulary_file).open(encoding="utf-8") as infile:
+				self._vocabulary = json.load(infile)
+
+		return self._vocabulary
+
+	@property
+	def intervals(self):
+		"""
+		Intervals in the token set, sorted by name
+
+		:return list:
+		"""
+		return sorted([file.name[:-len(".tokens.npy")] for file in self.path.glob("*.tokens.npy")])
+
+	def get_metadata(self):
+		"""
+		Get the token set's metadata
+
+		:return dict:  Metadata, or `None` if the token set has none (which is
+		the case for token sets made with old versions of the tokeniser)
+		"""
+		if self._metadata is None:
+			try:
+				with self.path.joinpath(self.metadata_file).open(encoding="utf-8") as infile:
+					self._metadata = json.load(infile)
+			except FileNotFoundError:
+				return None
+
+		return self._metadata
+
+	def get_filename(self, interval):
+		"""
+		Get name of the token file for an interval
+
+		This is how the interval's documents are referred to in the token
+		metadata.
+
+		:param str interval:  Interval
+		:return str:
+		"""
+		return self.legacy_filenames.get(interval, self.get_token_filename(interval))
+
+	def get_arrays(self, interval):
+		"""
+		Get token IDs and document offsets for an interval
+
+		The token IDs of document `n` are `tokens[offsets[n]:offsets[n + 1]]`.
+
+		:param str interval:  Interval
+		:return tuple:  Memory-mapped token ID and offset arrays
+		"""
+		offsets = np.load(self.path.joinpath(self.get_offsets_filename(interval)))
+		mmap_mode = "r" if offsets[-1] > 0 else None
+		tokens = np.load(self.path.joinpath(self.get_token_filename(interval)), mmap_mode=mmap_mode)
+
+		return tokens, offsets
+
+	def get_matrix(self, interval):
+		"""
+		Get the document-term matrix for an interval
+
+		If the token set was stored without one, it is built from the token
+		IDs and stored for later use.
+
+		:param str interval:  Interval
+		:return scipy.sparse.csr_matrix:  Matrix with a row per document and a
+		column per token ID, i.e. per item in the vocabulary
+		"""
+		matrix_path = self.path.joinpath(self.get_matrix_filename(interval))
+		if matrix_path.exists():
+			matrix = scipy.sparse.load_npz(matrix_path)
+		else:
+			tokens, offsets = self.get_arrays(interval)
+			matrix = self.build_matrix(tokens, offsets, len(self.vocabulary))
+			scipy.sparse.save_npz(matrix_path, matrix, compressed=False)
+
+		# the vocabulary may have grown since the matrix was built, if
+		# intervals were added to the token set later
+		if matrix.shape[1] < len(self.vocabulary):
+			matrix.resize(matrix.shape[0], len(self.vocabulary))
+
+		return matrix
+
+	def get_features(self, matrix, min_df=1, max_df=1.0):
+		"""
+		Select the tokens in a document-term matrix by document frequency
+
+		This works like the `min_df` and `max_df` parameters of scikit-learn's
+		`CountVectorizer`, and like it, sorts the selected tokens
+		alphabetically.
+
+		:param scipy.sparse.csr_matrix matrix:  Document-term matrix
+		:param int|float min_df:  Ignore tokens that occur in fewer documents
+		than this; if a float, as a proportion of all documents
+		:param int|float max_df:  Ignore tokens that occur in more documents
+		than this; if a float, as a proportion of all documents
+		:return tuple:  The matrix with only the columns of the selected
+		tokens, and an array with the selected tokens
+		"""
+		num_documents = matrix.shape[0]
+		min_count = min_df if isinstance(min_df, numbers.Integral) else min_df * num_documents
+		max_count = max_df if isinstance(max_df, numbers.Integral) else max_df * num_documents
+		if max_count < min_count:
+			raise ValueError("max_df corresponds to < documents than min_df")
+
+		document_frequency = np.bincount(matrix.indices, minlength=matrix.shape[1])
+		token_ids = np.flatnonzero((document_frequency >= max(min_count, 1)) & (document_frequency <= max_count))
+		if len(token_ids) == 0:
+			raise ValueError("After pruning, no terms remain. Try a lower min_df or a higher max_df.")
+
+		features = np.array(self.vocabulary, dtype=object)[token_ids]
+		order = np.argsort(features, kind="stable")
+
+		return matrix[:, token_ids[order]], features[order]
+
+	def num_documents(self, interval):
+		"""
+		Get amount of documents in an interval
+
+		:param str interval:  Interval
+		:return int:
+		"""
+		return len(np.load(self.path.joinpath(self.get_offsets_filename(interval)), mmap_mode="r")) - 1
+
+	def iterate_documents(self, interval, as_ids=False):
+		"""
+		Iterate through the documents in an interval
+
+		:param str interval:  Interval
+		:param bool as_ids:  Yield arrays of token IDs instead of lists of
+		tokens
+		:return:  A generator yielding a list of tokens per document
+		"""
+		tokens, offsets = self.get_arrays(interval)
+		vocabulary = self.vocabulary
+		for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+			if as_ids:
+				yield tokens[start:end]
+			else:
+				yield [vocabulary[token_id] for token_id in tokens[start:end].tolist()]
+
+	def get_token_counts(self, interval):
+		"""
+		Count how often each token occurs in an interval
+
+		:param str interval:  Interval
+		:return Counter:  Token counts
+		"""
+		id_counts = np.asarray(self.get_matrix(interval).sum(axis=0)).ravel()
+		token_ids = np.flatnonzero(id_counts)
+		vocabulary = self.vocabulary
+
+		return Counter({vocabulary[token_id]: count for token_id, count in
+						zip(token_ids.tolist(), id_counts[token_ids].tolist())})
+
+	def convert_legacy(self):
+		"""
+		Convert a token set made by an old version of the tokeniser
+
+		These are stored as a JSON (or pickle) dump per interval, containing a
+		list of documents, which are lists of tokens. They are converted to
+		the current format in place, and the dumps are deleted.
+		"""
+		token_writer = TokenWriter(self.path)
+		for path in sorted(self.path.iterdir()):
+			if path.name.startswith(".") or path.suffix not in (".json", ".pb"):
+				continue
+
+			interval = path.stem
+			self.legacy_filenames[interval] = path.name
+			token_writer.add_interval(interval)
+			for document in self.iterate_legacy_documents(path):
+				token_writer.add_document(interval, document)
+
+			path.unlink()
+
+		token_writer.close()
+
+	@staticmethod
+	def iterate_legacy_documents(path):
+		"""
+		Iterate through the documents in a legacy token dump
+
+		The tokeniser used to write JSON dumps with one document per line, so
+		these can be read line by line. Other dumps are loaded as a whole.
+
+		:param Path path:  Token dump
+		:return:  A generator yielding a list of tokens per document
+		"""
+		if path.suffix == ".pb":
+			with path.open("rb") as infile:
+				yield from pickle.load(infile)
+			return
+
+		with path.open(encoding="utf-8") as infile:
+			infile.seek(1)
+			yielded = False
+			for line in infile:
+				line = line.strip()
+				if line == "]":
+					return
+
+				if line.endswith(","):
+					line = line[:-1]
+
+				try:
+					document = json.loads(line)
+				except json.JSONDecodeError:
+					document = None
+
+				if type(document) is not list:
+					break
+
+				yielded = True
+				yield document
+
+			if yielded:
+				return
+
+			# not written one document per line, so read it as a whole
+			infile.seek(0)
+			yield from json.load(infile)
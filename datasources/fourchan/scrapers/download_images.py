@@ -1,8 +1,13 @@
 """
 4Chan image downloader
 """
+import threading
 import requests
 import random
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 from backend.abstract.worker import BasicWorker
 
@@ -14,57 +19,148 @@ class ImageDownloader(BasicWorker):
 
 	This downloads the images from 4chan posts that were scraped and saves them to disk.
 
+	Rather than downloading one image per worker, a single worker claims image
+	jobs in batches and downloads the images in each batch concurrently, over
+	a shared HTTP session so connections are re-used. It keeps going until no
+	image jobs are left.
+
 	todo: shrink images or keep archive at a manageable size otherwise
 	"""
 	type = "4chan-image"
 	pause = 1
-	max_workers = 10
+	max_workers = 1
+
+	# amount of image jobs to claim at a time
+	batch_size = 100
+
+	# amount of images to download at the same time
+	concurrency = 8
 
 	def work(self):
 		"""
-		Get image downloader job, and download given image
+		Get image downloader jobs, and download given images
 
 		If no images need to be downloaded, wait a while and try again.
 
 		:return:
 		"""
+		session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.concurrency)
+		session.mount("http://", adapter)
+		session.mount("https://", adapter)
+
+		jobs = [self.job]
 		try:
-			url = "http://i.4cdn.org/%s/%s%s" % (self.job.details["board"], self.job.details["tim"], self.job.details["ext"])
-			image = requests.get(url, timeout=config.get('SCRAPE_TIMEOUT') * 3)
+			with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+				while jobs:
+					# images with the same MD5 are saved to the same file, so
+					# only download each once
+					destinations = {}
+					for job in jobs:
+						if job.details["destination"] in destinations or Path(job.details["destination"]).exists():
+							job.finish()
+						else:
+							destinations[job.details["destination"]] = job
+
+					downloads = list(destinations.values())
+					for job, result in zip(downloads, pool.map(lambda job: self.download(job, session), downloads)):
+						self.handle_result(job, *result)
+
+					if self.interrupted:
+						# the current batch is done, which is as good a moment
+						# to stop as any
+						break
+
+					jobs = self.queue.claim_jobs({self.type: self.batch_size})
+		finally:
+			# if something went wrong, jobs in the batch that were not handled
+			# yet would otherwise stay claimed until 4CAT restarts. This
+			# worker's own job is left as is, like for any crashed worker
+			for job in jobs:
+				if job is not self.job and job.is_claimed and not job.is_finished:
+					job.release(delay=10)
+
+			session.close()
+
+	def download(self, job, session):
+		"""
+		Download an image
+
+		Writes the image to its destination, but leaves finishing or releasing
+		the job to `handle_result()`, which `work()` calls for each download
+		in the batch.
+
+		:param Job job:  Image job
+		:param requests.Session session:  HTTP session to download with
+		:return tuple:  Response status code (or `None` if the request failed)
+		and error message (or `None`)
+		"""
+		url = "http://i.4cdn.org/%s/%s%s" % (job.details["board"], job.details["tim"], job.details["ext"])
+		try:
+			image = session.get(url, timeout=config.get('SCRAPE_TIMEOUT') * 3, stream=True)
 		except (requests.exceptions.RequestException, ConnectionRefusedError) as e:
+			return None, str(e)
+
+		if image.status_code != 200:
+			image.close()
+			return image.status_code, None
+
+		# write image to disk - via a temporary file, so there never is a
+		# half-written image at the destination
+		image_location = Path(job.details["destination"])
+		temporary_location = image_location.with_name(".%s.%i-%i.tmp" % (image_location.name, os.getpid(), threading.get_ident()))
+		try:
+			with temporary_location.open("wb") as file:
+				for chunk in image.iter_content(1024):
+					file.write(chunk)
+
+			temporary_location.replace(image_location)
+		except (requests.exceptions.RequestException, ConnectionRefusedError, OSError) as e:
+			if temporary_location.exists():
+				temporary_location.unlink()
+			return None, str(e)
+		finally:
+			image.close()
+
+		return image.status_code, None
+
+	def handle_result(self, job, status_code, error):
+		"""
+		Finish or release an image job, depending on how the download went
+
+		:param Job job:  Image job
+		:param int status_code:  Response status code, or `None` if the
+		request failed
+		:param str error:  Error message if the request failed
+		"""
+		if status_code is None:
 			# something wrong with our internet connection? or blocked by 4chan?
 			# try again in a minute
-			if self.job.data["attempts"] > 2:
-				self.log.error("Could not download image %s after 2 retries (%s), aborting" % (self.job.details["tim"], e))
-				self.job.finish()
+			if job.data["attempts"] > 2:
+				self.log.error("Could not download image %s after 2 retries (%s), aborting" % (job.details["tim"], error))
+				job.finish()
 			else:
-				self.log.info("HTTP Error %s while downloading image, retrying later" % e)
-				self.job.release(delay=random.choice(range(15,45)))
+				self.log.info("HTTP Error %s while downloading image, retrying later" % error)
+				job.release(delay=random.choice(range(15,45)))
 			return
 
-		if image.status_code == 404:
+		if status_code == 404:
 			# image deleted - mark in database? either way, can't complete job
-			self.job.finish()
+			job.finish()
 			return
 
-		if image.status_code != 200:
+		if status_code != 200:
 			# try again in 30 seconds
-			if self.job.data["attempts"] > 2:
+			if job.data["attempts"] > 2:
 				self.log.error("Could not download image %s after 2 retries (last response code %i), aborting" %
-								 (url, image.status_code))
-				self.job.finish()
+								 (job.details["tim"], status_code))
+				job.finish()
 			else:
 				self.log.info(
-					"Got response code %i while trying to download image %s, retrying later" % (image.status_code, url))
-				self.job.release(delay=random.choice(range(5, 35)))
+					"Got response code %i while trying to download image %s, retrying later" % (status_code, job.details["tim"]))
+				job.release(delay=random.choice(range(5, 35)))
 
 			return
 
-		# write image to disk
-		image_location = self.job.details["destination"]
-		with open(image_location, 'wb') as file:
-			for chunk in image.iter_content(1024):
-				file.write(chunk)
-
 		# done!
-		self.job.finish()
+		job.finish()
@@ -2,10 +2,15 @@
 4Chan board scraper - indexes threads and queues them for scraping
 """
 
+import threading
 import json
+import time
 
 from backend.abstract.scraper import BasicJSONScraper
 from common.lib.exceptions import JobAlreadyExistsException
+from common.lib.user_input import UserInput
+
+import common.config_manager as config
 
 
 class BoardScraper4chan(BasicJSONScraper):
@@ -21,6 +26,32 @@ class BoardScraper4chan(BasicJSONScraper):
 	required_fields = ["no", "last_modified"]
 	position = 0
 
+	# thread scrape jobs to queue after processing the board index, as
+	# (claim after, position, thread ID, board) tuples
+	thread_jobs = None
+
+	# amount of thread scrapes scheduled per minute, per data source, to stay
+	# within the request budget
+	scheduled_scrapes = {}
+	schedule_lock = threading.Lock()
+
+	config = {
+		"4chan-board.thread_delay": {
+			"type": UserInput.OPTION_TEXT,
+			"default": 300,
+			"help": "Max thread scrape delay",
+			"tooltip": "Thread scrapes are delayed for threads that are in no danger of dropping off the board, so "
+					   "more new posts can be collected in one go. This is the maximum delay, in seconds."
+		},
+		"4chan-board.requests_per_minute": {
+			"type": UserInput.OPTION_TEXT,
+			"default": 60,
+			"help": "Thread scrapes per minute",
+			"tooltip": "Thread scrapes are scheduled so that at most this many threads per minute are scraped, per "
+					   "data source. Threads that are about to drop off the board are scheduled first."
+		}
+	}
+
 	def process(self, data):
 		"""
 		Process scraped board data
@@ -37,17 +68,24 @@ class BoardScraper4chan(BasicJSONScraper):
 			return False
 
 		index_thread_ids = []
+		self.thread_jobs = []
+
+		if any([page.get("threads") is None for page in data]):
+			self.log.error(
+				"No thread data from board scrape of %s/%s/" % (self.datasource, self.job.data["remote_id"]))
+			return False
 
-		for page in data:
-			if page.get('threads') is None:
-				self.log.error(
-					"No thread data from board scrape of %s/%s/" % (self.datasource, self.job.data["remote_id"]))
-				return False
+		# threads drop off the board as other threads are bumped, so the rate
+		# at which that happens determines how soon each thread should be
+		# scraped
+		threads = [thread for page in data for thread in page["threads"]]
+		self.num_threads = len(threads)
+		self.bump_rate = self.get_bump_rate(threads)
 
-			for thread in page["threads"]:
-				self.position += 1
-				new_threads += self.save_thread(thread)
-				index_thread_ids.append(thread["id"] if "id" in thread else thread["no"])
+		for thread in threads:
+			self.position += 1
+			new_threads += self.save_thread(thread)
+			index_thread_ids.append(thread["id"] if "id" in thread else thread["no"])
 
 		self.log.info("Board scrape for %s/%s/ yielded %i new threads" % (self.datasource, self.job.data["remote_id"], new_threads))
 
@@ -55,6 +93,8 @@ class BoardScraper4chan(BasicJSONScraper):
 		# These were either archived or deleted by moderators.
 		self.update_unindexed_threads(index_thread_ids)
 
+		self.queue_thread_jobs()
+
 	def save_thread(self, thread):
 		"""
 		Save thread
@@ -83,14 +123,6 @@ class BoardScraper4chan(BasicJSONScraper):
 			"index_positions": ""
 		}
 
-		# schedule a job for scraping the thread's posts
-		try:
-			jobtype = self.prefix + "-thread"
-			self.queue.add_job(jobtype=jobtype, remote_id=thread["no"], details={"board": board_id})
-		except JobAlreadyExistsException:
-			# this might happen if the workers can't keep up with the queue
-			pass
-
 		# add database record for thread, if none exists yet
 		# 8chan supports cyclical threads which have an ID that is *not* the first post's. The
 		# following line accounts for this.
@@ -100,6 +132,11 @@ class BoardScraper4chan(BasicJSONScraper):
 			new_thread += 1
 			self.db.insert("threads_" + self.prefix, thread_data)
 
+		# schedule a job for scraping the thread's posts, if needed
+		claim_after = self.get_thread_claim_time(thread, thread_row)
+		if claim_after is not None:
+			self.thread_jobs.append((claim_after, self.position, str(thread["no"]), board_id))
+
 		replacements = [self.init_time, thread.get("last_modified", 0)]
 		if "4chan" in self.type:
 			# update timestamps and position, but only for 4chan
@@ -152,7 +189,8 @@ class BoardScraper4chan(BasicJSONScraper):
 					remote_id = self.db.fetchone(query)
 					
 					if not remote_id:
-						self.queue.add_job(jobtype=jobtype, remote_id=str(thread["id"]), details={"board": board_id})
+						# these are gone from the board, so no reason to wait
+						self.thread_jobs.append((self.init_time, self.num_threads + 1, str(thread["id"]), board_id))
 						to_check += 1
 
 				except JobAlreadyExistsException:
@@ -162,6 +200,124 @@ class BoardScraper4chan(BasicJSONScraper):
 			if to_check:
 				self.log.info("Board scrape for %s/%s/ yielded %s threads that disappeared from the index, updating their status" % (self.datasource, self.job.data["remote_id"], to_check))
 
+	def get_bump_rate(self, threads):
+		"""
+		Estimate how often threads on the board are bumped
+
+		:param list threads:  Threads in the board index
+		:return float:  Bumps per second, or `None` if the index does not
+		include modification times
+		"""
+		window = 900
+		timestamps = [thread.get("last_modified", 0) for thread in threads]
+		if not any(timestamps):
+			return None
+
+		return len([timestamp for timestamp in timestamps if timestamp > self.init_time - window]) / window
+
+	def get_thread_claim_time(self, thread, thread_row):
+		"""
+		Determine when a thread should be scraped
+
+		Threads that have not changed since they were last scraped are not
+		scraped at all. Other threads are scraped sooner the closer they are
+		to dropping off the board, i.e. the lower their position in the index
+		and the faster other threads are bumped. Threads that are in no
+		danger yet wait longer, so more new posts are collected per scrape.
+
+		:param dict thread:  Thread data from the board index
+		:param dict thread_row:  Thread data from the database, or `None` if
+		the thread is new
+		:return int:  Timestamp after which the thread should be scraped, or
+		`None` if it does not need to be scraped
+		"""
+		if not thread.get("last_modified") or self.bump_rate is None:
+			# no way to tell, so scrape right away
+			return self.init_time
+
+		if thread_row and thread_row["timestamp_modified"] == thread["last_modified"] \
+				and thread_row["num_replies"] == thread.get("replies", -1) + 1:
+			# nothing happened since the thread was last scraped
+			return None
+
+		try:
+			max_delay = int(config.get("4chan-board.thread_delay", 300))
+		except (TypeError, ValueError):
+			max_delay = 300
+
+		# every bump pushes this thread one position down
+		positions_left = self.num_threads - self.position
+		time_left = positions_left / self.bump_rate if self.bump_rate else max_delay
+
+		return self.init_time + int(min(max_delay, time_left / 2))
+
+	def queue_thread_jobs(self):
+		"""
+		Queue thread scrape jobs, within the request budget
+
+		The budget is the configured amount of thread scrapes per minute for
+		this data source, shared by all its boards. Each job is scheduled in
+		the minute it should be scraped in if that minute has room left; if
+		not, it is scheduled in the closest earlier minute that does, since
+		scraping a thread a bit early does not risk missing posts. Only if no
+		minute before then has room is it scheduled later. Jobs are scheduled
+		most urgent first, so delayed scrapes never push back scrapes of
+		threads that are about to drop off the board.
+
+		Threads that already have a job queued are not counted towards the
+		budget, unless that job is moved forward because the thread has
+		become more urgent.
+		"""
+		try:
+			budget = max(1, int(config.get("4chan-board.requests_per_minute", 60)))
+		except (TypeError, ValueError):
+			budget = 60
+
+		jobtype = self.prefix + "-thread"
+		# most urgent first; for equally urgent threads, those lowest on the
+		# board first
+		for claim_after, position, thread_id, board_id in sorted(self.thread_jobs, key=lambda job: (job[0], -job[1])):
+			with self.schedule_lock:
+				scheduled = self.scheduled_scrapes.setdefault(self.prefix, {})
+				current_minute = int(time.time()) // 60
+				for minute in [minute for minute in scheduled if minute < current_minute]:
+					del scheduled[minute]
+
+				minute = self.get_free_minute(scheduled, max(current_minute, int(claim_after) // 60), current_minute, budget)
+				if minute != int(claim_after) // 60:
+					claim_after = minute * 60
+
+				# a thread may already have a job queued, e.g. if the workers
+				# can't keep up with the queue; if this thread has become more
+				# urgent since, the job is moved forward
+				job = self.queue.add_job(jobtype=jobtype, remote_id=thread_id, details={"board": board_id}, claim_after=int(claim_after))
+				if job.is_new or self.queue.advance_job(jobtype, thread_id, int(claim_after)):
+					scheduled[minute] = scheduled.get(minute, 0) + 1
+
+		self.thread_jobs = []
+
+	@staticmethod
+	def get_free_minute(scheduled, preferred, earliest, budget):
+		"""
+		Find a minute in which another thread scrape fits the budget
+
+		:param dict scheduled:  Amount of scrapes scheduled, per minute (as
+		a UNIX timestamp divided by 60)
+		:param int preferred:  Minute in which the scrape should happen
+		:param int earliest:  Earliest minute the scrape can happen in
+		:param int budget:  Maximum amount of scrapes per minute
+		:return int:  Minute to schedule the scrape in
+		"""
+		for minute in range(preferred, earliest - 1, -1):
+			if scheduled.get(minute, 0) < budget:
+				return minute
+
+		minute = preferred + 1
+		while scheduled.get(minute, 0) >= budget:
+			minute += 1
+
+		return minute
+
 	def get_url(self):
 		"""
 		Get URL to scrape for the current job
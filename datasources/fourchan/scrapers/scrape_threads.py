@@ -14,9 +14,9 @@ Flow:
         if no change in timestamp or number of posts, DONE (halt processing)
         if changes, continue
    -> create separate sets of new posts and deleted posts
-   -> mark deleted posts as deleted
+   -> mark deleted posts as deleted, in one query
    -> add new posts to database
-      -> save_post(): save post data to database
+      -> save_posts(): save post data to database, in one query
          -> queue_image(): if an image was attached, queue a job to scrape it
    -> update_thread(): update thread data
 """
@@ -125,19 +125,16 @@ class ThreadScraper4chan(BasicJSONScraper):
 
 		# mark deleted posts as such
 		deleted = set(post_dict_db.keys()) - set(post_dict_scrape.keys())
-		for post_id in deleted:
-			self.db.upsert("posts_%s_deleted" % self.prefix, data={"id_seq": post_id_map[post_id], "timestamp_deleted": self.init_time}, constraints=["id_seq"], commit=False)
+		if deleted:
+			self.db.execute_many("INSERT INTO posts_" + self.prefix + "_deleted (id_seq, timestamp_deleted) VALUES %s "
+								 "ON CONFLICT (id_seq) DO UPDATE SET timestamp_deleted = EXCLUDED.timestamp_deleted",
+								 replacements=[(post_id_map[post_id], self.init_time) for post_id in deleted], commit=False)
 		self.db.commit()
 
 		# add new posts
 		new = set(post_dict_scrape.keys()) - set(post_dict_db.keys())
-		new_posts = 0
-		new_ids = set()
-		for post_id in new:
-			added = self.save_post(post_dict_scrape[post_id], thread, first_post)
-			if added:
-				new_posts += 1
-				new_ids.add(added)
+		new_ids = self.save_posts([post_dict_scrape[post_id] for post_id in sorted(new, key=int)], thread, first_post)
+		new_posts = len(new_ids)
 
 		all_ids = set([post_id_map[post_id] for post_id in post_dict_scrape.keys() if post_id in post_id_map]).union(new_ids)
 		undeleted = 0
@@ -156,6 +153,68 @@ class ThreadScraper4chan(BasicJSONScraper):
 		# return the amount of new posts
 		return new_posts
 
+	def save_posts(self, posts, thread, first_post):
+		"""
+		Add posts to database
+
+		All posts are inserted with a single query, rather than one query per
+		post like `save_post()`. Posts that are already in the database are
+		skipped.
+
+		:param list posts:  Post data of posts to add
+		:param dict thread:  Data for thread the posts belong to
+		:param dict first_post:  First post in thread
+		:return set:  `id_seq` of each post that was inserted
+		"""
+		new_posts = {}
+		for post in posts:
+			post_data = self.get_post_data(post, thread)
+			if post_data:
+				self.highlight_post(post_data, thread, first_post)
+				new_posts[post_data["id"]] = (post, post_data)
+
+		if not new_posts:
+			return set()
+
+		fields = list(next(iter(new_posts.values()))[1].keys())
+		try:
+			inserted = self.db.execute_many(
+				"INSERT INTO posts_" + self.prefix + " (" + ", ".join(['"%s"' % field for field in fields]) + ") VALUES %s "
+				"ON CONFLICT (id, board) DO NOTHING RETURNING id, id_seq",
+				replacements=[tuple([post_data[field] for field in fields]) for post, post_data in new_posts.values()],
+				commit=False, fetch=True)
+		except (psycopg2.Error, ValueError) as e:
+			# insert one by one instead, so only the offending post is lost
+			self.db.rollback()
+			self.log.warning("Could not insert posts for thread %s/%s/%s in one go (%s), inserting separately" % (
+				self.datasource, thread["board"], thread["id"], e))
+			inserted_ids = [self.insert_post(post, post_data, thread) for post, post_data in new_posts.values()]
+			return set([id_seq for id_seq in inserted_ids if id_seq])
+
+		inserted = {row["id"]: row["id_seq"] for row in inserted}
+
+		# posts that were not inserted had been scraped before
+		dupes = [post_id for post_id in new_posts if post_id not in inserted]
+		if dupes:
+			known_dupes = {dupe["id"]: dupe for dupe in self.db.fetchall(
+				"SELECT id, thread_id, timestamp FROM posts_" + self.prefix + " WHERE id IN %s AND board = %s",
+				(tuple(dupes), self.job.details["board"]))}
+
+			for post_id in dupes:
+				post = new_posts[post_id][0]
+				dupe = known_dupes.get(post_id)
+				if dupe:
+					self.log.info("Post %s in thread %s/%s/%s (time: %s) scraped twice: first seen as %s in thread %s at %s" % (
+					 post["no"], self.datasource, thread["board"], thread["id"], post["time"], dupe["id"], dupe["thread_id"], dupe["timestamp"]))
+				else:
+					self.log.error("Post %s in thread %s/%s/%s hit database constraint but no dupe was found?" % (
+					post["no"], self.datasource, thread["board"], thread["id"]))
+
+		for post_id in inserted:
+			self.queue_post_image(new_posts[post_id][0], thread)
+
+		return set(inserted.values())
+
 	def save_post(self, post, thread, first_post):
 		"""
 		Add post to database
@@ -165,11 +224,28 @@ class ThreadScraper4chan(BasicJSONScraper):
 		:param dict first_post:  First post in thread
 		:return bool:  Whether the post was inserted
 		"""
+		post_data = self.get_post_data(post, thread)
+		if not post_data:
+			return False
+
+		self.highlight_post(post_data, thread, first_post)
+
+		return self.insert_post(post, post_data, thread)
+
+	def get_post_data(self, post, thread):
+		"""
+		Get the data to store in the database for a post
+
+		:param dict post: Post data, as scraped
+		:param dict thread: Data for thread the post belongs to
+		:return dict:  Post data, per database column, or `None` if the post
+		is missing required fields
+		"""
 		# check for data integrity
 		missing = set(self.required_fields) - set(post.keys())
 		if missing != set():
 			self.log.warning("Missing fields %s in scraped post in %s/%s, ignoring" % (repr(missing), self.datasource, self.job.data["remote_id"]))
-			return False
+			return None
 
 		# save dimensions as a dumpable dict - no need to make it indexable
 		if len({"w", "h", "tn_h", "tn_w"} - set(post.keys())) == 0:
@@ -201,6 +277,22 @@ class ThreadScraper4chan(BasicJSONScraper):
 				{field: post[field] for field in post.keys() if field not in self.known_fields})
 		}
 
+		for field in post_data:
+			if not isinstance(post_data[field], six.string_types):
+				continue
+			# apparently, sometimes \0 appears in posts or something; psycopg2 can't cope with this
+			post_data[field] = post_data[field].replace("\0", "")
+
+		return post_data
+
+	def highlight_post(self, post_data, thread, first_post):
+		"""
+		Send a Slack alert if the post matches a highlight keyword
+
+		:param dict post_data: Post data, as returned by `get_post_data()`
+		:param dict thread: Data for thread the post belongs to
+		:param dict first_post:  First post in thread
+		"""
 		# this is mostly unsupported, feel free to ignore
 		if config.get('HIGHLIGHT_SLACKHOOK') and config.get('HIGHLIGHT_MATCH') and self.type == "4chan-thread":
 			for highlight in config.get('HIGHLIGHT_MATCH'):
@@ -236,16 +328,18 @@ class ThreadScraper4chan(BasicJSONScraper):
 				except requests.RequestException as e:
 					self.log.warning("Could not send highlight alerts to Slack webhook (%s)" % e)
 
+	def insert_post(self, post, post_data, thread):
+		"""
+		Insert a single post into the database
 
-		# now insert the post into the database
+		:param dict post: Post data, as scraped
+		:param dict post_data: Post data, as returned by `get_post_data()`
+		:param dict thread: Data for thread the post belongs to
+		:return:  `id_seq` of the inserted post, or `False` if it could not be
+		inserted
+		"""
 		return_value = True
 		try:
-			for field in post_data:
-				if not isinstance(post_data[field], six.string_types):
-					continue
-				# apparently, sometimes \0 appears in posts or something; psycopg2 can't cope with this
-				post_data[field] = post_data[field].replace("\0", "")
-
 			return_value = self.db.insert("posts_" + self.prefix, post_data, return_field="id_seq")
 		except psycopg2.IntegrityError as e:
 			self.db.rollback()
@@ -262,12 +356,22 @@ class ThreadScraper4chan(BasicJSONScraper):
 			self.db.rollback()
 			self.log.error("ValueError (%s) during scrape of thread %s" % (e, post["no"]))
 
+		self.queue_post_image(post, thread)
+
+		return return_value
+
+	def queue_post_image(self, post, thread):
+		"""
+		Queue the post's image for downloading, if it has one and images
+		should be saved
+
+		:param dict post:  Post data, as scraped
+		:param dict thread:  Thread data of thread within which image was posted
+		"""
 		# Download images (exclude .webm files)
 		if "filename" in post and post["ext"] != ".webm" and config.get("4chan-thread.save_images"):
 			self.queue_image(post, thread)
 
-		return return_value
-
 	def queue_image(self, post, thread):
 		"""
 		Queue image for downloading
@@ -1,9 +1,12 @@
 """
 4chan Search via Sphinx
 """
+import threading
 import warnings
 import time
 
+from queue import Queue, Full
+
 from pymysql import OperationalError, ProgrammingError
 from pymysql.err import Warning as SphinxWarning
 
@@ -11,7 +14,7 @@ import common.config_manager as config
 from backend.lib.database_mysql import MySQLDatabase
 from common.lib.helpers import UserInput
 from backend.abstract.search import SearchWithScope
-from common.lib.exceptions import QueryParametersException, ProcessorInterruptedException
+from common.lib.exceptions import QueryParametersException, ProcessorInterruptedException, ProcessorException
 
 
 class Search4Chan(SearchWithScope):
@@ -39,6 +42,12 @@ class Search4Chan(SearchWithScope):
 	# request_abort() later
 	running_query = ""
 
+	# Sphinx queries return at most this many matches
+	sphinx_max_matches = 5000000
+
+	# amount of Sphinx matches to collect post data for at a time
+	sphinx_page_size = 250000
+
 	options = {
 		"intro": {
 			"type": UserInput.OPTION_INFO,
@@ -486,8 +495,8 @@ class Search4Chan(SearchWithScope):
 						self.dataset.update_status("Too many IDs inserted. Max 5.000.000.")
 						return None
 
-					valid_query_ids = "(" + ",".join(valid_query_ids) + ")"
-					sql_query = "SELECT * FROM (" + sql_query + " AND id IN " + valid_query_ids + ") AS ids ORDER BY timestamp ASC"
+					sql_query += " AND id IN (SELECT id FROM query_post_ids) ORDER BY timestamp ASC"
+					return self.iterate_with_post_ids(sql_query, replacements, valid_query_ids)
 
 				else:
 					self.dataset.update_status("No 4chan post IDs inserted.")
@@ -499,7 +508,7 @@ class Search4Chan(SearchWithScope):
 		else:
 			sql_query += " ORDER BY timestamp ASC"
 
-		return self.db.fetchall_interruptable(self.queue, sql_query, replacements)
+		return self.db.iterate_interruptable(self.queue, sql_query, replacements)
 
 	def get_items_complex(self, query):
 		"""
@@ -584,7 +593,11 @@ class Search4Chan(SearchWithScope):
 		where = " AND ".join(where)
 
 		if use_sphinx:
-			posts = self.fetch_sphinx(where, replacements)
+			# if we need post data, matches are collected in pages, see below
+			sphinx_limit = self.sphinx_max_matches if query.get("deleted") else self.sphinx_page_size
+			posts = self.fetch_sphinx(where, replacements, limit=sphinx_limit)
+			if posts is not None:
+				posts, num_found = posts
 		# Query the postgres table immediately if we're not using sphinx.
 		else:
 			columns = ", ".join(self.return_cols)
@@ -613,22 +626,17 @@ class Search4Chan(SearchWithScope):
 			return posts
 
 		# else we query the posts database
-		self.dataset.update_status("Found %i initial matches. Collecting post data" % len(posts))
-		datafetch_start = time.time()
+		self.dataset.update_status("Found %i initial matches. Collecting post data" % num_found)
 		self.log.info("Collecting post data from database")
-		columns = ", ".join(self.return_cols)
 
 		# Do a JOIN so we can check for deleted posts.
 		postgres_join = " LEFT JOIN posts_%s_deleted ON posts_%s.id_seq = posts_%s_deleted.id_seq " % tuple([self.prefix] * 3)
 		if not query.get("get_deleted"):
 			postgres_where.append("posts_%s_deleted.id_seq IS NULL" % self.prefix)
 
-		posts_full = self.fetch_posts(tuple([post["post_id"] for post in posts]), join=postgres_join, where=postgres_where, replacements=postgres_replacements)
-		
-		self.dataset.update_status("Post data collected")
-		self.log.info("Full posts query finished in %i seconds." % (time.time() - datafetch_start))
-
-		return posts_full
+		# post data is collected while further matches are retrieved
+		return self.iterate_sphinx_posts(posts, num_found, where, replacements, lambda post_ids: self.fetch_posts(
+			post_ids, join=postgres_join, where=postgres_where.copy(), replacements=postgres_replacements.copy()))
 
 	def convert_for_sphinx(self, string):
 		"""
@@ -661,7 +669,7 @@ class Search4Chan(SearchWithScope):
 		:param join, str: A potential JOIN statement
 		:param where, list: A potential WHERE statemement
 		:param replacements, list: The values to add in the JOIN and WHERE statements
-		:return list: List of posts, with a dictionary representing the database record for each post
+		:return generator: Posts, with a dictionary representing the database record for each post
 		"""
 		if not where:
 			where = []
@@ -670,8 +678,7 @@ class Search4Chan(SearchWithScope):
 			replacements = []
 
 		columns = ", ".join(self.return_cols) 
-		where.append("id IN %s")
-		replacements.append(post_ids)
+		where.append("id IN (SELECT id FROM query_post_ids)")
 
 		if self.interrupted:
 			raise ProcessorInterruptedException("Interrupted while fetching post data")
@@ -679,14 +686,47 @@ class Search4Chan(SearchWithScope):
 		query = "SELECT " + columns + " FROM posts_" + self.prefix + " " + join + " WHERE " + " AND ".join(
 			where) + " ORDER BY id ASC"
 
-		return self.db.fetchall_interruptable(self.queue, query, replacements)
+		return self.iterate_with_post_ids(query, replacements, post_ids)
+
+	def iterate_with_post_ids(self, query, replacements, post_ids):
+		"""
+		Iterate over rows for a query that selects posts by ID
+
+		Including the IDs in the query itself is slow for long lists of IDs
+		(they all need to be sent to and parsed by the database server, and
+		the query planner copes badly with them) and can make the query too
+		large to send at all. Instead, the IDs are bulk-loaded into a
+		temporary `query_post_ids` table which the query can select from,
+		e.g. with `id IN (SELECT id FROM query_post_ids)`. The table is
+		removed once the results have been read.
+
+		:param str query:  SQL query
+		:param list replacements:  Replacement values for the query
+		:param Iterable post_ids:  Post IDs
+		:return generator:  Yields rows, as dictionaries
+		"""
+		self.db.execute("DROP TABLE IF EXISTS query_post_ids")
+		self.db.execute("CREATE TEMPORARY TABLE query_post_ids (id BIGINT)")
+
+		try:
+			self.db.copy_rows("query_post_ids", ["id"], ((post_id,) for post_id in post_ids))
+
+			# temporary tables are not analysed automatically, but the query
+			# planner needs to know how many IDs there are
+			self.db.execute("ANALYZE query_post_ids")
+
+			yield from self.db.iterate_interruptable(self.queue, query, replacements)
+
+		finally:
+			self.db.rollback()
+			self.db.execute("DROP TABLE IF EXISTS query_post_ids")
 
 	def fetch_threads(self, thread_ids):
 		"""
 		Fetch post from database for given threads
 
 		:param list thread_ids: List of thread IDs to return post data for
-		:return list: List of posts, with a dictionary representing the database record for each post
+		:return generator: Posts, with a dictionary representing the database record for each post
 		"""
 		columns = ", ".join(self.return_cols)
 
@@ -698,40 +738,33 @@ class Search4Chan(SearchWithScope):
 		if self.parameters.get("get_deleted") is False:
 			exclude_deleted = "AND posts_" + self.prefix + "_deleted.id_seq IS NULL"
 
-		return self.db.fetchall_interruptable(self.queue,
+		return self.db.iterate_interruptable(self.queue,
 			"SELECT " + columns + " FROM posts_" + self.prefix + " \
 			LEFT JOIN posts_" + self.prefix + "_deleted ON posts_" + self.prefix + ".id_seq \
 			 = posts_" + self.prefix + "_deleted.id_seq \
 			WHERE thread_id IN %s " + exclude_deleted + " \
 			ORDER BY thread_id ASC, id ASC", (thread_ids,))
 
-	def fetch_sphinx(self, where, replacements, join=""):
+	def fetch_sphinx(self, where, replacements, join="", after_id=0, limit=None):
 		"""
 		Query Sphinx for matching post IDs
 
+		If the query fails, the dataset status is updated to explain why.
+
 		:param str where:  Drop-in WHERE clause (without the WHERE keyword) for the Sphinx query
 		:param list replacements:  Values to use for parameters in the WHERE clause that should be parsed
 		:param str join:  Drop-in JOIN clause (with the JOIN keyword) for the Sphinx query
-		:return list:  List of matching posts; each post as a dictionary with `thread_id` and `post_id` as keys
+		:param int after_id:  Only return matches with a higher Sphinx document ID than this
+		:param int limit:  Return at most this many matches; `sphinx_max_matches` if not given
+		:return tuple:  List of matching posts, each post as a dictionary with `id` (the Sphinx document ID),
+		`thread_id` and `post_id` as keys, and the total amount of matches; or `None` if the query failed
 		"""
-
-		# if a Sphinx query is interrupted, pymysql will not actually raise an
-		# exception but just a warning. But we need to detect interruption, so here we
-		# make sure pymysql warnings are converted to exceptions
-		warnings.filterwarnings("error", module=".*pymysql.*")
-
 		sphinx_start = time.time()
-		sphinx = self.get_sphinx_handler()
-
 		results = []
+		num_found = 0
 
 		try:
-			sql = "SELECT thread_id, post_id FROM `" + self.prefix + "_posts` " + join + " WHERE " + where + " LIMIT 5000000 OPTION max_matches = 5000000, ranker = none, boolean_simplify = 1, sort_method = kbuffer, cutoff = 5000000"
-			parsed_query = sphinx.mogrify(sql, replacements)
-			self.log.info("Running Sphinx query %s " % parsed_query)
-			self.running_query = parsed_query
-			results = sphinx.fetchall(parsed_query, [])
-			sphinx.close()
+			results, num_found = self.query_sphinx(where, replacements, join, after_id, limit)
 		except SphinxWarning as e:
 			# this is a pymysql warning converted to an exception
 			if "query was killed" in str(e):
@@ -762,7 +795,126 @@ class Search4Chan(SearchWithScope):
 			return None
 
 		self.log.info("Sphinx query finished in %i seconds, %i results." % (time.time() - sphinx_start, len(results)))
-		return results
+		return results, num_found
+
+	def query_sphinx(self, where, replacements, join="", after_id=0, limit=None):
+		"""
+		Run a Sphinx query for matching post IDs
+
+		Matches are returned in order of Sphinx document ID, so a query can be
+		continued where a previous one with the same parameters left off by
+		passing the last document ID as `after_id`. Unlike `fetch_sphinx()`,
+		this does not touch the dataset or 4CAT database, and exceptions are
+		left to the caller, so it can also be used from another thread.
+
+		:param str where:  Drop-in WHERE clause (without the WHERE keyword) for the Sphinx query
+		:param list replacements:  Values to use for parameters in the WHERE clause that should be parsed
+		:param str join:  Drop-in JOIN clause (with the JOIN keyword) for the Sphinx query
+		:param int after_id:  Only return matches with a higher Sphinx document ID than this
+		:param int limit:  Return at most this many matches; `sphinx_max_matches` if not given
+		:return tuple:  List of matching posts, and the total amount of matches
+		"""
+		# if a Sphinx query is interrupted, pymysql will not actually raise an
+		# exception but just a warning. But we need to detect interruption, so here we
+		# make sure pymysql warnings are converted to exceptions
+		warnings.filterwarnings("error", module=".*pymysql.*")
+
+		limit = limit if limit else self.sphinx_max_matches
+		sphinx = self.get_sphinx_handler()
+
+		if after_id:
+			where = "id > %i" % after_id + (" AND " + where if where else "")
+
+		sql = "SELECT id, thread_id, post_id FROM `" + self.prefix + "_posts` " + join + " WHERE " + where + " ORDER BY id ASC LIMIT %i OPTION max_matches = %i, ranker = none, boolean_simplify = 1, sort_method = kbuffer, cutoff = %i" % (limit, limit, self.sphinx_max_matches)
+		parsed_query = sphinx.mogrify(sql, replacements)
+		self.log.info("Running Sphinx query %s " % parsed_query)
+		self.running_query = parsed_query
+
+		try:
+			results = sphinx.fetchall(parsed_query, [])
+			meta = {row["Variable_name"]: row["Value"] for row in sphinx.fetchall("SHOW META", [])}
+		finally:
+			sphinx.close()
+
+		return results, min(self.sphinx_max_matches, int(meta.get("total_found", len(results))))
+
+	def iterate_sphinx_posts(self, first_page, num_found, where, replacements, fetch_posts, join=""):
+		"""
+		Fetch post data for all posts matching a Sphinx query
+
+		Matches are retrieved from Sphinx in pages of `sphinx_page_size`
+		matches, in order of document ID. Post data for each page is fetched
+		from the PostgreSQL database and yielded as it comes in, while the
+		next page is retrieved from Sphinx in a separate thread with its own
+		connection. That way Sphinx and PostgreSQL work at the same time
+		instead of one after the other, and posts can be written to the
+		result file before the Sphinx query is completely done.
+
+		:param list first_page:  First page of matches, as returned by
+		`fetch_sphinx()` with `sphinx_page_size` as the limit
+		:param int num_found:  Total amount of matches, as returned by
+		`fetch_sphinx()`
+		:param str where:  Drop-in WHERE clause for the Sphinx query
+		:param list replacements:  Values to use for parameters in the WHERE clause
+		:param callable fetch_posts:  Function that takes a list of post IDs
+		and returns an iterable of posts for those IDs
+		:param str join:  Drop-in JOIN clause for the Sphinx query
+		:return generator:  Yields posts
+		"""
+		pages = Queue(maxsize=2)
+		stopped = threading.Event()
+
+		def put_page(page):
+			# keep checking if the pipeline has been abandoned, so this thread
+			# does not wait forever for a page to be taken from the queue
+			while not stopped.is_set():
+				try:
+					pages.put(page, timeout=1)
+					return True
+				except Full:
+					continue
+
+			return False
+
+		def fetch_pages(page):
+			num_matches = len(page)
+			try:
+				while len(page) == self.sphinx_page_size and num_matches < self.sphinx_max_matches and not self.interrupted:
+					page, _ = self.query_sphinx(where, replacements, join, after_id=page[-1]["id"],
+													 limit=min(self.sphinx_page_size, self.sphinx_max_matches - num_matches))
+					num_matches += len(page)
+					if not put_page(page):
+						return
+			except Exception as e:
+				put_page(e)
+
+			put_page(None)
+
+		sphinx_thread = threading.Thread(target=fetch_pages, args=(first_page,), daemon=True)
+		sphinx_thread.start()
+
+		page = first_page
+		num_collected = 0
+		try:
+			while page is not None:
+				if isinstance(page, SphinxWarning) and "query was killed" in str(page):
+					raise ProcessorInterruptedException("Interrupted while running Sphinx query")
+				elif isinstance(page, Exception):
+					self.log.error("Sphinx crash during query %s: %s" % (self.dataset.key, page))
+					raise ProcessorException("Error while querying full-text search index: %s" % page)
+
+				if self.interrupted:
+					raise ProcessorInterruptedException("Interrupted while fetching post data")
+
+				yield from fetch_posts([match["post_id"] for match in page])
+
+				num_collected += len(page)
+				self.dataset.update_status("Collected post data for %s of %s matches" % ("{:,}".format(num_collected), "{:,}".format(num_found)))
+				self.dataset.update_progress(num_collected / max(1, num_found))
+
+				page = pages.get()
+		finally:
+			stopped.set()
 
 	def get_sphinx_handler(self):
 		"""
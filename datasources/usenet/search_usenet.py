@@ -1,7 +1,6 @@
 """
 Usenet Search via Sphinx
 """
-import time
 
 from common.lib.helpers import UserInput
 from common.lib.exceptions import QueryParametersException, ProcessorInterruptedException
@@ -173,31 +172,26 @@ class SearchUsenet(Search4Chan):
 		self.dataset.update_status("Searching for matches")
 		where = " AND ".join(where)
 
-		posts = self.fetch_sphinx(where, replacements)
+		posts = self.fetch_sphinx(where, replacements, limit=self.sphinx_page_size)
 		if posts is None:
 			return posts
-		elif len(posts) == 0:
+
+		posts, num_found = posts
+		if len(posts) == 0:
 			# no results
 			self.dataset.update_status("Query finished, but no results were found.")
 			return None
 
 		# query posts database
-		self.dataset.update_status("Found %i matches. Collecting post data" % len(posts))
-		datafetch_start = time.time()
+		self.dataset.update_status("Found %i matches. Collecting post data" % num_found)
 		self.log.info("Collecting post data from database")
-		columns = ", ".join(self.return_cols)
-
-		postgres_where = []
-		postgres_replacements = []
 
 		groups = [group.strip().replace("*", "%") for group in query.get("group_match", "").split(",")]
 		groups = [group for group in groups if group]
-		posts_full = self.fetch_posts(tuple([post["post_id"] for post in posts]), postgres_where, postgres_replacements, groups)
-
-		self.dataset.update_status("Post data collected")
-		self.log.info("Full posts query finished in %i seconds." % (time.time() - datafetch_start))
 
-		return posts_full
+		# post data is collected while further matches are retrieved
+		return self.iterate_sphinx_posts(posts, num_found, where, replacements,
+										 lambda post_ids: self.fetch_posts(tuple(post_ids), groups=groups))
 
 	def fetch_posts(self, post_ids, where=None, replacements=None, groups=None):
 		"""
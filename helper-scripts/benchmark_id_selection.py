@@ -0,0 +1,93 @@
+"""
+Benchmark selecting posts by a list of post IDs
+
+Compares including the IDs in the query (`id IN %s`, as the 4chan search used
+to do) with bulk-loading them into a temporary table and selecting from that
+(as it does now). Synthetic posts tables of the given sizes are created for
+this, and removed afterwards unless --keep is passed.
+
+Example: python3 helper-scripts/benchmark_id_selection.py -r 1000000,10000000 -i 1000,100000,1000000
+"""
+import argparse
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/..")
+
+from common.lib.database import Database
+from common.lib.logger import Logger
+
+cli = argparse.ArgumentParser()
+cli.add_argument("-r", "--rows", default="1000000,10000000", help="Sizes of the posts tables to test with, comma-separated")
+cli.add_argument("-i", "--ids", default="1000,100000,1000000", help="Amounts of IDs to select, comma-separated")
+cli.add_argument("-n", "--repeat", default=3, type=int, help="Times to run each query; the fastest time is reported")
+cli.add_argument("-k", "--keep", action="store_true", help="Keep synthetic posts tables after benchmarking")
+args = cli.parse_args()
+
+db = Database(logger=Logger(output=False), appname="benchmark-id-selection")
+
+
+def stream(query, replacements=None):
+	"""
+	Run a query and read its results via a server-side cursor
+
+	:param str query:  Query
+	:param replacements:  Replacement values
+	:return int:  Amount of rows read
+	"""
+	cursor = db.connection.cursor(name="benchmark")
+	cursor.itersize = 10000
+	cursor.execute(query, replacements)
+	num_rows = sum([1 for row in cursor])
+	cursor.close()
+	db.commit()
+	return num_rows
+
+
+def select_with_in(table, ids):
+	return stream("SELECT * FROM " + table + " WHERE id IN %s ORDER BY id ASC", (tuple(ids),))
+
+
+def select_with_temp_table(table, ids):
+	db.execute("DROP TABLE IF EXISTS query_post_ids")
+	db.execute("CREATE TEMPORARY TABLE query_post_ids (id BIGINT)")
+	db.copy_rows("query_post_ids", ["id"], ((post_id,) for post_id in ids))
+	db.execute("ANALYZE query_post_ids")
+	num_rows = stream("SELECT * FROM " + table + " WHERE id IN (SELECT id FROM query_post_ids) ORDER BY id ASC")
+	db.execute("DROP TABLE query_post_ids")
+	return num_rows
+
+
+methods = {"id IN %s": select_with_in, "temporary table": select_with_temp_table}
+
+for num_rows in [int(rows) for rows in args.rows.split(",")]:
+	table = "benchmark_posts_%i" % num_rows
+	print("Creating %s with %i synthetic posts..." % (table, num_rows))
+	db.execute("DROP TABLE IF EXISTS " + table)
+	# post IDs are not consecutive on 4chan either, since they are shared
+	# between boards
+	db.execute("CREATE TABLE " + table + " AS SELECT i * 3 AS id, i / 100 AS thread_id, 1500000000 + i AS timestamp, "
+			   "'Post ' || i AS body, 'Anonymous' AS author FROM generate_series(1, %s) AS i", (num_rows,))
+	db.execute("CREATE INDEX ON " + table + " (id)")
+	db.execute("ANALYZE " + table)
+
+	for num_ids in [int(ids) for ids in args.ids.split(",")]:
+		if num_ids > num_rows:
+			continue
+
+		ids = [post_id * 3 for post_id in random.sample(range(1, num_rows + 1), num_ids)]
+		for method, select in methods.items():
+			timings = []
+			for i in range(args.repeat):
+				start = time.time()
+				found = select(table, ids)
+				timings.append(time.time() - start)
+
+			print("  %10i IDs, %-16s %8.3fs (%i rows)" % (num_ids, method + ":", min(timings), found))
+
+	if not args.keep:
+		db.execute("DROP TABLE " + table)
+
+db.close()
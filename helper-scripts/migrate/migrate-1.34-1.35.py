@@ -0,0 +1,39 @@
+# Add indexes that speed up retrieving datasets, dataset trees and claimable jobs
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "'/../..")
+from common.lib.database import Database
+from common.lib.logger import Logger
+
+log = Logger(output=True)
+import common.config_manager as config
+db = Database(logger=log, dbname=config.get('DB_NAME'), user=config.get('DB_USER'), password=config.get('DB_PASSWORD'), host=config.get('DB_HOST'), port=config.get('DB_PORT'), appname="4cat-migrate")
+
+print("  Creating indexes for datasets table, if needed...")
+db.execute("""
+    CREATE INDEX IF NOT EXISTS datasets_key
+      ON datasets (
+        key
+      );
+""")
+
+db.execute("""
+    CREATE INDEX IF NOT EXISTS datasets_key_parent
+      ON datasets (
+        key_parent
+      );
+""")
+
+print("  Creating index for claimable jobs, if needed...")
+db.execute("""
+    CREATE INDEX IF NOT EXISTS jobs_claimable
+      ON jobs (
+        jobtype,
+        timestamp
+      ) WHERE timestamp_claimed = 0;
+""")
+
+db.commit()
+
+print("  Done!")
@@ -3,10 +3,15 @@ Extract URLs from columns
 
 Optionally expand shortened URLs (from Stijn's expand_url_shorteners)
 """
+import tempfile
+import shutil
 import csv
 import re
 import time
 import requests
+
+from functools import partial
+from pathlib import Path
 from ural import urls_from_text
 
 from common.lib.exceptions import ProcessorInterruptedException
@@ -32,6 +37,8 @@ class ExtractURLs(BasicProcessor):
                   " a new dataset."
     extension = "csv"
 
+    run_in_process = True  # so URLs can be extracted in parallel
+
     options = {
         "columns": {
             "type": UserInput.OPTION_TEXT,
@@ -232,65 +239,151 @@ class ExtractURLs(BasicProcessor):
         # Create fieldnames
         fieldnames = self.source_dataset.get_item_keys(self) + ["4CAT_number_unique_urls", "4CAT_extracted_urls"] + ["4CAT_extracted_from_" + column for column in columns]
 
-        # Avoid requesting the same URL multiple times
-        cache = {}
+        split_comma = self.parameters.get("split-comma", True)
+        get_row = partial(self.get_row, columns=columns, fieldnames=fieldnames, split_comma=split_comma,
+                          correct_croudtangle=correct_croudtangle, return_matches_only=return_matches_only)
 
         # write a new file with the updated links
         with self.dataset.get_results_path().open("w", encoding="utf-8", newline="") as output:
             writer = csv.DictWriter(output, fieldnames=fieldnames)
             writer.writeheader()
 
-            processed_items = 0
             url_matches_found = 0
-            total_items = self.source_dataset.num_rows
-            progress_interval_size = max(int(total_items / 10), 1)  # 1/10 of total number of records
-            for item in self.source_dataset.iterate_items(self):
-                if self.interrupted:
-                    raise ProcessorInterruptedException("Interrupted while iterating through items")
-
-                row = item.copy()
-                row["4CAT_extracted_urls"] = set()
-
-                for column in columns:
-                    value = item.get(column)
-                    if not value:
-                        continue
-                    if type(value) != str:
-                        self.dataset.update_status(f"Column \"{column}\" is not text and will be ignored.")
-                        # Remove from future
-                        columns.remove(column)
-                        continue
-
-                    # Check for links
-                    identified_urls = self.identify_links(value, self.parameters.get("split-comma", True))
-                    if correct_croudtangle:
-                        identified_urls = ["".join(id_url.split(":=:")[1:]) if ":=:" in id_url else id_url for id_url in identified_urls]
-
-                    # Expand url shorteners
-                    if expand_urls:
-                        identified_urls = [self.resolve_redirect(url=url, redirect_domains=self.redirect_domains, cache=cache) for url in identified_urls]
-
-                    # Add identified links
-                    row["4CAT_extracted_from_"+column] = identified_urls
-                    row["4CAT_extracted_urls"] |= set(identified_urls)
-
-                if (return_matches_only and row["4CAT_extracted_urls"]) or not return_matches_only:
-                    row["4CAT_number_unique_urls"] = len(row["4CAT_extracted_urls"])
-                    # Edit list/sets
-                    for column in fieldnames:
-                        if column in row.keys() and type(row[column]) in [list, set]:
-                            row[column] = ','.join(row[column])
-                    writer.writerow(row)
-                    url_matches_found += 1
-
-                processed_items += 1
-                if processed_items % progress_interval_size == 0:
-                    self.dataset.update_status(f"Processed {processed_items}/{total_items} items; {url_matches_found} items with url(s)")
-                    self.dataset.update_progress(processed_items / total_items)
-        if cache:
-            self.dataset.log(f"Expanded {len(cache)} URLs in dataset")
+            if expand_urls:
+                # expanding URLs is limited by the requests made for it, not
+                # by processing, so go through the items one by one and share
+                # the cache to avoid requesting the same URL multiple times
+                cache = {}
+                skipped_columns = set()
+                expand = partial(self.resolve_redirect, redirect_domains=self.redirect_domains, cache=cache)
+
+                processed_items = 0
+                total_items = self.source_dataset.num_rows
+                progress_interval_size = max(int(total_items / 10), 1)  # 1/10 of total number of records
+                for item in self.source_dataset.iterate_items(self):
+                    if self.interrupted:
+                        raise ProcessorInterruptedException("Interrupted while iterating through items")
+
+                    row = get_row(item, skipped_columns=skipped_columns, expand=expand)
+                    if row:
+                        writer.writerow(row)
+                        url_matches_found += 1
+
+                    processed_items += 1
+                    if processed_items % progress_interval_size == 0:
+                        self.dataset.update_status(f"Processed {processed_items}/{total_items} items; {url_matches_found} items with url(s)")
+                        self.dataset.update_progress(processed_items / total_items)
+
+                if cache:
+                    self.dataset.log(f"Expanded {len(cache)} URLs in dataset")
+
+            else:
+                # else, URLs are extracted in parallel, in chunks, each
+                # written to its own file, which are then merged in order
+                chunks = self.source_dataset.map_chunks(partial(self.extract_chunk, get_row=get_row, fieldnames=fieldnames, output_folder=str(self.dataset.get_staging_area())), processor=self)
+
+                skipped_columns = set()
+                output.flush()
+                for chunk in chunks:
+                    if self.interrupted:
+                        raise ProcessorInterruptedException("Interrupted while merging results")
+
+                    chunk_path = Path(chunk["path"])
+                    with chunk_path.open(encoding="utf-8", newline="") as infile:
+                        shutil.copyfileobj(infile, output)
+
+                    chunk_path.unlink()
+                    url_matches_found += chunk["num_rows"]
+                    skipped_columns |= chunk["skipped_columns"]
+
+            for column in skipped_columns:
+                self.dataset.update_status(f"Column \"{column}\" is not text and will be ignored.")
+
         self.dataset.finish(url_matches_found)
 
+    @staticmethod
+    def extract_chunk(items, get_row, fieldnames, output_folder):
+        """
+        Extract URLs for a chunk of the dataset
+
+        :param items:  Iterator of items in the chunk
+        :param callable get_row:  `get_row()`, with all but the item and
+        skipped columns given
+        :param list fieldnames:  Columns of the result file
+        :param str output_folder:  Folder to write the chunk's rows to
+        :return dict:  The path of the file the rows were written to (`path`),
+        the amount of rows (`num_rows`) and columns that were ignored because
+        they are not text (`skipped_columns`)
+        """
+        skipped_columns = set()
+        num_rows = 0
+
+        handle, chunk_path = tempfile.mkstemp(prefix="chunk-", suffix=".csv", dir=output_folder)
+        with open(handle, "w", encoding="utf-8", newline="") as output:
+            writer = csv.DictWriter(output, fieldnames=fieldnames)
+            for item in items:
+                row = get_row(item, skipped_columns=skipped_columns)
+                if row:
+                    writer.writerow(row)
+                    num_rows += 1
+
+        return {"path": chunk_path, "num_rows": num_rows, "skipped_columns": skipped_columns}
+
+    @staticmethod
+    def get_row(item, columns, fieldnames, split_comma, correct_croudtangle, return_matches_only, skipped_columns, expand=None):
+        """
+        Extract URLs from an item
+
+        :param dict item:  Item to extract URLs from
+        :param list columns:  Columns to extract URLs from
+        :param list fieldnames:  Columns of the result file
+        :param bool split_comma:  Split column values by comma?
+        :param bool correct_croudtangle:  Extract resolved CrowdTangle links?
+        :param bool return_matches_only:  Only return a row if it has URLs?
+        :param set skipped_columns:  Columns to ignore because they are not
+        text; updated when a column turns out not to be text
+        :param callable expand:  Function to expand URLs with, or `None`
+        :return dict:  Row to write, or `None` if it should be skipped
+        """
+        row = item.copy()
+        row["4CAT_extracted_urls"] = set()
+
+        for column in columns:
+            if column in skipped_columns:
+                continue
+
+            value = item.get(column)
+            if not value:
+                continue
+            if type(value) != str:
+                # Remove from future
+                skipped_columns.add(column)
+                continue
+
+            # Check for links
+            identified_urls = ExtractURLs.identify_links(value, split_comma)
+            if correct_croudtangle:
+                identified_urls = ["".join(id_url.split(":=:")[1:]) if ":=:" in id_url else id_url for id_url in identified_urls]
+
+            # Expand url shorteners
+            if expand:
+                identified_urls = [expand(url=url) for url in identified_urls]
+
+            # Add identified links
+            row["4CAT_extracted_from_"+column] = identified_urls
+            row["4CAT_extracted_urls"] |= set(identified_urls)
+
+        if return_matches_only and not row["4CAT_extracted_urls"]:
+            return None
+
+        row["4CAT_number_unique_urls"] = len(row["4CAT_extracted_urls"])
+        # Edit list/sets
+        for column in fieldnames:
+            if column in row.keys() and type(row[column]) in [list, set]:
+                row[column] = ','.join(row[column])
+
+        return row
+
     @staticmethod
     def resolve_redirect(url, redirect_domains=None, cache={}, depth=0):
         """
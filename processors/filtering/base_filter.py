@@ -6,6 +6,7 @@ import csv
 import json
 
 from backend.abstract.processor import BasicProcessor
+from common.lib.exceptions import QueryParametersException
 
 __author__ = "Dale Wahl"
 __credits__ = ["Dale Wahl"]
@@ -24,6 +25,12 @@ class BaseFilter(BasicProcessor):
     title = "Base Filter"  # title displayed in UI
     description = "This should not be available."
 
+    #: Relative cost of checking a single item with this filter. Filters that
+    #: define this can also be used as a step in a filter chain, in which case
+    #: they should implement `get_item_filter()`; cheaper filters are then
+    #: applied first.
+    filter_cost = None
+
     @classmethod
     def is_compatible_with(cls, module=None):
         """
@@ -85,6 +92,69 @@ class BaseFilter(BasicProcessor):
         """
         return True
 
+    @classmethod
+    def get_item_filter(cls, parameters):
+        """
+        Get a function that checks whether a single item should be retained
+
+        The function is called with the original and the mapped item, and
+        returns `True` if the item should be retained. It may add fields to
+        the original item. It should not depend on which other items it has
+        seen, so the order in which the filters in a chain are applied does
+        not change the result.
+
+        :param dict parameters:  Filter parameters
+        :return callable:  Item filter
+        :raises QueryParametersException:  If the parameters cannot be used to
+        filter items
+        """
+        raise NotImplementedError("Filter %s cannot be used to filter single items" % cls.type)
+
+    def iterate_matching_items(self, item_filters):
+        """
+        Iterate through the items that pass all given item filters
+
+        Filters are applied in the given order, and the remaining filters are
+        skipped as soon as one rejects an item.
+
+        :param list item_filters:  Item filters, as returned by
+        `get_item_filter()`
+        :return generator:  Yields original items
+        """
+        self.dataset.update_status("Reading source file")
+
+        processed_items = 0
+        matching_items = 0
+        for original_item, mapped_item in self.source_dataset.iterate_mapped_items(self):
+            processed_items += 1
+            if processed_items % 2500 == 0:
+                self.dataset.update_status("Processed %i items (%i matching)" % (processed_items, matching_items))
+                self.dataset.update_progress(processed_items / self.source_dataset.num_rows)
+
+            if not all(item_filter(original_item, mapped_item) for item_filter in item_filters):
+                continue
+
+            matching_items += 1
+            yield original_item
+
+    def filter_items_with_item_filter(self):
+        """
+        Filter items with this filter's item filter
+
+        Can be used as the `filter_items()` implementation of filters that
+        implement `get_item_filter()`.
+
+        :return generator:
+        """
+        try:
+            item_filter = self.get_item_filter(self.parameters)
+        except QueryParametersException as e:
+            self.dataset.update_status(str(e), is_final=True)
+            self.dataset.finish(0)
+            return
+
+        yield from self.iterate_matching_items([item_filter])
+
     @abc.abstractmethod
     def filter_items(self):
         """
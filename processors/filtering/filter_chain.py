@@ -0,0 +1,105 @@
+"""
+Apply multiple filters in one go
+"""
+import json
+
+from processors.filtering.base_filter import BaseFilter
+from common.lib.helpers import UserInput
+from common.lib.exceptions import QueryParametersException
+
+__author__ = "Dale Wahl"
+__credits__ = ["Dale Wahl"]
+__maintainer__ = "Dale Wahl"
+__email__ = "4cat@oilab.eu"
+
+
+class FilterChain(BaseFilter):
+    """
+    Retain only posts that pass all of a number of filters
+
+    Equivalent to running the filters one after the other, but the source
+    dataset is only read once and only a single new dataset is written.
+    """
+    type = "filter-chain"  # job type ID
+    category = "Filtering"  # category
+    title = "Apply multiple filters"  # title displayed in UI
+    description = "Retains posts that pass all of the given filters, in one go. Equivalent to filtering the dataset " \
+                  "with each of the filters one after the other. This creates a new dataset."  # description displayed in UI
+
+    options = {
+        "filters": {
+            "type": UserInput.OPTION_TEXT_JSON,
+            "default": "[]",
+            "help": "Filters",
+            "tooltip": "A list of filters, each an object with the filter type and the filter's options, e.g. "
+                       "[{\"type\": \"date-filter\", \"daterange-min\": \"2022-01-01\", \"daterange-max\": "
+                       "\"2022-12-31\"}, {\"type\": \"wildcard-filter\", \"match\": \"cat*\"}]. Supported filters "
+                       "are 'date-filter', 'wildcard-filter' and 'lexical-filter'."
+        }
+    }
+
+    @classmethod
+    def is_compatible_with(cls, module=None):
+        """
+        Allow processor on NDJSON and CSV files
+
+        :param module: Dataset or processor to determine compatibility with
+        """
+        return module.is_top_dataset() and module.get_extension() in ("csv", "ndjson")
+
+    def get_item_filters(self):
+        """
+        Get item filters for the configured filters, cheapest first
+
+        Since item filters do not depend on each other, the order in which
+        they are applied does not change the result; but applying cheap
+        filters first means expensive filters need to check fewer items.
+
+        :return list:  Item filters
+        """
+        try:
+            filters = json.loads(self.parameters.get("filters") or "[]")
+        except json.JSONDecodeError:
+            raise QueryParametersException("Filters are not valid JSON")
+
+        if type(filters) is not list or not filters:
+            raise QueryParametersException("No filters provided")
+
+        item_filters = []
+        for filter_spec in filters:
+            filter_type = filter_spec.get("type") if type(filter_spec) is dict else None
+            filter_processor = self.all_modules.processors.get(filter_type)
+            if not filter_processor or getattr(filter_processor, "filter_cost", None) is None:
+                raise QueryParametersException("'%s' cannot be used in a filter chain" % filter_type)
+
+            # options are parsed as if they were submitted via the web
+            # interface; unchecked toggles are simply left out there
+            form_input = {}
+            for option, value in filter_spec.items():
+                if value is False or value is None:
+                    continue
+                elif type(value) is list:
+                    value = ",".join([str(item) for item in value])
+
+                form_input[option] = str(value)
+
+            options = filter_processor.get_options(self.source_dataset, None)
+            parameters = UserInput.parse_all(options, form_input, silently_correct=False)
+            item_filters.append((filter_processor.filter_cost, filter_processor.get_item_filter(parameters)))
+
+        return [item_filter for cost, item_filter in sorted(item_filters, key=lambda item_filter: item_filter[0])]
+
+    def filter_items(self):
+        """
+        Create a generator to iterate through items that can be passed to create either a csv or ndjson
+
+        :return generator:
+        """
+        try:
+            item_filters = self.get_item_filters()
+        except QueryParametersException as e:
+            self.dataset.update_status(str(e), is_final=True)
+            self.dataset.finish(0)
+            return
+
+        yield from self.iterate_matching_items(item_filters)
@@ -6,6 +6,7 @@ from pathlib import Path
 
 from processors.filtering.base_filter import BaseFilter
 from common.lib.helpers import UserInput
+from common.lib.exceptions import QueryParametersException
 
 import common.config_manager as config
 
@@ -25,6 +26,8 @@ class LexicalFilter(BaseFilter):
     description = "Retains posts that contain selected words or phrases, including preset word lists. " \
                   "This creates a new dataset."  # description displayed in UI
 
+    filter_cost = 5  # potentially very large regular expressions per item
+
     references = [
         "[Hatebase](https://hatebase.org)",
         "[Regex101](https://regex101.com/)"
@@ -75,20 +78,23 @@ class LexicalFilter(BaseFilter):
         """
         return module.is_top_dataset() and module.get_extension() in ("csv", "ndjson")
 
-    def filter_items(self):
+    @classmethod
+    def get_item_filter(cls, parameters):
         """
-        Create a generator to iterate through items that can be passed to create either a csv or ndjson. Use
-        `for original_item, mapped_item in self.source_dataset.iterate_mapped_items(self)` to iterate through items
-        and yield `original_item`.
+        Get a function that checks whether an item's body matches the lexicons
 
-        :return generator:
+        Matching items get a `4cat_matching_lexicons` field listing the
+        lexicons they match.
+
+        :param dict parameters:  Filter parameters
+        :return callable:  Item filter
         """
-        exclude = self.parameters.get("exclude", False)
-        case_sensitive = self.parameters.get("case-sensitive", False)
+        exclude = parameters.get("exclude", False)
+        case_sensitive = parameters.get("case-sensitive", False)
 
         # load lexicons from word lists
         lexicons = {}
-        for lexicon_id in self.parameters.get("lexicon", []):
+        for lexicon_id in parameters.get("lexicon", []):
             lexicon_file = config.get('PATH_ROOT').joinpath(f"common/assets/wordlists/{lexicon_id}.txt")
             if not lexicon_file.exists():
                 continue
@@ -105,7 +111,7 @@ class LexicalFilter(BaseFilter):
             lexicons[custom_id] = set()
 
         custom_lexicon = set(
-            [word.strip() for word in self.parameters.get("lexicon-custom", "").split(",") if word.strip()])
+            [word.strip() for word in parameters.get("lexicon-custom", "").split(",") if word.strip()])
         lexicons[custom_id] |= custom_lexicon
 
         # compile into regex for quick matching
@@ -114,7 +120,7 @@ class LexicalFilter(BaseFilter):
             if not lexicons[lexicon_id]:
                 continue
 
-            if not self.parameters.get("as_regex"):
+            if not parameters.get("as_regex"):
                 phrases = [re.escape(term) for term in lexicons[lexicon_id] if term]
             else:
                 phrases = [term for term in lexicons[lexicon_id] if term]
@@ -128,49 +134,36 @@ class LexicalFilter(BaseFilter):
                     lexicon_regexes[lexicon_id] = re.compile(
                         r"\b(" + "|".join(phrases) + r")\b")
             except re.error:
-                self.dataset.update_status("Invalid regular expression, cannot use as filter", is_final=True)
-                self.dataset.finish(0)
-                return
-
-        # now for the real deal
-        self.dataset.update_status("Reading source file")
-        # keep some stats
-        processed = 0
-        matching_items = 0
-        for original_item, mapped_item in self.source_dataset.iterate_mapped_items(self):
-            if not mapped_item.get("body", None):
-                continue
+                raise QueryParametersException("Invalid regular expression, cannot use as filter")
 
-            if processed % 2500 == 0:
-                self.dataset.update_status("Processed %i posts (%i matching)" % (processed, matching_items))
-                self.dataset.update_progress(processed / self.source_dataset.num_rows)
+        def item_filter(original_item, mapped_item):
+            if not mapped_item.get("body", None):
+                return False
 
             # if 'partition' is false, there will just be one combined
             # lexicon, but else we'll have different ones we can
             # check separately
             matching_lexicons = set()
-            for lexicon_id in lexicons:
-                if lexicon_id not in lexicon_regexes:
-                    continue
-
-                lexicon_regex = lexicon_regexes[lexicon_id]
-
+            for lexicon_id, lexicon_regex in lexicon_regexes.items():
                 # check if we match
-                if not lexicon_regex.findall(mapped_item["body"]) and not exclude:
-                    continue
-                elif lexicon_regex.findall(mapped_item["body"]) and exclude:
-                    continue
-
-                matching_lexicons.add(lexicon_id)
+                if bool(lexicon_regex.search(mapped_item["body"])) != exclude:
+                    matching_lexicons.add(lexicon_id)
 
             # if none of the lexicons match, the post is not retained
-            processed += 1
             if not matching_lexicons:
-                continue
+                return False
 
             # if one does, record which match, and save it to the output
             # TODO: this is a conversion and will not show via map_items() for NDJSONs
             original_item["4cat_matching_lexicons"] = ",".join(matching_lexicons)
+            return True
 
-            matching_items += 1
-            yield original_item
+        return item_filter
+
+    def filter_items(self):
+        """
+        Create a generator to iterate through items that can be passed to create either a csv or ndjson
+
+        :return generator:
+        """
+        return self.filter_items_with_item_filter()
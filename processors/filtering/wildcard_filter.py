@@ -21,6 +21,8 @@ class WildcardFilter(BaseFilter):
     title = "Filter by wildcard"  # title displayed in UI
     description = "Retains only posts that contain certain words or phrases. Input may contain a wildcard *, which matches all text in between. This creates a new dataset."  # description displayed in UI
 
+    filter_cost = 3  # one regular expression per item
+
     # the following determines the options available to the user via the 4CAT interface
     options = {
         "match": {
@@ -40,40 +42,29 @@ class WildcardFilter(BaseFilter):
         """
         return module.is_top_dataset() and module.get_extension() in ("csv", "ndjson")
 
-    def filter_items(self):
+    @classmethod
+    def get_item_filter(cls, parameters):
         """
-        Create a generator to iterate through items that can be passed to create either a csv or ndjson. Use
-        `for original_item, mapped_item in self.source_dataset.iterate_mapped_items(self)` to iterate through items
-        and yield `original_item`.
+        Get a function that checks whether an item's body matches the words
 
-        :return generator:
+        :param dict parameters:  Filter parameters
+        :return callable:  Item filter
         """
-
-        matches = [match.strip().replace("*", "[^\s]*") for match in self.parameters.get("match").split(",")]
-
-        # load lexicons from word lists
-
+        matches = [match.strip().replace("*", "[^\s]*") for match in parameters.get("match").split(",")]
         matcher = re.compile(r"\b(" + "|".join(matches) + r")\b", flags=re.IGNORECASE)
 
-        # now for the real deal
-        self.dataset.update_status("Reading source file")
-
-        # keep some stats
-        processed = 0
-        matching_items = 0
-
-        # iterate through posts and see if they match
-        for original_item, mapped_item in self.source_dataset.iterate_mapped_items(self):
-            processed += 1
+        def item_filter(original_item, mapped_item):
             if not mapped_item.get("body", None):
-                continue
+                return False
 
-            if processed % 2500 == 0:
-                self.dataset.update_status("Processed %i posts (%i matching)" % (processed, matching_items))
-                self.dataset.update_progress(processed / self.source_dataset.num_rows)
+            return bool(matcher.search(mapped_item.get("body")))
 
-            if not matcher.findall(mapped_item.get("body")):
-                continue
+        return item_filter
 
-            matching_items += 1
-            yield original_item
+    def filter_items(self):
+        """
+        Create a generator to iterate through items that can be passed to create either a csv or ndjson
+
+        :return generator:
+        """
+        return self.filter_items_with_item_filter()
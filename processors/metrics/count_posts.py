@@ -3,6 +3,9 @@ Collapse post bodies into one long string
 """
 import datetime
 
+from collections import Counter
+from functools import partial
+
 from common.lib.helpers import UserInput, pad_interval, get_interval_descriptor
 from backend.abstract.processor import BasicProcessor
 
@@ -21,6 +24,8 @@ class CountPosts(BasicProcessor):
 	description = "Counts how many posts are in the dataset (overall or per timeframe)."  # description displayed in UI
 	extension = "csv"  # extension of result file, used internally and in UI
 
+	run_in_process = True  # so posts can be counted in parallel
+
 	options = {
 		"timeframe": {
 			"type": UserInput.OPTION_CHOICE,
@@ -54,31 +59,21 @@ class CountPosts(BasicProcessor):
 
 		self.dataset.update_status("Processing posts")
 		with self.dataset.get_results_path().open("w") as results:
-			counter = 0
-
-			for post in self.source_dataset.iterate_items(self):
-				try:
-					date = get_interval_descriptor(post, timeframe)
-				except ValueError as e:
-					self.dataset.update_status("%s, cannot count posts per %s" % (str(e), timeframe), is_final=True)
-					self.dataset.update_status(0)
-					return
-
-				# Add a count for the respective timeframe
-				if date not in intervals:
-					intervals[date] = {}
-					intervals[date]["absolute"] = 1
-				else:
-					intervals[date]["absolute"] += 1
-
-				first_interval = min(first_interval, date)
-				last_interval = max(last_interval, date)
-
-				counter += 1
-
-				if counter % 2500 == 0:
-					self.dataset.update_status("Counted through " + str(counter) + " posts.")
-					self.dataset.update_progress(counter / self.source_dataset.num_rows)
+			# posts are counted in parallel, in chunks; only the timestamp is
+			# needed for that
+			try:
+				intervals = self.source_dataset.map_chunks(partial(self.count_chunk, timeframe=timeframe), processor=self, reducer=self.merge_counts, columns=["timestamp"])
+			except ValueError as e:
+				self.dataset.update_status("%s, cannot count posts per %s" % (str(e), timeframe), is_final=True)
+				self.dataset.update_status(0)
+				return
+
+			# chunks are merged in order, so intervals are still in the order
+			# in which they occur in the dataset
+			intervals = {date: {"absolute": count} for date, count in intervals.items()} if intervals else {}
+			if intervals:
+				first_interval = min(intervals)
+				last_interval = max(intervals)
 
 			# pad interval if needed, this is useful if the result is to be
 			# visualised as a histogram, for example
@@ -149,6 +144,33 @@ class CountPosts(BasicProcessor):
 
 		self.write_csv_items_and_finish(rows)
 
+	@staticmethod
+	def count_chunk(posts, timeframe):
+		"""
+		Count posts per interval, for a chunk of the dataset
+
+		:param posts:  Iterator of posts in the chunk
+		:param str timeframe:  Interval to count per
+		:return Counter:  Amount of posts per interval
+		"""
+		counts = Counter()
+		for post in posts:
+			counts[get_interval_descriptor(post, timeframe)] += 1
+
+		return counts
+
+	@staticmethod
+	def merge_counts(counts, other_counts):
+		"""
+		Merge counts for two chunks
+
+		:param Counter counts:  Counts
+		:param Counter other_counts:  Counts to add
+		:return Counter:  Merged counts
+		"""
+		counts.update(other_counts)
+		return counts
+
 	@classmethod
 	def get_options(cls, parent_dataset=None, user=None):
 		
@@ -1,10 +1,15 @@
 """
 Determine hatebase scores for posts
 """
+import tempfile
+import shutil
 import json
 import csv
 import re
 
+from functools import partial
+from pathlib import Path
+
 from backend.abstract.processor import BasicProcessor
 from common.lib.helpers import UserInput
 from common.lib.exceptions import ProcessorInterruptedException
@@ -28,6 +33,8 @@ class HatebaseAnalyser(BasicProcessor):
 	description = "Assign scores for 'offensiveness' and hate speech propability to each post by using Hatebase."  # description displayed in UI
 	extension = "csv"  # extension of result file, used internally and in UI
 
+	run_in_process = True  # so posts can be annotated in parallel
+
 	token_expires = 0
 	token = ""
 
@@ -70,32 +77,75 @@ class HatebaseAnalyser(BasicProcessor):
 			self.dataset.finish(0)
 			return
 
+		# posts are annotated in parallel, in chunks, each written to its own
+		# file; the vocabulary is passed as a path, since the worker processes
+		# cannot read the configuration
+		hatebase_file = str(config.get('PATH_ROOT').joinpath(f"common/assets/hatebase/hatebase-{language}.json"))
+		chunk_area = self.dataset.get_staging_area()
+
+		fieldnames = self.source_dataset.get_item_keys(self)
+		fieldnames += ("hatebase_num", "hatebase_num_ambiguous", "hatebase_num_unambiguous",
+				"hatebase_terms", "hatebase_terms_ambiguous", "hatebase_terms_unambiguous",
+				"hatebase_offensiveness_avg")
+
+		self.dataset.update_status("Processing posts")
+		try:
+			chunks = self.source_dataset.map_chunks(partial(self.annotate_chunk, hatebase_file=hatebase_file, columns=columns,
+															fieldnames=fieldnames, output_folder=str(chunk_area)), processor=self)
+		except ValueError as e:
+			self.log.error(str(e))
+			self.dataset.update_status("Cannot write results. Your input file may contain invalid CSV data.")
+			self.dataset.finish(0)
+			return
+
+		# merge the chunks, in order
+		processed = 0
+		with self.dataset.get_results_path().open("w") as output:
+			writer = csv.DictWriter(output, fieldnames=fieldnames)
+			writer.writeheader()
+			output.flush()
+
+			for chunk in chunks:
+				if self.interrupted:
+					raise ProcessorInterruptedException("Interrupted while merging results")
+
+				chunk_path = Path(chunk["path"])
+				with chunk_path.open() as infile:
+					shutil.copyfileobj(infile, output)
+
+				chunk_path.unlink()
+				processed += chunk["num_posts"]
+
+		self.dataset.update_status("Finished")
+		self.dataset.finish(processed)
+
+	@staticmethod
+	def annotate_chunk(posts, hatebase_file, columns, fieldnames, output_folder):
+		"""
+		Determine hatebase scores for a chunk of the dataset
+
+		:param posts:  Iterator of posts in the chunk
+		:param str hatebase_file:  Path to the hatebase vocabulary to use
+		:param list columns:  Columns to look for hatebase terms in
+		:param list fieldnames:  Columns of the result file
+		:param str output_folder:  Folder to write the chunk's results to
+		:return dict:  The path of the file the annotated posts in the chunk
+		were written to (`path`) and the amount of posts (`num_posts`)
+		"""
 		# read and convert to a way we can easily match whether any word occurs
-		with config.get('PATH_ROOT').joinpath(f"common/assets/hatebase/hatebase-{language}.json").open() as hatebasedata:
+		with open(hatebase_file) as hatebasedata:
 			hatebase = json.loads(hatebasedata.read())
 
 		hatebase = {term.lower(): hatebase[term] for term in hatebase}
 		hatebase_regex = re.compile(r"\b(" + "|".join([re.escape(term) for term in hatebase]) + r")\b")
 
 		processed = 0
-		with self.dataset.get_results_path().open("w") as output:
-			fieldnames = self.source_dataset.get_item_keys(self)
-			fieldnames += ("hatebase_num", "hatebase_num_ambiguous", "hatebase_num_unambiguous",
-					"hatebase_terms", "hatebase_terms_ambiguous", "hatebase_terms_unambiguous",
-					"hatebase_offensiveness_avg")
-
+		handle, chunk_path = tempfile.mkstemp(prefix="chunk-", suffix=".csv", dir=output_folder)
+		with open(handle, "w") as output:
 			writer = csv.DictWriter(output, fieldnames=fieldnames)
-			writer.writeheader()
-
-			for post in self.source_dataset.iterate_items(self):
-				# stop processing if worker has been asked to stop
-				if self.interrupted:
-					raise ProcessorInterruptedException("Interrupted while processing posts")
 
+			for post in posts:
 				processed += 1
-				if processed % 1000 == 0:
-					self.dataset.update_status("Processing post %i" % processed)
-					self.dataset.update_progress(processed / self.source_dataset.num_rows)
 				row = {**post, **{
 					"hatebase_num": 0,
 					"hatebase_num_ambiguous": 0,
@@ -137,16 +187,9 @@ class HatebaseAnalyser(BasicProcessor):
 				if len(terms) > 0:
 					row["hatebase_offensiveness_avg"] = int(int(row["hatebase_offensiveness_avg"]) / len(terms))
 
-				try:
-					writer.writerow(row)
-				except ValueError as e:
-					self.log.error(str(e))
-					self.dataset.update_status("Cannot write results. Your input file may contain invalid CSV data.")
-					self.dataset.finish(0)
-					return
+				writer.writerow(row)
 
-		self.dataset.update_status("Finished")
-		self.dataset.finish(processed)
+		return {"path": chunk_path, "num_posts": processed}
 
 	@classmethod
 	def get_options(cls, parent_dataset=None, user=None):
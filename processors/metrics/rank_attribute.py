@@ -4,6 +4,7 @@ Generate ranking per post attribute
 import re
 
 from collections import OrderedDict
+from functools import partial
 from itertools import islice, chain
 
 from backend.abstract.processor import BasicProcessor
@@ -28,6 +29,8 @@ class AttributeRanker(BasicProcessor):
 	description = "Count values in a dataset column, like URLs or hashtags (overall or per timeframe)"  # description displayed in UI
 	extension = "csv"  # extension of result file, used internally and in UI
 
+	run_in_process = True  # so values can be counted in parallel
+
 	references = ["[regex010](https://regex101.com/)"]
 
 	# the following determines the options available to the user via the 4CAT
@@ -135,57 +138,34 @@ class AttributeRanker(BasicProcessor):
 		# This is needed to check for URLs in the "domain" and "url" columns for Reddit submissions
 		datasource = self.source_dataset.parameters.get("datasource")
 
-		# we need to be able to order the values later, chronologically, so use
-		# and OrderedDict; all frequencies go into this variable
-		items = OrderedDict()
+		# values are counted in parallel, in chunks, and only the selected
+		# columns and those needed for the time frame and weight are read
+		count_chunk = partial(self.count_chunk, columns=columns, filter=filter, split_comma=split_comma,
+							  extract=extract, to_lowercase=to_lowercase, weighby=weighby)
+		read_columns = columns + [column for column in ("timestamp", weighby) if column and column not in columns]
 
 		# if we're interested in overall top-ranking items rather than a
 		# per-period ranking, we need to do a first pass in which all posts are
 		# inspected to determine those overall top-scoring items
-		overall_top = {}
+		overall_top = None
 		if rank_style == "overall":
 			self.dataset.update_status("Determining overall top-%i items" % cutoff)
-			for post in self.source_dataset.iterate_items(self):
-				values = self.get_values(post, columns, filter, split_comma, extract)
-				for value in values:
-					if to_lowercase:
-						value = value.lower()
-					if value not in overall_top:
-						overall_top[value] = 0
-
-					overall_top[value] += convert_to_int(post.get(weighby, 1), 1)
-
-			overall_top = sorted(overall_top, key=lambda item: overall_top[item], reverse=True)[0:cutoff]
+			overall_counts = self.source_dataset.map_chunks(partial(count_chunk, timeframe="all"), processor=self,
+															reducer=self.merge_counts, columns=read_columns)
+			overall_counts = overall_counts.get("all", {}) if overall_counts else {}
+			overall_top = set(sorted(overall_counts, key=lambda item: overall_counts[item], reverse=True)[0:cutoff])
 
 		# now for the real deal
 		self.dataset.update_status("Reading source file")
-		for post in self.source_dataset.iterate_items(self):
-			# determine where to put this data
-			try:
-				time_unit = get_interval_descriptor(post, timeframe)
-			except ValueError as e:
-				self.dataset.update_status("%s, cannot count posts per %s" % (str(e), timeframe), is_final=True)
-				self.dataset.update_status(0)
-				return
-
-			if time_unit not in items:
-				items[time_unit] = OrderedDict()
-
-			# get values from post
-			values = self.get_values(post, columns, filter, split_comma, extract)
-
-			# keep track of occurrences of found items per relevant time period
-			for value in values:
-				if to_lowercase:
-						value = value.lower()
-				
-				if rank_style == "overall" and value not in overall_top:
-					continue
-
-				if value not in items[time_unit]:
-					items[time_unit][value] = 0
+		try:
+			items = self.source_dataset.map_chunks(partial(count_chunk, timeframe=timeframe, only=overall_top),
+												   processor=self, reducer=self.merge_counts, columns=read_columns)
+		except ValueError as e:
+			self.dataset.update_status("%s, cannot count posts per %s" % (str(e), timeframe), is_final=True)
+			self.dataset.update_status(0)
+			return
 
-				items[time_unit][value] += convert_to_int(post.get(weighby, 1))
+		items = items if items else {}
 
 		# sort by time and frequency
 		self.dataset.update_status("Sorting items")
@@ -221,7 +201,70 @@ class AttributeRanker(BasicProcessor):
 			self.dataset.update_status("No posts contain the requested attributes.")
 			self.dataset.finish(0)
 
-	def get_values(self, post, attributes, filter, split_comma, extract):
+	@staticmethod
+	def count_chunk(posts, timeframe, columns, filter, split_comma, extract, to_lowercase, weighby, only=None):
+		"""
+		Count values per time frame, for a chunk of the dataset
+
+		:param posts:  Iterator of posts in the chunk
+		:param str timeframe:  Interval to count per
+		:param list columns:  Columns to take values from
+		:param filter:  A compiled regular expression to filter values with, or None
+		:param bool split_comma:  Split values by comma?
+		:param str extract:  Type of value to extract from the columns
+		:param bool to_lowercase:  Convert values to lowercase?
+		:param str weighby:  Column to weigh values by, or an empty string
+		:param set only:  If given, only count these values
+		:return dict:  Per time frame, the frequency of each value
+		"""
+		counts = {}
+		for post in posts:
+			# determine where to put this data
+			time_unit = get_interval_descriptor(post, timeframe)
+			if time_unit not in counts:
+				counts[time_unit] = {}
+
+			# get values from post
+			values = AttributeRanker.get_values(post, columns, filter, split_comma, extract)
+
+			# keep track of occurrences of found items per relevant time period
+			for value in values:
+				if to_lowercase:
+					value = value.lower()
+
+				if only is not None and value not in only:
+					continue
+
+				if value not in counts[time_unit]:
+					counts[time_unit][value] = 0
+
+				counts[time_unit][value] += convert_to_int(post.get(weighby, 1))
+
+		return counts
+
+	@staticmethod
+	def merge_counts(counts, other_counts):
+		"""
+		Merge counts for two chunks
+
+		Values are added in the order in which they occur, so the result is the
+		same as when all posts would have been counted in one go.
+
+		:param dict counts:  Counts
+		:param dict other_counts:  Counts to add
+		:return dict:  Merged counts
+		"""
+		for time_unit, values in other_counts.items():
+			if time_unit not in counts:
+				counts[time_unit] = {}
+
+			for value, frequency in values.items():
+				counts[time_unit][value] = counts[time_unit].get(value, 0) + frequency
+
+		return counts
+
+	@staticmethod
+	def get_values(post, attributes, filter, split_comma, extract):
 		"""
 		Get relevant values for attribute per post
 
@@ -241,7 +284,7 @@ class AttributeRanker(BasicProcessor):
 				item_values = [post.get(attribute, "")] if post.get(attribute, "") else []
 
 			if extract:
-				item_values = list(chain(*[self.extract(v, extract) for v in item_values]))
+				item_values = list(chain(*[AttributeRanker.extract(v, extract) for v in item_values]))
 
 			if item_values:
 				values.extend(item_values)
@@ -251,7 +294,8 @@ class AttributeRanker(BasicProcessor):
 		else:
 			return set([value for value in values if not filter or filter.match(value)])
 
-	def extract(self, value, look_for):
+	@staticmethod
+	def extract(value, look_for):
 		"""
 		Extract particular types of values from a string
 
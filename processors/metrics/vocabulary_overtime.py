@@ -3,6 +3,8 @@ Over-time trends
 """
 import re
 
+from collections import Counter
+from functools import partial
 from pathlib import Path
 
 from backend.abstract.processor import BasicProcessor
@@ -25,6 +27,8 @@ class OvertimeAnalysis(BasicProcessor):
 	description = "Determines the counts over time of particular set of words or phrases."  # description displayed in UI
 	extension = "csv"  # extension of result file, used internally and in UI
 
+	run_in_process = True  # so posts can be matched in parallel
+
 	references = [
 		"[Hatebase.org](https://hatebase.org)"
 		"[\"Salvaging the Internet Hate Machine: Using the discourse of radical online subcultures to identify emergent extreme speech\" - Unblished paper detailing the OILab extreme speech lexigon](https://oilab.eu/texts/4CAT_Hate_Speech_WebSci_paper.pdf)",
@@ -127,48 +131,19 @@ class OvertimeAnalysis(BasicProcessor):
 			vocabularies["everything"] = set()
 			vocabulary_regexes["everything"] = re.compile(r".*")
 
-		# now for the real deal
+		# now for the real deal; posts are matched in parallel, in chunks
 		self.dataset.update_status("Reading source file")
-		activity = {vocabulary_id: {} for vocabulary_id in vocabularies}
-		intervals = set()
-
-		processed = 0
-		for post in self.source_dataset.iterate_items(self):
-			if not post["body"]:
-				post["body"] = ""
-				
-			if processed % 2500 == 0:
-				self.dataset.update_status("Processed %i posts" % processed)
-				self.dataset.update_progress(processed / self.source_dataset.num_rows)
-				
-			# if 'partition' is false, there will just be one combined
-			# vocabulary, but else we'll have different ones we can
-			# check separately
-			for vocabulary_id in vocabularies:
-				if vocabulary_id not in vocabulary_regexes:
-					continue
-
-				vocabulary_regex = vocabulary_regexes[vocabulary_id]
-
-				# check if we match
-				if not vocabulary_regex.findall(post["body"].lower()):
-					continue
-
-				# determine what interval to save the frequency for
-				try:
-					interval = get_interval_descriptor(post, timeframe)
-				except ValueError as e:
-					self.dataset.update_status("%s, cannot count posts per %s" % (str(e), timeframe), is_final=True)
-					self.dataset.update_status(0)
-					return
-
-				if interval not in activity[vocabulary_id]:
-					activity[vocabulary_id][interval] = 0
-
-				activity[vocabulary_id][interval] += 1
-				intervals.add(interval)
-
-			processed += 1
+		try:
+			matches = self.source_dataset.map_chunks(partial(self.count_chunk, vocabulary_regexes=vocabulary_regexes, timeframe=timeframe),
+													 processor=self, reducer=self.merge_counts, columns=["body", "timestamp"])
+		except ValueError as e:
+			self.dataset.update_status("%s, cannot count posts per %s" % (str(e), timeframe), is_final=True)
+			self.dataset.update_status(0)
+			return
+
+		matches = matches if matches else {}
+		activity = {vocabulary_id: matches.get(vocabulary_id, {}) for vocabulary_id in vocabularies}
+		intervals = set([interval for vocabulary_id in activity for interval in activity[vocabulary_id]])
 
 		# turn all that data into a simple three-column frequency table
 		rows = []
@@ -185,3 +160,53 @@ class OvertimeAnalysis(BasicProcessor):
 			self.write_csv_items_and_finish(rows)
 		else:
 			self.dataset.finish(0)
+
+	@staticmethod
+	def count_chunk(posts, vocabulary_regexes, timeframe):
+		"""
+		Count posts matching each vocabulary per interval, for a chunk of the
+		dataset
+
+		:param posts:  Iterator of posts in the chunk
+		:param dict vocabulary_regexes:  Compiled regular expression per
+		vocabulary
+		:param str timeframe:  Interval to count per
+		:return dict:  Per vocabulary, the amount of matching posts per interval
+		"""
+		activity = {}
+		for post in posts:
+			body = post["body"].lower() if post.get("body") else ""
+
+			# if 'partition' is false, there will just be one combined
+			# vocabulary, but else we'll have different ones we can
+			# check separately
+			for vocabulary_id, vocabulary_regex in vocabulary_regexes.items():
+				# check if we match
+				if not vocabulary_regex.findall(body):
+					continue
+
+				# determine what interval to save the frequency for
+				interval = get_interval_descriptor(post, timeframe)
+				if vocabulary_id not in activity:
+					activity[vocabulary_id] = Counter()
+
+				activity[vocabulary_id][interval] += 1
+
+		return activity
+
+	@staticmethod
+	def merge_counts(activity, other_activity):
+		"""
+		Merge counts for two chunks
+
+		:param dict activity:  Counts
+		:param dict other_activity:  Counts to add
+		:return dict:  Merged counts
+		"""
+		for vocabulary_id, counts in other_activity.items():
+			if vocabulary_id not in activity:
+				activity[vocabulary_id] = Counter()
+
+			activity[vocabulary_id].update(counts)
+
+		return activity
@@ -27,6 +27,8 @@ class HashSimilarityNetworker(BasicProcessor):
     description = "Calculate similarity of hashes and create a GEXF network file."
     extension = "gexf"
 
+    run_in_process = True
+
     options = {
         "descriptor_column": {
             "help": "Column containing ID or unique descriptor (e.g., URL, filename, etc.)",
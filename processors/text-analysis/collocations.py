@@ -1,16 +1,15 @@
 """
 Calculate word collocations from tokens
 """
-import json
-import pickle
-
 from pathlib import Path
 
 import operator
 from nltk.collocations import *
 
 from common.lib.helpers import UserInput
+from common.lib.token_store import TokenReader
 from backend.abstract.processor import BasicProcessor
+from common.lib.exceptions import ProcessorInterruptedException
 
 class GetCollocations(BasicProcessor):
 	"""
@@ -22,6 +21,8 @@ class GetCollocations(BasicProcessor):
 	description = "Extracts words appearing close to each other from a set of tokens."  # description displayed in UI
 	extension = "csv"  # extension of result file, used internally and in UI
 
+	run_in_process = True
+
 	@classmethod
 	def is_compatible_with(cls, module=None):
 		"""
@@ -143,18 +144,13 @@ class GetCollocations(BasicProcessor):
 		results = []
 
 		# Go through all archived token sets and generate collocations for each
-		for token_file in self.iterate_archive_contents(self.source_file):
-			if token_file.name == '.token_metadata.json':
-				# Skip metadata
-				continue
-			# we support both pickle and json dumps of vectors
-			token_unpacker = pickle if token_file.suffix == "pb" else json
-
-			with token_file.open("rb") as binary_tokens:
-				tokens = token_unpacker.load(binary_tokens)
+		token_reader = TokenReader(self.unpack_archive_contents(self.source_file))
+		for interval in token_reader.intervals:
+			if self.interrupted:
+				raise ProcessorInterruptedException("Interrupted while generating collocations")
 
 			# Get the date
-			date_string = token_file.stem
+			date_string = interval
 
 			# Get the collocations. Returns a tuple.
 			self.dataset.update_status("Generating collocations for " + date_string)
@@ -163,7 +159,7 @@ class GetCollocations(BasicProcessor):
 			collocations = []
 
 			# The tokens are separated per posts, so we get collocations per post.
-			for post_tokens in tokens:
+			for post_tokens in token_reader.iterate_documents(interval):
 				post_collocations = self.get_collocations(post_tokens, window_size, n_size, query_string=query_string, forbidden_words=forbidden_words, unique=unique)
 				collocations += post_collocations
 
@@ -100,12 +100,15 @@ class TopicModelWordExtractor(BasicProcessor):
         # Reformat model data
         topics = []
         for token_filename, model_data in model_metadata.items():
+            # models made from older token sets do not record the interval,
+            # but their token files are named after it
+            interval = model_data.get('interval', token_filename.split('.')[0])
             for topic in model_data['model_topics'].values():
                 topics.append({
-                                'topic_interval': token_filename.rstrip('.json'),
+                                'topic_interval': interval,
                                 'topic_number': topic['topic_index'] + 1, # Adding 1 to conform with other processors
                                 'top_five_features': ', '.join([f+': '+str(w) for f,w in topic['top_five_features'].items()]),
-                                'number_of_documents': topics_count[token_filename.rstrip('.json') + str(topic['topic_index'])],
+                                'number_of_documents': topics_count[interval + str(topic['topic_index'])],
                                 })
 
         self.write_csv_items_and_finish(topics)
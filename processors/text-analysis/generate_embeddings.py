@@ -1,18 +1,23 @@
 """
 Generate interval-based word embedding models for sentences
 """
+import multiprocessing
 import shutil
-import pickle
-import json
+import os
+
+from pathlib import Path
 
 from gensim.models import Word2Vec, FastText
 from gensim.models.phrases import Phrases, Phraser
-from pathlib import Path
 
 from common.lib.helpers import UserInput, convert_to_int
+from common.lib.token_store import TokenReader
+from common.lib.parallel import can_spawn_processes
 from backend.abstract.processor import BasicProcessor
 from common.lib.exceptions import ProcessorInterruptedException
 
+import common.config_manager as config
+
 __author__ = "Sal Hagen"
 __credits__ = ["Sal Hagen", "Stijn Peeters", "Tom Willaert"]
 __maintainer__ = "Sal Hagen"
@@ -33,6 +38,8 @@ class GenerateWordEmbeddings(BasicProcessor):
 				  "Note that good models require a lot of data."  # description displayed in UI
 	extension = "zip"  # extension of result file, used internally and in UI
 
+	run_in_process = True
+
 	references = [
 		"Word2Vec: [Mikolov, Tomas, Ilya Sutskever, Kai Chen, Greg Corrado, and Jeffrey Dean. 2013. “Distributed Representations of Words and Phrases and Their Compositionality.” 8Advances in Neural Information Processing Systems*, 2013: 3111-3119.](https://papers.nips.cc/paper/5021-distributed-representations-of-words-and-phrases-and-their-compositionality.pdf)",
 		"Word2Vec: [Mikolov, Tomas, Kai Chen, Greg Corrado, and Jeffrey Dean. 2013. “Efficient Estimation of Word Representations in Vector Space.” *ICLR Workshop Papers*, 2013: 1-12.](https://arxiv.org/pdf/1301.3781.pdf)",
@@ -115,15 +122,20 @@ class GenerateWordEmbeddings(BasicProcessor):
 		"""
 		This takes a 4CAT results file as input, and outputs a number of files containing
 		tokenised posts, grouped per time unit as specified in the parameters.
+
+		Models for the separate intervals of the token set are independent of
+		each other, so they are trained in parallel, in separate processes.
+		Each process first writes the documents of its interval to a plain
+		text corpus file, which gensim's worker threads can then read from
+		disk by themselves, rather than all waiting for one Python generator
+		to yield the next document.
+
+		Corpus files and finished models are kept in a checkpoint folder
+		until all models are done; if the processor is interrupted and runs
+		again later, they do not need to be generated again.
 		"""
 		self.dataset.update_status("Processing sentences")
 
-		use_skipgram = 1 if self.parameters.get("algorithm") == "skipgram" else 0
-		window = min(10, max(1, convert_to_int(self.parameters.get("window"))))
-		use_negative = 5 if self.parameters.get("negative") else 0
-		min_count = max(1, convert_to_int(self.parameters.get("min_count")))
-		dimensionality = convert_to_int(self.parameters.get("dimensionality"), 100)
-		detect_bigrams = self.parameters.get("detect-bigrams")
 		model_type = self.parameters.get("model-type")
 		max_words = convert_to_int(self.parameters.get("max_words"))
 
@@ -131,128 +143,206 @@ class GenerateWordEmbeddings(BasicProcessor):
 			# unlimited amount of words in model
 			max_words = None
 
-		staging_area = self.dataset.get_staging_area()
-		model_builder = {
-			"Word2Vec": Word2Vec,
-			"FastText": FastText
-		}[model_type]
+		settings = {
+			"model_type": model_type,
+			"sg": 1 if self.parameters.get("algorithm") == "skipgram" else 0,
+			"window": min(10, max(1, convert_to_int(self.parameters.get("window")))),
+			"negative": 5 if self.parameters.get("negative") else 0,
+			"min_count": max(1, convert_to_int(self.parameters.get("min_count"))),
+			"vector_size": convert_to_int(self.parameters.get("dimensionality"), 100),
+			"detect_bigrams": bool(self.parameters.get("detect-bigrams")),
+			"max_final_vocab": max_words
+		}
 
-		# go through all archived token sets and vectorise them
+		try:
+			token_reader = TokenReader(self.unpack_archive_contents(self.source_file))
+		except UnicodeDecodeError:
+			self.dataset.update_status(
+				"Error reading input data. If it was imported from outside 4CAT, make sure it is encoded as UTF-8.",
+				is_final=True)
+			self.dataset.finish(0)
+			return
+
+		staging_area = self.dataset.get_staging_area()
+		checkpoint_path = self.get_checkpoint_path("embedding-checkpoint")
+
+		# models trained before the processor was interrupted can be re-used
+		intervals = token_reader.intervals
+		untrained = [interval for interval in intervals if not self.is_trained(checkpoint_path, interval)]
+		finished = len(intervals) - len(untrained)
+
+		# a process is spawned even if there is only one model to train, so
+		# this process remains free to check if the processor is interrupted
+		in_parallel = bool(untrained) and can_spawn_processes()
+		num_processes = max(1, min(convert_to_int(config.get("4cat.parallel_workers"), 4), len(untrained))) if in_parallel else 1
+
+		# the available cores are divided between the models trained at the
+		# same time
+		settings["workers"] = max(1, (os.cpu_count() or 1) // num_processes)
+		tasks = [(str(token_reader.path), interval, str(checkpoint_path), settings) for interval in untrained]
+
+		def update_progress():
+			if self.interrupted:
+				raise ProcessorInterruptedException("Interrupted while training %s models" % model_type)
+
+			self.dataset.update_status("Training %s models (%i/%i done)" % (model_type, finished, len(intervals)))
+			self.dataset.update_progress(finished / len(intervals))
+
+		if in_parallel:
+			with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
+				pending = pool.imap_unordered(self.train_interval, tasks)
+				while True:
+					update_progress()
+					try:
+						pending.next(timeout=1)
+						finished += 1
+					except multiprocessing.TimeoutError:
+						continue
+					except StopIteration:
+						break
+		else:
+			for task in tasks:
+				update_progress()
+				self.train_interval(task)
+				finished += 1
+
+		# intervals without enough data are skipped - if this happens for all
+		# intervals, there is nothing to save
 		models = 0
-		for temp_file in self.iterate_archive_contents(self.source_file):
-			if temp_file.name == '.token_metadata.json':
-				# Skip metadata
+		for interval in intervals:
+			if not checkpoint_path.joinpath("%s.done" % interval).exists():
 				continue
-			# use the "list of lists" as input for the word2vec model
-			# by default the tokeniser generates one list of tokens per
-			# post... which may actually be preferable for short
-			# 4chan-style posts. But alternatively it could generate one
-			# list per sentence - this processor is agnostic in that regard
-			token_set_name = temp_file.name
-			self.dataset.update_status("Extracting bigrams from token set %s..." % token_set_name)
-			self.dataset.update_progress(models / self.source_dataset.num_rows)
-
-			try:
-				if detect_bigrams:
-					bigram_transformer = Phrases(self.tokens_from_file(temp_file, staging_area))
-					bigram_transformer = Phraser(bigram_transformer)
-				else:
-					bigram_transformer = None
-
-				self.dataset.update_status("Training %s model for token set %s..." % (model_builder.__name__, token_set_name))
-				try:
-					model = model_builder(negative=use_negative, vector_size=dimensionality, sg=use_skipgram, window=window, workers=3, min_count=min_count, max_final_vocab=max_words)
-
-					# we do not simply pass a sentences argument to model builder
-					# because we are using a generator, which exhausts, while
-					# Word2Vec needs to iterate over the sentences twice
-					# https://stackoverflow.com/a/57632747
-					model.build_vocab(self.tokens_from_file(temp_file, staging_area, phraser=bigram_transformer))
-					model.train(self.tokens_from_file(temp_file, staging_area, phraser=bigram_transformer), epochs=1, total_examples=model.corpus_count)
-
-				except RuntimeError as e:
-					if "you must first build vocabulary before training the model" in str(e):
-						# not enough data. Skip - if this happens for all models
-						# an error will be generated later
-						continue
-					else:
-						raise e
-
-			except UnicodeDecodeError:
-				self.dataset.update_status(
-					"Error reading input data. If it was imported from outside 4CAT, make sure it is encoded as UTF-8.",
-					is_final=True)
-				self.dataset.finish(0)
-				return
-
-			# save - we only save the KeyedVectors for the model, this
-			# saves space and we don't need to re-train the model later
-			model_name = token_set_name.split(".")[0] + ".model"
-			model.wv.save(str(staging_area.joinpath(model_name)))
-
-			# save vocabulary too, some processors need it
-			del model
+
+			# large arrays are stored in separate files next to the model file
+			for model_file in checkpoint_path.glob("%s.model*" % interval):
+				shutil.move(str(model_file), str(staging_area.joinpath(model_file.name)))
 			models += 1
 
+		shutil.rmtree(checkpoint_path)
+
 		if models == 0:
-			self.dataset.update_status("Not enough data in source file to train %s models." % model_builder.__name__)
+			self.dataset.update_status("Not enough data in source file to train %s models." % model_type)
 			shutil.rmtree(staging_area)
 			self.dataset.finish(0)
 			return
 
 		# create another archive with all model files in it
-		self.dataset.update_status("%s model(s) saved." % model_builder.__name__)
+		self.dataset.update_status("%s model(s) saved." % model_type)
 		self.write_archive_and_finish(staging_area)
 
-	def tokens_from_file(self, file, staging_area, phraser=None):
+	@staticmethod
+	def train_interval(task):
+		"""
+		Train a word embedding model for one interval of a token set
+
+		This runs in a separate process, so it should not rely on the state of
+		the processor. Progress is saved to the checkpoint folder: the corpus
+		file once it has been written, and the model once it has been trained,
+		after which a `<interval>.done` file is created. Intervals with too
+		little data to train a model get a `<interval>.skipped` file instead.
+
+		:param tuple task:  Path of the token set, interval to train a model
+		for, path of the checkpoint folder, and model settings
+		:return str:  The interval
+		"""
+		token_path, interval, checkpoint_path, settings = task
+		token_reader = TokenReader(Path(token_path))
+		checkpoint_path = Path(checkpoint_path)
+		corpus_path = checkpoint_path.joinpath("%s.corpus.txt" % interval)
+
+		# use the "list of lists" as input for the word2vec model
+		# by default the tokeniser generates one list of tokens per
+		# post... which may actually be preferable for short
+		# 4chan-style posts. But alternatively it could generate one
+		# list per sentence - this processor is agnostic in that regard
+		if not corpus_path.exists():
+			if settings["detect_bigrams"]:
+				phraser = Phraser(Phrases(token_reader.iterate_documents(interval)))
+			else:
+				phraser = None
+
+			GenerateWordEmbeddings.write_corpus_file(token_reader, interval, corpus_path, phraser=phraser)
+
+		model_builder = {
+			"Word2Vec": Word2Vec,
+			"FastText": FastText
+		}[settings["model_type"]]
+
+		try:
+			model = model_builder(negative=settings["negative"], vector_size=settings["vector_size"], sg=settings["sg"],
+								  window=settings["window"], workers=settings["workers"], min_count=settings["min_count"],
+								  max_final_vocab=settings["max_final_vocab"])
+			model.build_vocab(corpus_file=str(corpus_path))
+			model.train(corpus_file=str(corpus_path), epochs=1, total_examples=model.corpus_count,
+						total_words=model.corpus_total_words)
+		except RuntimeError as e:
+			if "you must first build vocabulary before training the model" in str(e):
+				# not enough data. Skip - if this happens for all models
+				# an error will be generated later
+				checkpoint_path.joinpath("%s.skipped" % interval).touch()
+				corpus_path.unlink()
+				return interval
+			else:
+				raise e
+
+		# save - we only save the KeyedVectors for the model, this
+		# saves space and we don't need to re-train the model later
+		model.wv.save(str(checkpoint_path.joinpath("%s.model" % interval)))
+		checkpoint_path.joinpath("%s.done" % interval).touch()
+		corpus_path.unlink()
+
+		return interval
+
+	@staticmethod
+	def write_corpus_file(token_reader, interval, corpus_path, phraser=None):
+		"""
+		Write the documents of an interval to a corpus file
+
+		The file has one document per line, with tokens separated by spaces,
+		which is the format gensim expects for its `corpus_file` parameter.
+		It is written to a temporary file first, so a corpus file that exists
+		is always complete.
+
+		:param TokenReader token_reader:  Reader for the token set
+		:param str interval:  Interval to write the documents of
+		:param Path corpus_path:  Path to write the corpus file to
+		:param Phraser phraser:  Optional. If given, each document is passed
+		through the phraser to detect (e.g.) bigrams.
+		"""
+		temporary_path = corpus_path.with_suffix(".tmp")
+		with temporary_path.open("w", encoding="utf-8") as outfile:
+			for document in token_reader.iterate_documents(interval):
+				if phraser:
+					document = phraser[document]
+
+				outfile.write(" ".join(GenerateWordEmbeddings.get_corpus_tokens(document)) + "\n")
+
+		temporary_path.replace(corpus_path)
+
+	@staticmethod
+	def get_corpus_tokens(document):
 		"""
-		Read tokens from token dump
+		Prepare the tokens of a document for a corpus file
+
+		Whitespace separates tokens in the corpus file, so it cannot be part
+		of a token. Whitespace in a token is replaced with underscores, like
+		the phraser joins bigrams; tokens that consist of nothing but
+		whitespace are left out.
 
-		If the tokens were saved as JSON, take advantage of this and return
-		them as a generator, reducing memory usage and allowing interruption.
+		:param list document:  Tokens
+		:return list:  Tokens without whitespace
+		"""
+		return ["_".join(token.split()) for token in document if token.strip()]
 
-		:param Path file:
-		:param Path staging_area:  Path to staging area, so it can be cleaned
-		up when the processor is interrupted
-		:param Phraser phraser:  Optional. If given, the yielded sentence is
-		passed through the phraser to detect (e.g.) bigrams.
-		:return list:  A set of tokens
+	@staticmethod
+	def is_trained(checkpoint_path, interval):
 		"""
+		Check if a model for an interval was trained before
 
-		if file.suffix == "pb":
-			with file.open("rb") as input:
-				return pickle.load(input)
-
-		with file.open("r") as input:
-			input.seek(1)
-			while True:
-				line = input.readline()
-				if line is None:
-					break
-
-				if self.interrupted:
-					shutil.rmtree(staging_area)
-					raise ProcessorInterruptedException("Interrupted while reading tokens")
-
-				if line == "]":
-					# this marks the end of the file
-					return
-
-				try:
-					# the tokeniser dumps the json with one set of tokens per
-					# line, ending with a comma
-					line = line.strip()
-					if line[-1] == ",":
-						line = line[:-1]
-
-					token_set = json.loads(line)
-					if phraser:
-						yield phraser[token_set]
-					else:
-						yield token_set
-				except json.JSONDecodeError:
-					# old-format json dumps are not suitable for the generator
-					# approach
-					input.seek(0)
-					everything = json.load(input)
-					return everything
+		:param Path checkpoint_path:  Checkpoint folder
+		:param str interval:  Interval
+		:return bool:  Whether a model was trained, or found to be impossible
+		to train
+		"""
+		return checkpoint_path.joinpath("%s.done" % interval).exists() or \
+			   checkpoint_path.joinpath("%s.skipped" % interval).exists()
@@ -111,6 +111,11 @@ class TopicModelWordExtractor(BasicProcessor):
         token_metadata_parameters = token_metadata.pop('parameters')
         model_metadata_parameters = model_metadata.pop('parameters')
 
+        # Models are stored per token file; map them to their intervals (models
+        # made from older token sets do not record the interval, but their
+        # token files are named after it)
+        interval_models = {model_data.get('interval', token_file.split('.')[0]): model_data for token_file, model_data in model_metadata.items()}
+
         # Collect column names of matrix
         post_column_names = list(set(['id', 'thread_id', 'timestamp', 'author', 'body'] + self.parameters.get('columns', []) + token_metadata_parameters.get('columns')))
         model_column_names = ['post_id', 'document_id', 'interval', 'top_topic(s)']
@@ -124,7 +129,7 @@ class TopicModelWordExtractor(BasicProcessor):
         # Add topic columns for each interval/model
         for interval in token_metadata_parameters.get('intervals'):
             if self.parameters.get('include_top_features'):
-                model_column_names += [interval + '_topic_' + str(i+1) + '_' + '-'.join([f for f in model_metadata[interval+'.json']['model_topics'][str(i)]['top_five_features']]) for i in range(model_metadata_parameters.get('topics'))]
+                model_column_names += [interval + '_topic_' + str(i+1) + '_' + '-'.join([f for f in interval_models[interval]['model_topics'][str(i)]['top_five_features']]) for i in range(model_metadata_parameters.get('topics'))]
             else:
                 model_column_names += [interval + '_topic_' + str(i+1) for i in range(model_metadata_parameters.get('topics'))]
 
@@ -154,7 +159,7 @@ class TopicModelWordExtractor(BasicProcessor):
                 # Collect relevant topics for the model used on this post
                 # NOTE: adding 1 to the topic numbers to be constent with topic_words processor (and normal people don't start counting with 0)
                 if self.parameters.get('include_top_features'):
-                    related_topic_columns = [interval + '_topic_' + str(i+1) + '_' + '-'.join([f for f in model_metadata[interval+'.json']['model_topics'][str(i)]['top_five_features']]) for i in range(model_metadata_parameters.get('topics'))]
+                    related_topic_columns = [interval + '_topic_' + str(i+1) + '_' + '-'.join([f for f in interval_models[interval]['model_topics'][str(i)]['top_five_features']]) for i in range(model_metadata_parameters.get('topics'))]
                 else:
                     related_topic_columns = [interval + '_topic_' + str(i+1) for i in range(model_metadata_parameters.get('topics'))]
 
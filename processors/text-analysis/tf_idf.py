@@ -1,18 +1,18 @@
 """
 Create a csv with tf-idf ranked terms
 """
-import json
-import pickle
 import numpy as np
 import pandas as pd
+import scipy.sparse
 import itertools
 
 from common.lib.helpers import UserInput, convert_to_int
+from common.lib.token_store import TokenReader
+from common.lib.exceptions import ProcessorInterruptedException
 from backend.abstract.processor import BasicProcessor
 
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, TfidfTransformer
 from gensim.models import TfidfModel
-from gensim import corpora
 
 __author__ = "Sal Hagen"
 __credits__ = ["Sal Hagen"]
@@ -31,6 +31,8 @@ class TfIdf(BasicProcessor):
 	description = "Get the tf-idf values of tokenised text. Works better with more documents (e.g. time-separated)."  # description displayed in UI
 	extension = "csv"  # extension of result file, used internally and in UI
 
+	run_in_process = True
+
 	options = {
 		"library": {
 			"type": UserInput.OPTION_CHOICE,
@@ -118,52 +120,27 @@ class TfIdf(BasicProcessor):
 		smartirs = self.parameters.get("smartirs", "nfc")
 
 		# Get token sets
+		# each token set (i.e. interval) is treated as one document; they are
+		# read from disk one by one while calculating the tf-idf matrix, so
+		# they do not all need to be kept in memory
 		self.dataset.update_status("Processing token sets")
-		tokens = []
-		dates = []
-
-		# Go through all archived token sets and generate collocations for each
-		for token_file in self.iterate_archive_contents(self.source_file):
-			if token_file.name == '.token_metadata.json':
-				# Skip metadata
-				continue
-			# Get the date
-			date_string = token_file.stem
-			dates.append(date_string)
-
-			# we support both pickle and json dumps of vectors
-			token_unpacker = pickle if token_file.suffix == "pb" else json
-
-			try:
-				with token_file.open("rb") as binary_tokens:
-					# these were saved as pickle dumps so we need the binary mode
-					post_tokens = token_unpacker.load(binary_tokens)
-
-					# Flatten the list of list of tokens - we're treating the whole time series as one document.
-					post_tokens = list(itertools.chain.from_iterable(post_tokens))
-
-					# Add to all date's tokens
-					tokens.append(post_tokens)
-
-			except UnicodeDecodeError:
-				self.dataset.update_status("Error reading input data. If it was imported from outside 4CAT, make sure it is encoded as UTF-8.", is_final=True)
-				self.dataset.finish(0)
-				return
+		token_reader = TokenReader(self.unpack_archive_contents(self.source_file))
+		dates = token_reader.intervals
 
 		# Make sure `min_occurrences` and `max_occurrences` are valid
-		if min_occurrences > len(tokens):
-			min_occurrences = len(tokens) - 1
-		if max_occurrences <= 0 or max_occurrences > len(tokens):
-			max_occurrences = len(tokens)
+		if min_occurrences > len(dates):
+			min_occurrences = len(dates) - 1
+		if max_occurrences <= 0 or max_occurrences > len(dates):
+			max_occurrences = len(dates)
 
 		# Get the tf-idf matrix.
 		self.dataset.update_status("Generating tf-idf for token set")
 		try:
 
 			if library == "gensim":
-				results = self.get_tfidf_gensim(tokens, dates, top_n=max_output, smartirs=smartirs)
+				results = self.get_tfidf_gensim(token_reader, dates, top_n=max_output, smartirs=smartirs)
 			elif library == "scikit-learn":
-				results = self.get_tfidf_sklearn(tokens, dates, ngram_range=n_size, min_occurrences=min_occurrences,
+				results = self.get_tfidf_sklearn(token_reader, dates, ngram_range=n_size, min_occurrences=min_occurrences,
 								 max_occurrences=max_occurrences, top_n=max_output)
 			else:
 				self.dataset.update_status("Invalid library.")
@@ -175,16 +152,20 @@ class TfIdf(BasicProcessor):
 				self.dataset.update_status("Writing to csv and finishing")
 				self.write_csv_items_and_finish(results)
 
+		except UnicodeDecodeError:
+			self.dataset.update_status("Error reading input data. If it was imported from outside 4CAT, make sure it is encoded as UTF-8.", is_final=True)
+			self.dataset.finish(0)
+
 		except MemoryError:
 			self.dataset.update_status("Out of memory - dataset too large to run tf-idf analysis.")
 			self.dataset.finish(0)
 
-	def get_tfidf_gensim(self, tokens, dates, top_n=25, smartirs="nfc"):
+	def get_tfidf_gensim(self, token_reader, dates, top_n=25, smartirs="nfc"):
 		"""
 		Creates a csv with the top n highest scoring tf-idf words.
 
-		:param input, list:			List of tokens.
-		:param dates, list:			List of dates.
+		:param token_reader, TokenReader:	Reader for the token sets.
+		:param dates, list:			List of dates (i.e. token set intervals).
 		:param top_n, int:			The amount of top weighted tf-idf terms to return per date.
 		:param smartirs, str:		Parameters for SMART Information Retrieval System.
 
@@ -192,9 +173,19 @@ class TfIdf(BasicProcessor):
 		"""
 
 		# Create a bag of words with words repsented as ints.
+		# The token counts per date are all we need for this, so there is no
+		# need to keep the tokens themselves in memory.
 		self.dataset.update_status("Converting corpus to bag of words")
-		dict_tokens = corpora.Dictionary()
-		corpus = [dict_tokens.doc2bow(doc, allow_update=True) for doc in tokens]
+		token_ids = {}
+		corpus = []
+		for date in dates:
+			if self.interrupted:
+				raise ProcessorInterruptedException("Interrupted while counting tokens")
+
+			token_counts = token_reader.get_token_counts(date)
+			corpus.append(sorted([(token_ids.setdefault(token, len(token_ids)), count) for token, count in token_counts.items()]))
+
+		dict_tokens = list(token_ids)
 
 		# Calculate the tf-idf
 		self.dataset.update_status("Vectorizing")
@@ -228,11 +219,11 @@ class TfIdf(BasicProcessor):
 
 		return results
 
-	def get_tfidf_sklearn(self, tokens, dates, ngram_range=(1, 1), min_occurrences=0, max_occurrences=0, top_n=25):
+	def get_tfidf_sklearn(self, token_reader, dates, ngram_range=(1, 1), min_occurrences=0, max_occurrences=0, top_n=25):
 		"""
 		Creates a csv with the top n highest scoring tf-idf words using sklearn's TfIdfVectoriser.
 
-		:param tokens, list:			List of tokens. Should be unpickled first
+		:param token_reader, TokenReader:	Reader for the token sets.
 		:param dates, list:				List of column names.
 		:param max_occurrences, int:	Filter out words that appear in more than length of token list - max_occurrences.
 		:param min_occurrences, int:	Filter out words that appear in less than min_occurrences.
@@ -244,27 +235,46 @@ class TfIdf(BasicProcessor):
 
 		# Vectorise
 		self.dataset.update_status("Vectorizing")
-		tfidf_vectorizer = TfidfVectorizer(min_df=min_occurrences, max_df=max_occurrences, ngram_range=ngram_range,
-										   analyzer="word", token_pattern=None, tokenizer=lambda i: i, lowercase=False)
-
 		try:
-			tfidf_matrix = tfidf_vectorizer.fit_transform(tokens)
+			if ngram_range == (1, 1):
+				# The token set's document-term matrices already contain the
+				# token counts we need, so there is no need to re-read the
+				# tokens. Each date is one document, so add up the matrix's rows.
+				counts = scipy.sparse.vstack([scipy.sparse.csr_matrix(token_reader.get_matrix(date).sum(axis=0)) for date in dates], format="csr")
+				counts, feature_names = token_reader.get_features(counts, min_df=min_occurrences, max_df=max_occurrences)
+				tfidf_matrix = TfidfTransformer().fit_transform(counts)
+
+			else:
+				tfidf_vectorizer = TfidfVectorizer(min_df=min_occurrences, max_df=max_occurrences, ngram_range=ngram_range,
+												   analyzer="word", token_pattern=None, tokenizer=lambda i: i, lowercase=False)
+
+				def iterate_token_sets():
+					# Flatten the list of list of tokens - we're treating each date's tokens as one document.
+					for date in dates:
+						if self.interrupted:
+							raise ProcessorInterruptedException("Interrupted while vectorizing")
+
+						yield list(itertools.chain.from_iterable(token_reader.iterate_documents(date)))
+
+				tfidf_matrix = tfidf_vectorizer.fit_transform(iterate_token_sets())
+				feature_names = tfidf_vectorizer.get_feature_names_out()
+
 		except ValueError:
 			self.dataset.update_status("No tokens remain with these parameters. Set less strict constraints and try again.", is_final=True)
 			self.dataset.finish(0)
 			return
 
-		feature_array = np.array(tfidf_vectorizer.get_feature_names_out())
+		feature_array = np.array(feature_names)
 		tfidf_sorting = np.argsort(tfidf_matrix.toarray()).flatten()[::-1]
 
 		# Print and store top n highest scoring tf-idf scores
 		top_words = feature_array[tfidf_sorting[:top_n]]
 		weights = np.asarray(tfidf_matrix.mean(axis=0)).ravel().tolist()
-		df_weights = pd.DataFrame({"term": tfidf_vectorizer.get_feature_names_out(), "weight": weights})
+		df_weights = pd.DataFrame({"term": feature_names, "weight": weights})
 		df_weights = df_weights.sort_values(by="weight", ascending=False).head(100)
 
 		self.dataset.update_status("Writing tf-idf vector to csv")
-		df_matrix = pd.DataFrame(tfidf_matrix.toarray(), columns=tfidf_vectorizer.get_feature_names_out())
+		df_matrix = pd.DataFrame(tfidf_matrix.toarray(), columns=feature_names)
 
 		# Turn the dataframe 90 degrees
 		df_matrix = df_matrix.transpose()
@@ -2,18 +2,25 @@
 Tokenize post bodies
 """
 import ahocorasick
+import functools
+import tempfile
 import string
+import shutil
 import jieba
 import json
 import re
 import os
 
+from pathlib import Path
+
 import nltk
 from nltk.stem.snowball import SnowballStemmer
 from nltk.stem import WordNetLemmatizer
 from nltk.tokenize import word_tokenize, TweetTokenizer, sent_tokenize
 
 from common.lib.helpers import UserInput, get_interval_descriptor
+from common.lib.token_store import TokenWriter, TokenReader
+from common.lib.exceptions import ProcessorInterruptedException
 from backend.abstract.processor import BasicProcessor
 
 import common.config_manager as config
@@ -34,6 +41,8 @@ class Tokenise(BasicProcessor):
 				  "tokens per sentence)."  # description displayed in UI
 	extension = "zip"  # extension of result file, used internally and in UI
 
+	run_in_process = True
+
 	references = [
 			"[NLTK tokenizer documentation](https://www.nltk.org/api/nltk.tokenize.html)",
 			"[Different types of tokenizers in NLTK](https://chendianblog.wordpress.com/2016/11/25/different-types-of-tokenizers-in-nltk/)",
@@ -147,250 +156,156 @@ class Tokenise(BasicProcessor):
 		containing tokenised posts, grouped per time unit as specified in the
 		parameters.
 
-		Tokens are stored as a JSON dump per 'output unit'; each output unit
-		corresponds to e.g. a month or year depending on the processor
-		parameters. JSON files are partially encoded 'manually', since we don't
-		want to keep all tokens for a given output unit in memory until it's
-		done, as for large datasets that may exceed memory capacity. Instead,
-		we keep a file handle open while tokenising and write the tokens to
-		that file per tokenised post. Since we simply need to store a list of
-		strings, we can concatenate these lists manually, only using the json
-		export options for the token lists. In other words, files are written
-		as such:
-
-		first, the opening bracket for a list of lists:
-			[
-
-		then, if not the first token in the list, a comma:
-			,
-
-		then for each post, a list of tokens, with json.dumps:
-			["token1","token2"]
-
-		then after all tokens are done for an output unit, a closing bracket:
-			]
-
-		The result is valid JSON, written in chunks.
+		Tokens are stored per 'output unit'; each output unit corresponds to
+		e.g. a month or year depending on the processor parameters. Rather
+		than storing the tokens as JSON, each token is assigned a numeric ID
+		and tokens are stored as arrays of these IDs with a `TokenWriter`, with
+		one vocabulary for all output units that maps the IDs back to tokens.
+		This is a lot more compact, and allows processors that use the tokens
+		to read them without having to keep all of them in memory. Token IDs
+		are written to disk as they are generated, so the tokens for a given
+		output unit do not need to be kept in memory until it's done either.
+
+		Posts are tokenised in parallel: the dataset is split in chunks, which
+		are tokenised in separate processes, each writing its own token set.
+		These are then merged in dataset order, so the result is the same as
+		when the posts would have been tokenised one by one.
 		"""
 		columns = self.parameters.get("columns")
 		if type(columns) is not list:
 			columns = [columns]
 
-		self.dataset.update_status("Building filtering automaton")
-
-		link_regex = re.compile(r"https?://[^\s]+")
-		symbol = re.compile(r"[" + re.escape(string.punctuation) + "’‘“”" + "]")
-		numbers = re.compile(r"\b[0-9]+\b")
-
-		# Twitter tokenizer if indicated
 		language = self.parameters.get("language", "english")
-		if self.parameters.get("tokenizer_type") == "jieba-cut":
-			tokenizer = jieba.cut
-			tokenizer_args = {"cut_all": False}
-		elif self.parameters.get("tokenizer_type") == "jieba-cut-all":
-			tokenizer = jieba.cut
-			tokenizer_args = {"cut_all": True}
-		elif self.parameters.get("tokenizer_type") == "jieba-search":
-			tokenizer = jieba.cut_for_search
-			tokenizer_args = {}
-		else:
-			tokenizer = TweetTokenizer(preserve_case=False).tokenize if self.parameters.get("tokenizer_type") == "twitter" else word_tokenize
-			tokenizer_args = {} if self.parameters.get("tokenizer_type") == "twitter" else {"language": language}
+		grouping = "item" if self.parameters.get("grouping-per", "") == "item" else "sentence"
 
-		# load word filters - words to exclude from tokenisation
-		word_filter = set()
-		for wordlist in self.parameters.get("filter", []):
-			with config.get('PATH_ROOT').joinpath(f"common/assets/wordlists/{wordlist}.txt").open(encoding="utf-8") as input:
-				word_filter = set.union(word_filter, input.read().splitlines())
+		# if told so, first split the post into separate sentences
+		split_sentences = False
+		if grouping == "sentence":
+			if language not in [lang.split('.')[0] for lang in os.listdir(nltk.data.find('tokenizers/punkt')) if
+								'pickle' in lang]:
+				self.dataset.update_status(
+					f"Language {language} not available for sentence tokenizer; grouping by item/post instead.")
+			else:
+				split_sentences = True
+
+		# everything the worker processes need to know to tokenise posts
+		# word lists are passed as paths, since the worker processes cannot
+		# read the configuration
+		settings = json.dumps({
+			"columns": columns,
+			"docs_per": self.parameters.get("docs_per"),
+			"tokenizer_type": self.parameters.get("tokenizer_type"),
+			"language": language,
+			"split_sentences": split_sentences,
+			"stem": self.parameters.get("stem") and language != "other",
+			"lemmatise": self.parameters.get("lemmatise") and language != "other",
+			"only_unique": self.parameters.get("only_unique"),
+			"filter": [str(config.get('PATH_ROOT').joinpath(f"common/assets/wordlists/{wordlist}.txt")) for wordlist in
+					   self.parameters.get("filter", [])],
+			"accept_words": self.parameters.get("accept_words", ""),
+			"reject_words": self.parameters.get("reject_words", "")
+		}, sort_keys=True)
+
+		# prepare staging areas - one for the result, and one for the token
+		# sets of the separate chunks
+		staging_area = self.dataset.get_staging_area()
+		chunk_area = self.dataset.get_staging_area()
 
-		# Extend or limit the word filter with optionally added words
-		# Remove accepted words from filter
-		if self.parameters.get("accept_words"):
-			accept_words = [str(word).strip() for word in self.parameters["accept_words"].split(",")]
-			for accept_word in accept_words:
-				if accept_word in word_filter:
-					word_filter.remove(accept_word)
+		# process posts; only the columns to tokenise and the fields needed to
+		# group posts into documents are read
+		self.dataset.update_status("Processing items")
+		try:
+			chunks = self.source_dataset.map_chunks(functools.partial(self.tokenise_chunk, settings=settings, output_folder=str(chunk_area)), processor=self, columns=columns + [field for field in ("id", "thread_id", "timestamp") if field not in columns])
+		except ValueError as e:
+			self.dataset.update_status(str(e), is_final=True)
+			self.dataset.finish(0)
+			return
 
-		# Add rejected words to filter
-		if self.parameters.get("reject_words"):
-			reject_words = [str(word).strip().lower() for word in self.parameters["reject_words"].split(",")]
-			word_filter.update(reject_words)
+		# Collect metadata
+		# document_numbers lists the indexes for documents found in filename relating to this post/item
+		# It should only have one index if grouped_by is "item", but may have more if grouped_by is "sentence" or multiple columns are provided
+		metadata = {'parameters':{'columns':columns, 'grouped_by':grouping, 'intervals':set()}}
 
-		# Use an Aho-Corasick trie to filter tokens - significantly faster
-		# than a native Python list or matching by regex
-		automaton = ahocorasick.Automaton()
-		for word in word_filter:
-			if word:
-				# the value doesn't matter to us here, we just want to know if
-				# the string occurs
-				automaton.add_word(word, 1)
+		# merge the token sets of the chunks, in order, so documents are
+		# numbered as if all posts were tokenised in one go
+		token_writer = TokenWriter(staging_area)
+		for index, chunk in enumerate(chunks):
+			if self.interrupted:
+				raise ProcessorInterruptedException("Interrupted while merging token sets")
 
-		# initialise pre-processors if needed
-		stemmer = None
-		lemmatizer = None
-		if self.parameters.get("language") != "other":
-			if self.parameters.get("stem"):
-				stemmer = SnowballStemmer(language)
+			self.dataset.update_status("Merging token sets (%i/%i)" % (index + 1, len(chunks)))
+			chunk_path = Path(chunk["path"])
+			first_documents = token_writer.append(TokenReader(chunk_path))
+			shutil.rmtree(chunk_path)
 
-			if self.parameters.get("lemmatise"):
-				lemmatizer = WordNetLemmatizer()
+			for post_id, post_metadata in chunk["metadata"].items():
+				first_document = first_documents.get(post_metadata["interval"], 0)
+				post_metadata["document_numbers"] = [first_document + number for number in post_metadata["document_numbers"]]
+				post_metadata["documents"] = {first_document + number: document for number, document in post_metadata["documents"].items()}
+				metadata['parameters']['intervals'].add(post_metadata["interval"])
+				metadata[post_id] = post_metadata
 
-		# Only keep unique words?
-		only_unique = self.parameters.get("only_unique")
+		self.dataset.update_status("Writing token sets")
+		intervals = token_writer.close()
 
-		# prepare staging area
-		staging_area = self.dataset.get_staging_area()
+		# Save the metadata in our staging area
+		metadata['parameters']['intervals'] = list(metadata['parameters']['intervals'])
+		with staging_area.joinpath(".token_metadata.json").open("w", encoding="utf-8") as outfile:
+			json.dump(metadata, outfile)
 
-		# process posts
-		self.dataset.update_status("Processing items")
-		docs_per = self.parameters.get("docs_per")
-		grouping = "item" if self.parameters.get("grouping-per", "") == "item" else "sentence"
+		# create zip of archive and delete temporary files and folder
+		self.write_archive_and_finish(staging_area, num_items=len(intervals))
 
-		# this is how we'll keep track of the subsets of tokens
-		output_files = {}
-		current_output_path = None
-		output_file_handle = None
+	@staticmethod
+	def tokenise_chunk(posts, settings, output_folder):
+		"""
+		Tokenise a chunk of the dataset
 
-		# dummy function to pass through data (as an alternative to sent_tokenize later)
-		def dummy_function(x, *args, **kwargs):
-			return [x]
+		This runs in a separate process. The tokens are written to a token set
+		of their own, in a new folder in the output folder.
 
-		# if told so, first split the post into separate sentences
-		if grouping == "sentence":
-			if language not in [lang.split('.')[0] for lang in os.listdir(nltk.data.find('tokenizers/punkt')) if
-								'pickle' in lang]:
-				self.dataset.update_status(
-					f"Language {language} not available for sentence tokenizer; grouping by item/post instead.")
-				sentence_method = dummy_function
-			else:
-				sentence_method = sent_tokenize
-		else:
-			sentence_method = dummy_function
+		:param posts:  Iterator of posts in the chunk
+		:param str settings:  JSON-encoded tokeniser settings
+		:param str output_folder:  Folder to write the chunk's token set to
+		:return dict:  The path of the chunk's token set (`path`) and the
+		token metadata for the posts in the chunk (`metadata`), with document
+		numbers relative to the chunk
+		"""
+		tokeniser = get_post_tokeniser(settings)
+		docs_per = tokeniser.settings["docs_per"]
+		multiple_docs_per_post = tokeniser.split_sentences or len(tokeniser.settings["columns"]) > 1
 
-		# Collect metadata
-		metadata = {'parameters':{'columns':columns, 'grouped_by':grouping, 'intervals':set()}}
-		multiple_docs_per_post = True if grouping == 'sentence' or len(columns) > 1 else False
-		processed = 0
-		for post in self.source_dataset.iterate_items(self):
+		chunk_path = Path(tempfile.mkdtemp(prefix="chunk-", dir=output_folder))
+		token_writer = TokenWriter(chunk_path)
+		metadata = {}
+
+		for post in posts:
 			# determine what output unit this post belongs to
 			if docs_per != "thread":
 				try:
 					document_descriptor = get_interval_descriptor(post, docs_per)
 				except ValueError as e:
-					self.dataset.update_status("%s, cannot count items per %s" % (str(e), docs_per), is_final=True)
-					self.dataset.update_status(0)
-					return
+					raise ValueError("%s, cannot count items per %s" % (str(e), docs_per))
 			else:
 				document_descriptor = post["thread_id"] if post["thread_id"] else "undefined"
 
-			# Prep metadata
-			# document_numbers lists the indexes for documents found in filename relating to this post/item
-			# It should only have one index if grouped_by is "item", but may have more if grouped_by is "sentence" or multiple columns are provided
-			metadata['parameters']['intervals'].add(document_descriptor)
 			metadata[post.get('id')] = {
 								'interval': document_descriptor,
-								'filename': document_descriptor + ".json",
+								'filename': TokenWriter.get_token_filename(document_descriptor),
 								'document_numbers': [],
 								'documents': {}, # Only needed if there are more than one document per post/item
 								}
 
-			groupings = []
-			for column in columns:
-				column_value = post.get(column)
-				# Possible to only check ones? Not if column is blank/None for some rows, but not all.
-				if column_value is not None and type(column_value) != str:
-					self.dataset.update_status("Column %s contains non text values and cannot be tokenized" % column, is_final=True)
-					self.dataset.update_status(0)
-					return
-
-				value = [v for v in sentence_method(post[column], language) if v is not None]
-				if value:
-					groupings.extend(value)
-
-			if processed % 500 == 0:
-				self.dataset.update_progress(processed / self.source_dataset.num_rows)
-			processed += 1
-
-			# tokenise...
-			for document in groupings:
-				post_tokens = []
-
-				# clean up text and get tokens from it
-				body = link_regex.sub("", document)
-
-				# Use differing tokenizers depending on the user input
-				tokens = tokenizer(body, **tokenizer_args)
-
-				# stem, lemmatise and save tokens that are not in filter
-				for token in tokens:
-					token = token.lower()
-					token = numbers.sub("", symbol.sub("", token))
-
-					# skip empty and filtered tokens
-					if not token or token in automaton:
-						continue
-
-					if self.parameters["stem"] and stemmer:
-						token = stemmer.stem(token)
-
-					if self.parameters["lemmatise"] and lemmatizer:
-						token = lemmatizer.lemmatize(token)
-
-					# append tokens to the post's token list
-					post_tokens.append(token)
-
-				# write tokens to file
-				# this writes lists of json lists, with the outer list serialised
-				# 'manually' and the token lists serialised by the json library
+			for document in tokeniser.get_documents(post):
+				post_tokens = tokeniser.tokenise(document)
 				if post_tokens:
-
-					# Only keep unique words, if desired
-					if only_unique:
-						post_tokens = list(set(post_tokens))
-
-					output_file = staging_area.joinpath(document_descriptor + ".json")
-					output_path = str(output_file)
-
-					if current_output_path != output_path:
-						self.dataset.update_status("Processing items (%s)" % document_descriptor)
-						if output_file_handle:
-							output_file_handle.close()
-						output_file_handle = output_file.open("a")
-
-						if output_path not in output_files:
-							output_file_handle.write("[")
-							output_files[output_path] = 0
-
-						current_output_path = output_path
-
-					if output_files[current_output_path] > 0:
-						output_file_handle.write(",\n")
-
-					output_file_handle.write(json.dumps(post_tokens))
-					metadata[post.get('id')]['document_numbers'].append(output_files[output_path])
+					document_number = token_writer.add_document(document_descriptor, post_tokens)
+					metadata[post.get('id')]['document_numbers'].append(document_number)
 					if multiple_docs_per_post:
-						metadata[post.get('id')]['documents'][output_files[output_path]] = document
-					output_files[output_path] += 1
-
-		if output_file_handle:
-			output_file_handle.close()
-
-		# close all json lists
-		# we do this now because only here do we know all files have been
-		# fully written - if posts are out of order, the tokeniser may
-		# need to repeatedly switch between various token files
-		for output_path in output_files:
-			with open(output_path, "a") as file_handle:
-				file_handle.write("\n]")
-
-		# Save the metadata in our staging area
-		metadata['parameters']['intervals'] = list(metadata['parameters']['intervals'])
-		with staging_area.joinpath(".token_metadata.json").open("w", encoding="utf-8") as outfile:
-			json.dump(metadata, outfile)
-
-		# create zip of archive and delete temporary files and folder
-		self.write_archive_and_finish(staging_area)
+						metadata[post.get('id')]['documents'][document_number] = document
 
+		token_writer.close()
+		return {"path": str(chunk_path), "metadata": metadata}
 
 	@classmethod
 	def get_options(cls, parent_dataset=None, user=None):
@@ -418,3 +333,167 @@ class Tokenise(BasicProcessor):
 			options["columns"]["default"] = ["body"]
 
 		return options
+
+
+class PostTokeniser:
+	"""
+	Tokenise posts according to the tokeniser settings
+
+	Social media text is highly repetitive, so the same tokens are cleaned up,
+	filtered, stemmed and lemmatised over and over again. The result of that
+	is cached per token, in a bounded cache, so this only needs to be done
+	once for most tokens.
+	"""
+	settings = None
+
+	#: Maximum amount of tokens to cache the normalised form of
+	cache_size = 250000
+
+	def __init__(self, settings):
+		"""
+		Set up tokeniser
+
+		:param dict settings:  Tokeniser settings
+		"""
+		self.settings = settings
+		self.split_sentences = settings["split_sentences"]
+		self.language = settings["language"]
+
+		self.link_regex = re.compile(r"https?://[^\s]+")
+		self.symbol = re.compile(r"[" + re.escape(string.punctuation) + "’‘“”" + "]")
+		self.numbers = re.compile(r"\b[0-9]+\b")
+
+		# Twitter tokenizer if indicated
+		if settings["tokenizer_type"] == "jieba-cut":
+			self.tokenizer = jieba.cut
+			self.tokenizer_args = {"cut_all": False}
+		elif settings["tokenizer_type"] == "jieba-cut-all":
+			self.tokenizer = jieba.cut
+			self.tokenizer_args = {"cut_all": True}
+		elif settings["tokenizer_type"] == "jieba-search":
+			self.tokenizer = jieba.cut_for_search
+			self.tokenizer_args = {}
+		else:
+			self.tokenizer = TweetTokenizer(preserve_case=False).tokenize if settings["tokenizer_type"] == "twitter" else word_tokenize
+			self.tokenizer_args = {} if settings["tokenizer_type"] == "twitter" else {"language": self.language}
+
+		# load word filters - words to exclude from tokenisation
+		word_filter = set()
+		for wordlist in settings["filter"]:
+			with open(wordlist, encoding="utf-8") as input:
+				word_filter = set.union(word_filter, input.read().splitlines())
+
+		# Extend or limit the word filter with optionally added words
+		# Remove accepted words from filter
+		if settings["accept_words"]:
+			accept_words = [str(word).strip() for word in settings["accept_words"].split(",")]
+			for accept_word in accept_words:
+				if accept_word in word_filter:
+					word_filter.remove(accept_word)
+
+		# Add rejected words to filter
+		if settings["reject_words"]:
+			reject_words = [str(word).strip().lower() for word in settings["reject_words"].split(",")]
+			word_filter.update(reject_words)
+
+		# Use an Aho-Corasick trie to filter tokens - significantly faster
+		# than a native Python list or matching by regex
+		self.automaton = ahocorasick.Automaton()
+		for word in word_filter:
+			if word:
+				# the value doesn't matter to us here, we just want to know if
+				# the string occurs
+				self.automaton.add_word(word, 1)
+
+		# initialise pre-processors if needed
+		self.stemmer = SnowballStemmer(self.language) if settings["stem"] else None
+		self.lemmatizer = WordNetLemmatizer() if settings["lemmatise"] else None
+
+		self.normalise = functools.lru_cache(maxsize=self.cache_size)(self.normalise_token)
+
+	def get_documents(self, post):
+		"""
+		Get the texts to tokenise for a post
+
+		:param dict post:  Post
+		:return list:  Texts; one per column, or one per sentence per column
+		"""
+		groupings = []
+		for column in self.settings["columns"]:
+			column_value = post.get(column)
+			# Possible to only check ones? Not if column is blank/None for some rows, but not all.
+			if column_value is not None and type(column_value) != str:
+				raise ValueError("Column %s contains non text values and cannot be tokenized" % column)
+
+			if not column_value:
+				continue
+
+			if self.split_sentences:
+				groupings.extend([v for v in sent_tokenize(column_value, self.language) if v is not None])
+			else:
+				groupings.append(column_value)
+
+		return groupings
+
+	def tokenise(self, document):
+		"""
+		Tokenise a text
+
+		:param str document:  Text to tokenise
+		:return list:  Tokens
+		"""
+		# clean up text and get tokens from it
+		body = self.link_regex.sub("", document)
+
+		# Use differing tokenizers depending on the user input
+		tokens = self.tokenizer(body, **self.tokenizer_args)
+
+		# stem, lemmatise and keep tokens that are not in filter
+		normalise = self.normalise
+		post_tokens = [token for token in map(normalise, tokens) if token]
+
+		# Only keep unique words, if desired
+		if post_tokens and self.settings["only_unique"]:
+			post_tokens = list(set(post_tokens))
+
+		return post_tokens
+
+	def normalise_token(self, token):
+		"""
+		Clean up, filter, stem and lemmatise a token
+
+		Use `normalise()` instead, which caches the result.
+
+		:param str token:  Token as returned by the tokenizer
+		:return str:  Normalised token, or `None` if the token should be
+		skipped
+		"""
+		token = token.lower()
+		token = self.numbers.sub("", self.symbol.sub("", token))
+
+		# skip empty and filtered tokens
+		if not token or token in self.automaton:
+			return None
+
+		if self.stemmer:
+			token = self.stemmer.stem(token)
+
+		if self.lemmatizer:
+			token = self.lemmatizer.lemmatize(token)
+
+		return token
+
+
+@functools.lru_cache(maxsize=1)
+def get_post_tokeniser(settings):
+	"""
+	Get a tokeniser for the given settings
+
+	Setting up a tokeniser (particularly loading the word filters) takes a
+	while, so the tokeniser is kept around for the next chunk tokenised by the
+	same worker process, along with its cached tokens.
+
+	:param str settings:  JSON-encoded tokeniser settings
+	:return PostTokeniser:
+	"""
+	return PostTokeniser(json.loads(settings))
@@ -2,15 +2,20 @@
 Create topic clusters based on datasets
 """
 
-from common.lib.helpers import UserInput
+from common.lib.helpers import UserInput, convert_to_int
 from backend.abstract.processor import BasicProcessor
 from common.lib.exceptions import ProcessorInterruptedException
+from common.lib.token_store import TokenReader
 
 import json, pickle
 import shutil
+import math
+import time
 import numpy as np
 
-from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+import common.config_manager as config
+
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer, TfidfTransformer
 from sklearn.decomposition import LatentDirichletAllocation
 
 __author__ = ["Stijn Peeters"]
@@ -31,6 +36,29 @@ class TopicModeler(BasicProcessor):
                   "which can be used to find clusters of related words."  # description displayed in UI
     extension = "zip"  # extension of result file, used internally and in UI
 
+    run_in_process = True
+
+    # save partially fitted models at most this often, in seconds
+    checkpoint_interval = 60
+
+    config = {
+        "topic-modeller.n_jobs": {
+            "type": UserInput.OPTION_TEXT,
+            "coerce_type": int,
+            "default": 1,
+            "help": "CPU cores per topic model",
+            "tooltip": "Amount of CPU cores to use when fitting a topic model. -1 uses all available cores."
+        },
+        "topic-modeller.batch_size": {
+            "type": UserInput.OPTION_TEXT,
+            "coerce_type": int,
+            "default": 4096,
+            "help": "Topic model mini-batch size",
+            "tooltip": "Amount of items to fit topic models on at a time in online mode, and to predict topics "
+                       "for at a time. Lower values use less memory."
+        }
+    }
+
     options = {
         "vectoriser": {
             "type": UserInput.OPTION_CHOICE,
@@ -65,6 +93,26 @@ class TopicModeler(BasicProcessor):
             "default": 0.8,
             "help": "Maximum document frequency",
             "tooltip": "Tokens are ignored if they  occur in more than this fraction (between 0 and 1) of all tokenised items."
+        },
+        "learning_method": {
+            "type": UserInput.OPTION_CHOICE,
+            "options": {
+                "batch": "Batch (all items at once)",
+                "online": "Online (in mini-batches)"
+            },
+            "default": "batch",
+            "help": "Fitting method",
+            "tooltip": "Online fitting uses less memory, which makes it more suitable for large datasets, and can "
+                       "resume where it left off when interrupted. The resulting topics may differ slightly."
+        },
+        "passes": {
+            "type": UserInput.OPTION_TEXT,
+            "min": 1,
+            "max": 50,
+            "default": 10,
+            "help": "Passes (online fitting only)",
+            "tooltip": "How often to go through all items when fitting in online mode. More passes take longer, "
+                       "but may result in better topics."
         }
     }
 
@@ -86,72 +134,105 @@ class TopicModeler(BasicProcessor):
         """
         Unzips token sets and builds topic models for each one. Model data is
         pickle-dumped for later processing (e.g. visualisation).
+
+        Models are fitted either in batch mode, on all documents at once, or
+        in online mode, on mini-batches of documents, which uses less memory.
+        Each finished model is kept in a checkpoint folder until all models
+        are done; if the processor is interrupted and runs again later, those
+        models do not need to be fitted again. In online mode, the model that
+        is being fitted is regularly saved as well, so fitting it can resume
+        where it left off.
         """
 
         self.dataset.update_status("Processing token sets")
         vectoriser_class = TfidfVectorizer if self.parameters.get("vectoriser") == "tf-idf" else CountVectorizer
         min_df = self.parameters.get("min_df")
         max_df = self.parameters.get("max_df")
+        online = self.parameters.get("learning_method") == "online"
+        passes = max(1, convert_to_int(self.parameters.get("passes"), 10))
+        batch_size = max(1, convert_to_int(config.get("topic-modeller.batch_size", 4096), 4096))
+        n_jobs = convert_to_int(config.get("topic-modeller.n_jobs", 1), 1) or 1
 
         # prepare temporary location for model files
         staging_area = self.dataset.get_staging_area()
+        # partially fitted models cannot be resumed with a different batch size
+        checkpoint_path = self.get_checkpoint_path("topic-model-checkpoint",
+                                                   {"parameters": self.parameters, "batch_size": batch_size})
 
         model_metadata = {'parameters': self.parameters}
-        # go through all archived token sets and vectorise them
-        index = 0
-        for token_file in self.iterate_archive_contents(self.source_file):
-            # Check for and open token metadata file
-            if token_file.name == '.token_metadata.json':
-                # Copy the token metadata into our staging area
-                shutil.copyfile(token_file, staging_area.joinpath(".token_metadata.json"))
-                continue
+        token_reader = TokenReader(self.unpack_archive_contents(self.source_file))
 
-            index += 1
-            self.dataset.update_status("Processing token set %i (%s)" % (index, token_file.stem))
-            self.dataset.update_progress(index / self.source_dataset.num_rows)
+        # Copy the token metadata into our staging area
+        token_metadata = token_reader.path.joinpath(token_reader.metadata_file)
+        if token_metadata.exists():
+            shutil.copyfile(token_metadata, staging_area.joinpath(".token_metadata.json"))
+
+        # go through all archived token sets and vectorise them
+        intervals = token_reader.intervals
+        for index, interval in enumerate(intervals):
+            token_file = token_reader.get_filename(interval)
+            self.dataset.update_status("Processing token set %i (%s)" % (index + 1, interval))
+            self.dataset.update_progress(index / len(intervals))
 
             if self.interrupted:
                 raise ProcessorInterruptedException("Interrupted while topic modeling")
 
-            # temporarily extract file (we cannot use ZipFile.open() as it doesn't support binary modes)
-            with token_file.open("rb") as binary_tokens:
-                tokens = json.load(binary_tokens)
-
-            self.dataset.update_status("Vectorising token set '%s'" % token_file.stem)
-            vectoriser = vectoriser_class(tokenizer=token_helper, lowercase=False, min_df=min_df, max_df=max_df)
+            # modeled before the processor was interrupted?
+            metadata_path = checkpoint_path.joinpath("%s.metadata.json" % interval)
+            if metadata_path.exists():
+                self.dataset.update_status("Token set '%s' was already modeled, re-using model" % interval)
+                with metadata_path.open(encoding="utf-8") as infile:
+                    model_metadata[token_file] = json.load(infile)
+                continue
 
+            self.dataset.update_status("Vectorising token set '%s'" % interval)
             try:
-                vectors = vectoriser.fit_transform(tokens)
+                # the token set's document-term matrix already has the token
+                # counts, so all that is left is selecting the tokens to use
+                vectors, features = token_reader.get_features(token_reader.get_matrix(interval), min_df=min_df, max_df=max_df)
             except ValueError as e:
                 # 'no words left' after pruning, so nothing to model with
                 self.dataset.update_status(str(e), is_final=True)
                 self.dataset.finish(0)
                 return
 
-            features = vectoriser.get_feature_names_out()
+            # the vectoriser is stored so new documents can be vectorised the
+            # same way later, so set it up with the selected tokens (and their
+            # weights, for tf-idf)
+            vectoriser = vectoriser_class(tokenizer=token_helper, lowercase=False, min_df=min_df, max_df=max_df, vocabulary=features)
+            if vectoriser_class is TfidfVectorizer:
+                transformer = TfidfTransformer()
+                vectors = transformer.fit_transform(vectors)
+                vectoriser.idf_ = transformer.idf_
 
-            self.dataset.update_status("Fitting token clusters for token set '%s'" % token_file.stem)
+            self.dataset.update_status("Fitting token clusters for token set '%s'" % interval)
             if self.interrupted:
                 raise ProcessorInterruptedException("Interrupted while fitting LDA model")
 
-            model = LatentDirichletAllocation(n_components=self.parameters.get("topics"), random_state=0)
-            model.fit(vectors)
+            model = LatentDirichletAllocation(n_components=self.parameters.get("topics"), random_state=0, n_jobs=n_jobs,
+                                              learning_method="online" if online else "batch",
+                                              batch_size=batch_size, total_samples=vectors.shape[0])
+            if online:
+                model = self.fit_online(model, vectors, interval, checkpoint_path, passes=passes, batch_size=batch_size,
+                                        progress=(index / len(intervals), 1 / len(intervals)))
+            else:
+                model.fit(vectors)
 
             # store features too, because we need those to later know what
             # tokens the modeled weights correspond to
-            self.dataset.update_status("Storing model for token set '%s'" % token_file.stem)
-            with staging_area.joinpath("%s.features" % token_file.stem).open("wb") as outfile:
+            self.dataset.update_status("Storing model for token set '%s'" % interval)
+            with checkpoint_path.joinpath("%s.features" % interval).open("wb") as outfile:
                 pickle.dump(features, outfile)
 
-            with staging_area.joinpath("%s.model" % token_file.stem).open("wb") as outfile:
+            with checkpoint_path.joinpath("%s.model" % interval).open("wb") as outfile:
                 pickle.dump(model, outfile)
 
             # Storing vectors and vectoriser for LDA visualisation
-            self.dataset.update_status("Storing vectors and vectoriser for token set '%s'" % token_file.stem)
-            with staging_area.joinpath("%s.vectors" % token_file.stem).open("wb") as outfile:
+            self.dataset.update_status("Storing vectors and vectoriser for token set '%s'" % interval)
+            with checkpoint_path.joinpath("%s.vectors" % interval).open("wb") as outfile:
                 pickle.dump(vectors, outfile)
 
-            with staging_area.joinpath("%s.vectoriser" % token_file.stem).open("wb") as outfile:
+            with checkpoint_path.joinpath("%s.vectoriser" % interval).open("wb") as outfile:
                 pickle.dump(vectoriser, outfile)
 
             # Collect Metadata
@@ -164,17 +245,44 @@ class TopicModeler(BasicProcessor):
                                             'topic_index': topic_index,
                                             'top_five_features': top_five_features,
                                             }
-            model_metadata[token_file.name] = {
-                                          'model_file': "%s.model" % token_file.stem,
-                                          'feature_file': "%s.features" % token_file.stem,
-                                          'source_token_file': token_file.name,
+            model_metadata[token_file] = {
+                                          'interval': interval,
+                                          'model_file': "%s.model" % interval,
+                                          'feature_file': "%s.features" % interval,
+                                          'source_token_file': token_file,
                                           'model_topics': model_topics,
                                           }
 
             # Make predictions
             # This could be done in another processor, but we have the model right here
-            predicted_topics = model.transform(vectors)
-            model_metadata[token_file.name]['predictions'] = {i:{topic:unnormalized_distribution for topic, unnormalized_distribution in enumerate(doc_predictions)} for i, doc_predictions in enumerate(predicted_topics)}
+            # Predict per batch, so the predictions for all documents never
+            # need to be in memory as an array at once
+            self.dataset.update_status("Predicting topics for token set '%s'" % interval)
+            predictions = {}
+            for start in range(0, vectors.shape[0], batch_size):
+                predicted_topics = model.transform(vectors[start:start + batch_size])
+                predictions.update({i:{topic:unnormalized_distribution for topic, unnormalized_distribution in enumerate(doc_predictions)} for i, doc_predictions in enumerate(predicted_topics, start=start)})
+            model_metadata[token_file]['predictions'] = predictions
+
+            # this interval is done - note so in the checkpoint folder, and
+            # discard the partially fitted model
+            with checkpoint_path.joinpath("%s.metadata.json.tmp" % interval).open("w", encoding="utf-8") as outfile:
+                json.dump(model_metadata[token_file], outfile)
+            checkpoint_path.joinpath("%s.metadata.json.tmp" % interval).replace(metadata_path)
+
+            partial_model_path = checkpoint_path.joinpath("%s.partial" % interval)
+            if partial_model_path.exists():
+                partial_model_path.unlink()
+
+        # all models are done, so the checkpoint folder only holds the
+        # model files now
+        for interval in intervals:
+            for extension in ("features", "model", "vectors", "vectoriser"):
+                model_file = checkpoint_path.joinpath("%s.%s" % (interval, extension))
+                if model_file.exists():
+                    shutil.move(str(model_file), str(staging_area.joinpath(model_file.name)))
+
+        shutil.rmtree(checkpoint_path)
 
         # Save the model metadata in our staging area
         with staging_area.joinpath(".model_metadata.json").open("w", encoding="utf-8") as outfile:
@@ -183,6 +291,63 @@ class TopicModeler(BasicProcessor):
         self.dataset.update_status("Compressing generated model files")
         self.write_archive_and_finish(staging_area)
 
+    def fit_online(self, model, vectors, interval, checkpoint_path, passes, batch_size, progress):
+        """
+        Fit a topic model in mini-batches
+
+        The model is fitted with one mini-batch of documents at a time, for
+        the given amount of passes over all documents. While fitting, the
+        model is regularly saved to the checkpoint folder, as well as when
+        the processor is interrupted; if a saved model exists, fitting
+        resumes with it.
+
+        :param LatentDirichletAllocation model:  Model to fit
+        :param vectors:  Document-term matrix to fit the model on
+        :param str interval:  Interval of the token set the vectors are for
+        :param Path checkpoint_path:  Checkpoint folder
+        :param int passes:  Amount of passes over all documents
+        :param int batch_size:  Documents per mini-batch
+        :param tuple progress:  Dataset progress at the start of fitting, and
+        the part of the total progress fitting this model represents
+        :return LatentDirichletAllocation:  Fitted model
+        """
+        num_documents = vectors.shape[0]
+        num_batches = max(1, math.ceil(num_documents / batch_size))
+        num_steps = num_batches * passes
+
+        partial_model_path = checkpoint_path.joinpath("%s.partial" % interval)
+        step = 0
+        if partial_model_path.exists():
+            with partial_model_path.open("rb") as infile:
+                model, step = pickle.load(infile)
+            self.dataset.update_status("Resuming fitting token clusters for token set '%s'" % interval)
+
+        def save_model():
+            with partial_model_path.with_suffix(".tmp").open("wb") as outfile:
+                pickle.dump((model, step), outfile)
+            partial_model_path.with_suffix(".tmp").replace(partial_model_path)
+
+        last_saved = time.time()
+        while step < num_steps:
+            if self.interrupted:
+                save_model()
+                raise ProcessorInterruptedException("Interrupted while fitting LDA model")
+
+            start = (step % num_batches) * batch_size
+            model.partial_fit(vectors[start:start + batch_size])
+            step += 1
+
+            self.dataset.update_status("Fitting token clusters for token set '%s' (pass %i/%i, batch %i/%i)" %
+                                       (interval, (step - 1) // num_batches + 1, passes, (step - 1) % num_batches + 1, num_batches))
+            self.dataset.update_progress(progress[0] + progress[1] * (step / num_steps))
+
+            if time.time() - last_saved > self.checkpoint_interval:
+                save_model()
+                last_saved = time.time()
+
+        return model
+
+
 def token_helper(token):
     """
     pickle requires named functions
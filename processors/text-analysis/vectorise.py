@@ -2,10 +2,10 @@
 Transform tokeniser output into vectors
 """
 import json
-import pickle
-import itertools
 
 from backend.abstract.processor import BasicProcessor
+from common.lib.token_store import TokenReader
+from common.lib.exceptions import ProcessorInterruptedException
 
 __author__ = "Stijn Peeters"
 __credits__ = ["Stijn Peeters"]
@@ -44,47 +44,32 @@ class Vectorise(BasicProcessor):
 		vector_paths = []
 
 		# go through all archived token sets and vectorise them
-		index = 0
-		for token_file in self.iterate_archive_contents(self.source_file):
-			if token_file.name == '.token_metadata.json':
-				# Skip metadata
-				continue
-			index += 1
-			vector_set_name = token_file.stem  # we don't need the full path
-			self.dataset.update_status("Processing token set %i (%s)" % (index, vector_set_name))
-			self.dataset.update_progress(index / self.source_dataset.num_rows)
-
-			# we support both pickle and json dumps of vectors
-			token_unpacker = pickle if vector_set_name.split(".")[-1] == "pb" else json
-			write_mode = "wb" if token_unpacker is pickle else "w"
-
-			# temporarily extract file (we cannot use ZipFile.open() as it doesn't support binary modes)
-			with token_file.open("rb") as binary_tokens:
-				# these were saved as pickle dumps so we need the binary mode
-				tokens = token_unpacker.load(binary_tokens)
-
-				# flatten token list first - we don't have to separate per post
-				tokens = list(itertools.chain.from_iterable(tokens))
-
-				# all we need is a pretty straightforward frequency count
-				vectors = {}
-				for token in tokens:
-					if token not in vectors:
-						vectors[token] = 0
-					vectors[token] += 1
-
-				# convert to vector list
-				vectors_list = [[token, vectors[token]] for token in vectors]
-
-				# sort
-				vectors_list = sorted(vectors_list, key=lambda item: item[1], reverse=True)
-
-				# dump the resulting file via pickle
-				vector_path = staging_area.joinpath(vector_set_name)
-				vector_paths.append(vector_path)
-
-				with vector_path.open(write_mode) as output:
-					token_unpacker.dump(vectors_list, output)
+		token_reader = TokenReader(self.unpack_archive_contents(self.source_file))
+		intervals = token_reader.intervals
+		for index, interval in enumerate(intervals):
+			if self.interrupted:
+				raise ProcessorInterruptedException("Interrupted while vectorising tokens")
+
+			vector_set_name = interval
+			self.dataset.update_status("Processing token set %i (%s)" % (index + 1, vector_set_name))
+			self.dataset.update_progress((index + 1) / len(intervals))
+
+			# all we need is a pretty straightforward frequency count, which
+			# follows from the token set's document-term matrix
+			vectors = token_reader.get_token_counts(interval)
+
+			# convert to vector list
+			vectors_list = [[token, vectors[token]] for token in vectors]
+
+			# sort
+			vectors_list = sorted(vectors_list, key=lambda item: item[1], reverse=True)
+
+			# dump the resulting file as json
+			vector_path = staging_area.joinpath(vector_set_name)
+			vector_paths.append(vector_path)
+
+			with vector_path.open("w") as output:
+				json.dump(vectors_list, output)
 
 		# create zip of archive and delete temporary files and folder
 		self.write_archive_and_finish(staging_area)
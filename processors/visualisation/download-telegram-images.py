@@ -13,6 +13,7 @@ import common.config_manager as config
 from backend.abstract.processor import BasicProcessor
 from common.lib.exceptions import ProcessorInterruptedException
 from common.lib.helpers import UserInput
+from common.lib.media_cache import MediaCache
 from common.lib.dataset import DataSet
 
 __author__ = "Stijn Peeters"
@@ -100,8 +101,10 @@ class TelegramImageDownloader(BasicProcessor):
         self.staging_area = self.dataset.get_staging_area()
         self.eventloop = None
         self.metadata = {}
+        self.media_cache = MediaCache()
 
         asyncio.run(self.get_images())
+        self.media_cache.trim()
 
         # finish up
         with self.staging_area.joinpath(".metadata.json").open("w", encoding="utf-8") as outfile:
@@ -150,6 +153,7 @@ class TelegramImageDownloader(BasicProcessor):
         messages_with_photos = {}
         downloadable_types = ("photo",) if not with_thumbnails else ("photo", "video")
         total_media = 0
+        media_done = 1
         self.dataset.update_status("Finding messages with image attachments")
         for message in self.source_dataset.iterate_items(self):
             if self.interrupted:
@@ -158,18 +162,38 @@ class TelegramImageDownloader(BasicProcessor):
             if not message.get("attachment_data") or message.get("attachment_type") not in downloadable_types:
                 continue
 
+            total_media += 1
+
+            # media downloaded for other datasets is cached
+            cached = self.media_cache.get(self.get_message_url(message["chat"], int(message["id"])))
+            if cached:
+                try:
+                    filename = self.media_cache.link_files(cached, self.staging_area)[0]
+                    self.metadata[filename] = {
+                        "filename": filename,
+                        "success": True,
+                        "from_dataset": self.source_dataset.key,
+                        "post_ids": [int(message["id"])]
+                    }
+                    media_done += 1
+                    if amount and total_media >= amount:
+                        break
+
+                    continue
+                except FileNotFoundError:
+                    # removed from the cache in the meantime
+                    pass
+
             if message["chat"] not in messages_with_photos:
                 messages_with_photos[message["chat"]] = []
 
             messages_with_photos[message["chat"]].append(int(message["id"]))
-            total_media += 1
 
             if amount and total_media >= amount:
                 break
 
         # now actually download the images
         # todo: investigate if we can directly instantiate a MessageMediaPhoto instead of fetching messages
-        media_done = 1
         for entity, message_ids in messages_with_photos.items():
             try:
                 async for message in client.iter_messages(entity=entity, ids=message_ids):
@@ -192,6 +216,8 @@ class TelegramImageDownloader(BasicProcessor):
                             await client.download_media(message, str(path), thumb=-1)
                         msg_id = message.id
                         success = True
+                        if path.exists():
+                            self.media_cache.add(self.get_message_url(entity, message.id), [path])
                     except (AttributeError, RuntimeError, ValueError, TypeError) as e:
                         filename = "%s-index-%i" % (entity, media_done)
                         msg_id = str(message.id) if hasattr(message, "id") else "with index %i" % media_done
@@ -210,6 +236,17 @@ class TelegramImageDownloader(BasicProcessor):
                 self.dataset.log("Couldn't retrieve images for %s, it probably does not exist anymore (%s)" % (entity, str(e)))
                 self.flawless = False
 
+    @staticmethod
+    def get_message_url(entity, message_id):
+        """
+        Get URL of a message, to identify its media by in the media cache
+
+        :param str entity:  Channel or group the message was posted in
+        :param int message_id:  Message ID
+        :return str:  URL
+        """
+        return "https://t.me/%s/%i" % (entity, message_id)
+
     @staticmethod
     def cancel_start():
         """
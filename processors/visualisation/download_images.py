@@ -3,12 +3,14 @@ Download images linked in dataset
 """
 import requests
 import binascii
+import tempfile
 import hashlib
 import base64
+import shutil
 import json
-import time
 import re
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from PIL import Image, UnidentifiedImageError
 
@@ -18,6 +20,8 @@ from io import StringIO, BytesIO
 
 import common.config_manager as config
 from common.lib.helpers import UserInput
+from common.lib.throttle import DomainThrottle
+from common.lib.media_cache import MediaCache
 from backend.abstract.processor import BasicProcessor
 from common.lib.exceptions import ProcessorInterruptedException
 
@@ -41,6 +45,26 @@ class ImageDownloader(BasicProcessor):
 				  "is included in the output archive. \n4chan datasets should include the image_md5 column."  # description displayed in UI
 	extension = "zip"  # extension of result file, used internally and in UI
 
+	# limits for requests per domain, as (max simultaneous requests, minimum
+	# seconds between requests); also applies to subdomains
+	domain_limits = {
+		"archive.4plebs.org": (1, 16),  # image search rate limits, empirically verified
+		"boards.fireden.net": (1, 1),
+		"4cdn.org": (4, 0.5),
+		"imgur.com": (4, 0.5),
+		"twimg.com": (8, 0),
+		"redd.it": (8, 0)
+	}
+	default_domain_limit = (4, 0)
+
+	# downloaded images larger than this are kept on disk rather than in
+	# memory until they are saved
+	max_image_memory = 8 * 1024 * 1024
+
+	throttle = None
+	session = None
+	media_cache = None
+
 	options = {
 		"amount": {
 			"type": UserInput.OPTION_TEXT,
@@ -73,6 +97,14 @@ class ImageDownloader(BasicProcessor):
 			"help": "Max images to download",
 			"tooltip": "Only allow downloading up to this many images per batch. Increasing this can easily lead to "
 					   "very long-running processors and large datasets."
+		},
+		"image_downloader.MAX_CONCURRENT_DOWNLOADS": {
+			"type": UserInput.OPTION_TEXT,
+			"coerce_type": int,
+			"default": 8,
+			"help": "Max simultaneous downloads",
+			"tooltip": "Download up to this many images at the same time. Requests to any single site are further "
+					   "limited to avoid overloading it."
 		}
 	}
 
@@ -257,90 +289,71 @@ class ImageDownloader(BasicProcessor):
 		else:
 			self.dataset.log('Collected %i image urls.' % len(urls))
 
-		# next, loop through images and download them - until we have as many images
-		# as required. Note that images that cannot be downloaded or parsed do
-		# not count towards that limit
+		# next, download images - until we have as many images as required.
+		# Note that images that cannot be downloaded or parsed do not count
+		# towards that limit. Downloads run in parallel, but never more than
+		# could still be needed to reach the limit
+		max_concurrent = max(1, int(config.get('image_downloader.MAX_CONCURRENT_DOWNLOADS', 8)))
+		self.media_cache = MediaCache()
+		self.throttle = DomainThrottle(self.domain_limits, self.default_domain_limit, lambda: bool(self.interrupted))
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_concurrent)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+
 		downloaded_images = 0
-		processed_urls = 0
 		failures = []
-		for url in urls:
-			if downloaded_images >= amount:
-				break
-
-			# stop processing if worker has been asked to stop
-			if self.interrupted:
-				raise ProcessorInterruptedException("Interrupted while downloading images.")
-
-			processed_urls += 1
-			self.dataset.update_status("Downloaded %i/%i images; downloading from %s" %
-									   (downloaded_images, amount, url))
-			self.dataset.update_progress(downloaded_images / amount)
-
-			try:
-				# acquire image
-				if not url.lower().startswith("http"):
-					# This will open filenames (e.g. locally stored images)
-					# Note possibly open other things (e.g. ftp?)
-					picture = Image.open(url)
-					if isinstance(url, Path):
-						image_filename = Path(url).name
-					else:
-						image_filename = url.split("/")[-1].split("?")[0]
-				else:
-					image, image_filename = self.get_image(url)
-
-					try:
-						picture = Image.open(image)
-					except UnidentifiedImageError:
-						picture = Image.open(image.raw)
-
-			except FileNotFoundError as e:
-				# get_image raises FileNotFoundError for many reasons
-				failures.append(url)
-				continue
-
-			except (UnidentifiedImageError, AttributeError, TypeError) as e:
-				self.dataset.log('ERROR: Downloading image %s: %s' % (url, str(e)))
-				failures.append(url)
-				continue
-
-			# save the image...? avoid overwriting images by appending
-			# -[number] to filenames if they already exist
-			index = 0
-			if not image_filename:
-				image_filename = 'image'
-			image_filename = Path(image_filename).name[:100]  # no folder shenanigans
-			image_stem = Path(image_filename).stem
-			image_suffix = Path(image_filename).suffix.lower()
-			if not image_suffix or image_suffix not in (".png", ".gif", ".jpeg", ".jpg"):
-				# default to PNG
-				image_suffix = ".png"
-
-			save_location = results_path.joinpath(image_filename).with_suffix(image_suffix)
-			while save_location.exists():
-				save_location = results_path.joinpath(image_stem + "-" + str(index) + image_suffix)
-				index += 1
-
-			url_file_map[url] = save_location.name
-			file_url_map[save_location.name] = url
+		url_queue = iter(urls)
+		pending = {}
+		with ThreadPoolExecutor(max_workers=max_concurrent) as pool:
 			try:
-				picture.save(str(save_location))
-				# Counting is important
-				downloaded_images += 1
-			except OSError as e:
-				# some images may need to be converted to RGB to be saved
-				self.dataset.log('ERROR: OSError when saving image %s: %s' % (save_location, e))
-				try:
-					picture = picture.convert('RGB')
-					picture.save(str(results_path.joinpath(image_stem + '.png')))
-				except OSError as e:
-					self.dataset.log(f"Error '{e}' saving image for {url}, skipping")
-					failures.append(url)
-					continue
-			except ValueError as e:
-				self.dataset.log(f"Error '{e}' saving image for {url}, skipping")
-				failures.append(url)
-				continue
+				while True:
+					while len(pending) < max_concurrent and downloaded_images + len(pending) < amount:
+						url = next(url_queue, None)
+						if url is None:
+							break
+						pending[pool.submit(self.get_picture, url)] = url
+
+					if not pending:
+						break
+
+					done = wait(pending, timeout=1, return_when=FIRST_COMPLETED)[0]
+
+					# stop processing if worker has been asked to stop
+					if self.interrupted:
+						raise ProcessorInterruptedException("Interrupted while downloading images.")
+
+					for future in done:
+						url = pending.pop(future)
+						try:
+							picture, image_filename = future.result()
+
+						except FileNotFoundError as e:
+							# get_image raises FileNotFoundError for many reasons
+							failures.append(url)
+							continue
+
+						except (UnidentifiedImageError, AttributeError, TypeError) as e:
+							self.dataset.log('ERROR: Downloading image %s: %s' % (url, str(e)))
+							failures.append(url)
+							continue
+
+						if self.save_picture(picture, image_filename, url, results_path, url_file_map, file_url_map):
+							# Counting is important
+							downloaded_images += 1
+						else:
+							failures.append(url)
+
+						self.dataset.update_status("Downloaded %i/%i images" % (downloaded_images, amount))
+						self.dataset.update_progress(downloaded_images / amount)
+			finally:
+				# don't start downloads that are no longer needed; the ones
+				# in progress will stop at the next throttle check
+				for future in pending:
+					future.cancel()
+				self.session.close()
+
+		self.media_cache.trim()
 
 		# save some metadata to be able to connect the images to their source
 		# posts again later
@@ -360,6 +373,95 @@ class ImageDownloader(BasicProcessor):
 		self.dataset.update_status("Compressing images")
 		self.write_archive_and_finish(results_path)
 
+	def get_picture(self, url):
+		"""
+		Get image from a URL or local path
+
+		Called from the download thread pool in `process()`, which logs the
+		outcome and saves the picture once this returns.
+
+		:param str url:  Path to image, either a local path or a URL
+		:return tuple:  Image object and file name for the image
+		"""
+		if not url.lower().startswith("http"):
+			# This will open filenames (e.g. locally stored images)
+			# Note possibly open other things (e.g. ftp?)
+			picture = Image.open(url)
+			if isinstance(url, Path):
+				image_filename = Path(url).name
+			else:
+				image_filename = url.split("/")[-1].split("?")[0]
+		else:
+			# images downloaded before, for any dataset, are cached
+			cached = self.media_cache.get(url)
+			picture = None
+			if cached:
+				try:
+					picture, image_filename = Image.open(cached["files"][0]["path"]), cached["files"][0]["filename"]
+				except FileNotFoundError:
+					# removed from the cache in the meantime
+					pass
+
+			if not picture:
+				image, image_filename = self.get_image(url)
+				self.media_cache.add(url, [(image, image_filename or "image")])
+
+				try:
+					picture = Image.open(image)
+				except UnidentifiedImageError:
+					picture = Image.open(image.raw)
+
+		return picture, image_filename
+
+	def save_picture(self, picture, image_filename, url, results_path, url_file_map, file_url_map):
+		"""
+		Save a downloaded image to the staging area
+
+		Avoids overwriting images by appending -[number] to file names if they
+		already exist.
+
+		:param Image picture:  Image to save
+		:param str image_filename:  Original file name of image
+		:param str url:  URL the image was downloaded from
+		:param Path results_path:  Staging area to save image in
+		:param dict url_file_map:  Mapping of URLs to saved file names, updated
+		:param dict file_url_map:  Mapping of saved file names to URLs, updated
+		:return bool:  Whether the image was saved
+		"""
+		index = 0
+		if not image_filename:
+			image_filename = 'image'
+		image_filename = Path(image_filename).name[:100]  # no folder shenanigans
+		image_stem = Path(image_filename).stem
+		image_suffix = Path(image_filename).suffix.lower()
+		if not image_suffix or image_suffix not in (".png", ".gif", ".jpeg", ".jpg"):
+			# default to PNG
+			image_suffix = ".png"
+
+		save_location = results_path.joinpath(image_filename).with_suffix(image_suffix)
+		while save_location.exists():
+			save_location = results_path.joinpath(image_stem + "-" + str(index) + image_suffix)
+			index += 1
+
+		url_file_map[url] = save_location.name
+		file_url_map[save_location.name] = url
+		try:
+			picture.save(str(save_location))
+		except OSError as e:
+			# some images may need to be converted to RGB to be saved
+			self.dataset.log('ERROR: OSError when saving image %s: %s' % (save_location, e))
+			try:
+				picture = picture.convert('RGB')
+				picture.save(str(results_path.joinpath(image_stem + '.png')))
+			except OSError as e:
+				self.dataset.log(f"Error '{e}' saving image for {url}, skipping")
+				return False
+		except ValueError as e:
+			self.dataset.log(f"Error '{e}' saving image for {url}, skipping")
+			return False
+
+		return True
+
 	def get_image(self, url):
 		"""
 		Get image from a generic URL.
@@ -448,7 +550,7 @@ class ImageDownloader(BasicProcessor):
 			# Check if we succeeded; content type should be an image
 			if image.status_code != 200 or image.headers.get("content-type", "")[:5] != "image":
 				raise FileNotFoundError()
-			image = BytesIO(image.content)
+			image = image.file
 			image_name = image_url.split("/")[-1].split("?")[0]
 		else:
 			raise FileNotFoundError()
@@ -469,7 +571,6 @@ class ImageDownloader(BasicProcessor):
 		:return str:	string with the filename of the image
 		"""
 		rate_regex = re.compile(r"Search limit exceeded. Please wait ([0-9]+) seconds before attempting again.")
-		rate_limit = 1 if "fireden.net" in url else 16  # empirically verified
 
 		# get link to image from external HTML search results
 		# detect rate limiting and wait until we're good to go again
@@ -478,8 +579,9 @@ class ImageDownloader(BasicProcessor):
 		rate_limited = rate_regex.search(page.text)
 
 		while rate_limited:
+			# postpone other requests to the same source too
 			self.log.debug("Rate-limited by external source. Waiting %s seconds." % rate_limited[1])
-			time.sleep(int(rate_limited[1]))
+			self.throttle.defer(url, int(rate_limited[1]))
 			page = self.request_get_w_error_handling(url, headers=headers)
 			rate_limited = rate_regex.search(page.content.decode("utf-8"))
 
@@ -528,47 +630,67 @@ class ImageDownloader(BasicProcessor):
 			# in which case we can't re-generate the hash
 			raise FileNotFoundError()
 
-		# avoid getting rate-limited by image source
-		time.sleep(rate_limit)
-
 		# cache the image for later, if configured so
 		if config.get('PATH_IMAGES'):
 			local_path = Path(config.get('PATH_IMAGES'), md5.hexdigest() + "." + extension)
 			with open(local_path, 'wb') as outfile:
-				for chunk in image.iter_content(1024):
-					outfile.write(chunk)
+				shutil.copyfileobj(image.file, outfile)
 
 			with open(local_path, 'rb') as infile:
 				return BytesIO(infile.read()), file_name
 		else:
-			return BytesIO(image.content), file_name
+			return image.file, file_name
 
 	def request_get_w_error_handling(self, url, retries=0, **kwargs):
 		"""
 		Try requests.get() and raise FileNotFoundError while logging actual
 		error in dataset.log().
 
-		Retries ConnectionError three times
+		Requests wait for the throttle for the URL's domain (see
+		`domain_limits`). Retries ConnectionError three times, and responses
+		that indicate the host is overloaded, with increasing delays.
+
+		If `stream` is set, the body of successful responses is read into a
+		temporary file, which is available as the `file` attribute of the
+		returned response; large files are then not kept in memory.
 		"""
-		try:
-			response = requests.get(url, **kwargs)
-		except requests.exceptions.Timeout as e:
-			self.dataset.log("Error: Timeout while trying to download image %s: %s" % (url, e))
-			raise FileNotFoundError()
-		except requests.exceptions.SSLError as e:
-			self.dataset.log("Error: SSLError while trying to download image %s: %s" % (url, e))
-			raise FileNotFoundError()
-		except requests.exceptions.TooManyRedirects as e:
-			self.dataset.log("Error: TooManyRedirects while trying to download image %s: %s" % (url, e))
-			raise FileNotFoundError()
-		except requests.exceptions.ConnectionError as e:
-			if retries < 3:
-				response = self.request_get_w_error_handling(url, retries + 1, **kwargs)
-			else:
-				self.dataset.log("Error: ConnectionError while trying to download image %s: %s" % (url, e))
+		while True:
+			try:
+				with self.throttle.request(url):
+					response = self.session.get(url, **kwargs)
+					response.file = None
+					if kwargs.get("stream") and response.status_code == 200:
+						response.file = tempfile.SpooledTemporaryFile(max_size=self.max_image_memory)
+						for chunk in response.iter_content(65536):
+							response.file.write(chunk)
+						response.file.seek(0)
+						response.close()
+			except requests.exceptions.Timeout as e:
+				self.dataset.log("Error: Timeout while trying to download image %s: %s" % (url, e))
 				raise FileNotFoundError()
-		except requests.exceptions.InvalidSchema:
-			# not an http url, just skip
-			raise FileNotFoundError()
+			except requests.exceptions.SSLError as e:
+				self.dataset.log("Error: SSLError while trying to download image %s: %s" % (url, e))
+				raise FileNotFoundError()
+			except requests.exceptions.TooManyRedirects as e:
+				self.dataset.log("Error: TooManyRedirects while trying to download image %s: %s" % (url, e))
+				raise FileNotFoundError()
+			except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+				if retries < 3:
+					retries += 1
+					self.throttle.sleep(2 ** retries)
+					continue
+				else:
+					self.dataset.log("Error: ConnectionError while trying to download image %s: %s" % (url, e))
+					raise FileNotFoundError()
+			except requests.exceptions.InvalidSchema:
+				# not an http url, just skip
+				raise FileNotFoundError()
+
+			if response.status_code in (429, 503) and retries < 3:
+				# back off, for all requests to this host
+				retries += 1
+				retry_after = response.headers.get("Retry-After", "")
+				self.throttle.defer(url, min(int(retry_after), 60) if retry_after.isdigit() else 2 ** retries)
+				continue
 
-		return response
+			return response
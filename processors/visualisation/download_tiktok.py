@@ -12,6 +12,7 @@ import requests
 
 import common.config_manager as config
 from common.lib.exceptions import ProcessorInterruptedException
+from common.lib.media_cache import MediaCache
 from common.lib.user_input import UserInput
 from datasources.tiktok_urls.search_tiktok_urls import TikTokScraper
 from backend.abstract.processor import BasicProcessor
@@ -92,19 +93,58 @@ class TikTokVideoDownloader(BasicProcessor):
         results_path = self.dataset.get_staging_area()
 
         self.dataset.update_status("Downloading TikTok media")
+        media_cache = MediaCache()
         video_ids_to_download = []
+        results = {}
         for original_item, mapped_item in self.source_dataset.iterate_mapped_items(self):
-            video_ids_to_download.append(mapped_item.get("id"))
+            # videos downloaded for other datasets are cached; download URLs
+            # expire, so they are cached by their (stable) embed URL
+            video_id = mapped_item.get("id")
+            cached = media_cache.get(self.get_cache_url(video_id)) if len(results) < max_amount else None
+            if cached:
+                try:
+                    filenames = media_cache.link_files(cached, results_path)
+                    results[video_id] = {
+                        **cached["metadata"],
+                        "from_dataset": self.source_dataset.key,
+                        "files": [{"filename": filename, "success": True} for filename in filenames]
+                    }
+                    continue
+                except FileNotFoundError:
+                    # removed from the cache in the meantime
+                    pass
+
+            video_ids_to_download.append(video_id)
+
+        if len(results) < max_amount:
+            tiktok_scraper = TikTokScraper()
+            loop = asyncio.new_event_loop()
+            downloaded = loop.run_until_complete(tiktok_scraper.download_videos(video_ids_to_download, results_path, max_amount - len(results), processor=self))
+
+            for video_id, metadata in downloaded.items():
+                if metadata.get("success"):
+                    media_cache.add(self.get_cache_url(video_id), [results_path.joinpath(file["filename"]) for file in metadata["files"]],
+                                    metadata={key: value for key, value in metadata.items() if key not in ("files", "from_dataset")})
+
+            results.update(downloaded)
 
-        tiktok_scraper = TikTokScraper()
-        loop = asyncio.new_event_loop()
-        results = loop.run_until_complete(tiktok_scraper.download_videos(video_ids_to_download, results_path, max_amount, processor=self))
+        media_cache.trim()
 
         with results_path.joinpath(".metadata.json").open("w", encoding="utf-8") as outfile:
             json.dump(results, outfile)
 
         self.write_archive_and_finish(results_path, len(results))
 
+    @staticmethod
+    def get_cache_url(video_id):
+        """
+        Get URL to identify a video by in the media cache
+
+        :param str video_id:  TikTok video ID
+        :return str:  URL
+        """
+        return f"https://www.tiktok.com/embed/v2/{video_id}"
+
     @staticmethod
     def map_metadata(video_id, data):
         """
@@ -208,6 +248,7 @@ class TikTokImageDownloader(BasicProcessor):
         results_path = self.dataset.get_staging_area()
 
         self.dataset.update_status("Downloading TikTok media")
+        self.media_cache = MediaCache()
         downloaded_media = 0
         urls_to_refresh = []
         url_to_item_id = {}
@@ -232,8 +273,9 @@ class TikTokImageDownloader(BasicProcessor):
                 refresh_tiktok_urls = False
 
                 # Check if URL missing or expired
+                # (unless it was cached when it was still valid)
                 now = int(datetime.datetime.now(tz=datetime.timezone.utc).timestamp())
-                if not url or int(parse_qs(urlparse(url).query).get("x-expires", [now])[0]) < now:
+                if not url or (int(parse_qs(urlparse(url).query).get("x-expires", [now])[0]) < now and not self.media_cache.get(url)):
                     refresh_tiktok_urls = True
                 else:
                     # Collect image
@@ -325,6 +367,7 @@ class TikTokImageDownloader(BasicProcessor):
         with results_path.joinpath(".metadata.json").open("w", encoding="utf-8") as outfile:
             json.dump(metadata, outfile)
 
+        self.media_cache.trim()
         self.write_archive_and_finish(results_path, downloaded_media)
 
     @staticmethod
@@ -352,12 +395,22 @@ class TikTokImageDownloader(BasicProcessor):
         except ValueError:
             return False, ''
 
-    @staticmethod
-    def collect_image(url, user_agent="Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.1.1 Safari/605.1.15"):
+    def collect_image(self, url, user_agent="Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.1.1 Safari/605.1.15"):
         """
+        Images are taken from the media cache if they were downloaded before,
+        and added to it otherwise.
+
         :param str url:         String with a validated URL
         :param str user_agent:  String with the desired user agent to be sent as a header
         """
+        cached = self.media_cache.get(url)
+        if cached:
+            try:
+                return Image.open(cached["files"][0]["path"]), cached["files"][0]["filename"].split(".")[-1]
+            except FileNotFoundError:
+                # removed from the cache in the meantime
+                pass
+
         try:
             response = requests.get(url, stream=True, timeout=20, headers={"User-Agent": user_agent})
         except requests.exceptions.RequestException as e:
@@ -366,14 +419,15 @@ class TikTokImageDownloader(BasicProcessor):
         if response.status_code != 200 or "image" not in response.headers.get("content-type", ""):
             raise FileNotFoundError(f"Unable to download image; status_code:{response.status_code} content-type:{response.headers.get('content-type', '')}")
 
+        # Grab extension from response
+        extension = response.headers["Content-Type"].split("/")[-1]
+
         # Process images
         image_io = BytesIO(response.content)
+        self.media_cache.add(url, [(image_io, "image." + extension)])
         try:
             picture = Image.open(image_io)
         except UnidentifiedImageError:
             picture = Image.open(image_io.raw)
 
-        # Grab extension from response
-        extension = response.headers["Content-Type"].split("/")[-1]
-
         return picture, extension
@@ -3,10 +3,14 @@ Download videos
 
 First attempt to download via request, but if that fails use yt-dlp
 """
+import threading
+import subprocess
+import shutil
 import json
 import re
-import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from pathlib import Path
 import requests
 import yt_dlp
@@ -18,6 +22,8 @@ import common.config_manager as config
 from backend.abstract.processor import BasicProcessor
 from common.lib.dataset import DataSet
 from common.lib.exceptions import ProcessorInterruptedException, ProcessorException
+from common.lib.media_cache import MediaCache
+from common.lib.throttle import DomainThrottle
 from common.lib.helpers import UserInput, sets_to_lists
 
 __author__ = "Dale Wahl"
@@ -61,6 +67,19 @@ class VideoDownloaderPlus(BasicProcessor):
 
     known_channels = ['youtube.com/c/', 'youtube.com/channel/']
 
+    # limits for requests per domain, as (max simultaneous requests, minimum
+    # seconds between requests); also applies to subdomains
+    domain_limits = {
+        "tiktok.com": (2, 1),
+        "youtube.com": (2, 1),
+        "instagram.com": (1, 2),
+        "twimg.com": (4, 0)
+    }
+    default_domain_limit = (4, 0)
+
+    # amount of downloaded videos to probe with ffprobe at the same time
+    max_probes = 2
+
     options = {
         "amount": {
             "type": UserInput.OPTION_TEXT,
@@ -136,17 +155,37 @@ class VideoDownloaderPlus(BasicProcessor):
             "tooltip": "Allow users to choose to download videos from links that refer to multiple videos. For "
                        "example, for a given link to a YouTube channel all videos for that channel are downloaded."
         },
+        "video_downloader.max-concurrent-direct": {
+            "type": UserInput.OPTION_TEXT,
+            "coerce_type": int,
+            "default": 4,
+            "help": "Max simultaneous direct downloads",
+            "tooltip": "Download up to this many directly linked videos at the same time, per dataset. Requests to "
+                       "any single site are further limited to avoid overloading it."
+        },
+        "video_downloader.max-concurrent-yt-dlp": {
+            "type": UserInput.OPTION_TEXT,
+            "coerce_type": int,
+            "default": 2,
+            "help": "Max simultaneous yt-dlp downloads",
+            "tooltip": "Download up to this many videos via yt-dlp at the same time, per dataset. Only relevant if "
+                       "indirect downloads are allowed."
+        },
     }
 
     def __init__(self, logger, job, queue=None, manager=None, modules=None):
         super().__init__(logger, job, queue, manager, modules)
         self.max_videos_per_url = 1
-        self.videos_downloaded_from_url = 0
+        self.max_video_size = 100
+        self.use_yt_dlp = False
+        self.ydl_opts = {}
         self.downloaded_videos = 0
         self.total_possible_videos = 5
-        self.url_files = None
-        self.last_dl_status = None
-        self.last_post_process_status = None
+        self.direct_slots = None
+        self.yt_dlp_slots = None
+        self.throttle = None
+        self.filename_lock = None
+        self.yt_dlp_archive_map = {}
 
     @classmethod
     def get_options(cls, parent_dataset=None, user=None):
@@ -240,6 +279,12 @@ class VideoDownloaderPlus(BasicProcessor):
         """
         This takes a 4CAT results file as input, and downloads video files
         referenced therein according to the processor parameters.
+
+        Videos are downloaded concurrently. Direct downloads and downloads via
+        yt-dlp are limited separately, and requests to any single site are
+        further limited per domain (see `domain_limits`). Downloaded videos are
+        probed with ffprobe, if available, while other videos are still being
+        downloaded.
         """
         # Check processor able to run
         if self.source_dataset.num_rows == 0:
@@ -258,6 +303,7 @@ class VideoDownloaderPlus(BasicProcessor):
         self.dataset.log('Collected %i urls.' % len(urls))
 
         vid_lib = DatasetVideoLibrary(self.dataset)
+        media_cache = MediaCache()
 
         # Prepare staging area for videos and video tracking
         results_path = self.dataset.get_staging_area()
@@ -273,10 +319,11 @@ class VideoDownloaderPlus(BasicProcessor):
                 raise LiveVideoException("4CAT settings do not allow downloading live videos with this processor")
 
         # Use YT-DLP
-        use_yt_dlp = self.parameters.get("use_yt_dlp", False)
+        self.use_yt_dlp = self.parameters.get("use_yt_dlp", False)
 
         # Set up YT-DLP options
-        ydl_opts = {
+        # Hooks and output file names are added per download, see download_with_yt_dlp()
+        self.ydl_opts = {
             # "logger": self.log,  # This will dump any errors to our logger if desired
             "socket_timeout": 20,
             # TODO: if yt-dlp archive is used, it raises an error, but does not contain the archive info; how to then
@@ -284,9 +331,6 @@ class VideoDownloaderPlus(BasicProcessor):
             #  download=False can get the `info` but need to then use that info to tie to the filename!
             "download_archive": str(results_path.joinpath("video_archive")),
             "break_on_existing": True,
-            "postprocessor_hooks": [self.yt_dlp_post_monitor],
-            # This function ensures no more than self.max_videos_per_url downloaded and can be used to monitor progress
-            "progress_hooks": [self.yt_dlp_monitor],
             'match_filter': dmi_match_filter,
         }
 
@@ -307,21 +351,32 @@ class VideoDownloaderPlus(BasicProcessor):
 
         # YT-DLP by default attempts to download the best quality videos
         allow_unknown_sizes = config.get('video_downloader.DOWNLOAD_UNKNOWN_SIZE', False)
-        max_video_size = self.parameters.get("max_video_size", 100)
-        max_size = str(max_video_size) + "M"
-        if not max_video_size == 0:
+        self.max_video_size = self.parameters.get("max_video_size", 100)
+        max_size = str(self.max_video_size) + "M"
+        if not self.max_video_size == 0:
             if allow_unknown_sizes:
-                ydl_opts["format"] = f"[filesize<?{max_size}]/[filesize_approx<?{max_size}]"
+                self.ydl_opts["format"] = f"[filesize<?{max_size}]/[filesize_approx<?{max_size}]"
             else:
-                ydl_opts["format"] = f"[filesize<{max_size}]/[filesize_approx<{max_size}]"
-
-        # Loop through video URLs and download
+                self.ydl_opts["format"] = f"[filesize<{max_size}]/[filesize_approx<{max_size}]"
+
+        # Set up concurrent downloads
+        max_direct = max(1, int(config.get("video_downloader.max-concurrent-direct", 4)))
+        max_yt_dlp = max(1, int(config.get("video_downloader.max-concurrent-yt-dlp", 2)))
+        max_downloads = max_direct + max_yt_dlp if self.use_yt_dlp else max_direct
+        self.direct_slots = threading.BoundedSemaphore(max_direct)
+        self.yt_dlp_slots = threading.BoundedSemaphore(max_yt_dlp)
+        self.throttle = DomainThrottle(self.domain_limits, self.default_domain_limit, lambda: bool(self.interrupted))
+        self.filename_lock = threading.Lock()
+        self.yt_dlp_archive_map = {}
+        ffprobe = self.get_ffprobe_path()
+
+        # First, loop through video URLs to see which need to be downloaded
         self.downloaded_videos = 0
         failed_downloads = 0
         copied_videos = 0
         consecutive_timeouts = 0
         self.total_possible_videos = min(len(urls), amount) if amount != 0 else len(urls)
-        yt_dlp_archive_map = {}
+        urls_to_download = []
         for url in urls:
             # Check previously downloaded library
             if url in vid_lib.library:
@@ -342,32 +397,25 @@ class VideoDownloaderPlus(BasicProcessor):
                     self.dataset.log(f"Skipping; previously identified url as not a video: {url}")
                     continue
 
+            # Check videos downloaded for other datasets
+            cached = media_cache.get(url)
+            if cached:
+                try:
+                    if self.max_video_size == 0 or all([file["path"].stat().st_size <= self.max_video_size * 1000000 for file in cached["files"]]):
+                        filenames = media_cache.link_files(cached, results_path)
+                        urls[url].update(cached["metadata"])
+                        urls[url]["files"] = [{**file, "filename": filename} for file, filename in zip(cached["metadata"]["files"], filenames)]
+                        urls[url]["success"] = True
+                        self.dataset.log(f"Copied cached video to current dataset for url: {url}")
+                        copied_videos += len(filenames)
+                        continue
+                except FileNotFoundError:
+                    # removed from the cache in the meantime
+                    pass
+
             urls[url]["success"] = False
             urls[url]["retry"] = True
 
-            # Stop processing if worker has been asked to stop or max downloads reached
-            if self.downloaded_videos >= amount and amount != 0:
-                urls[url]["error"] = "Max video download limit already reached."
-                continue
-            if self.interrupted:
-                raise ProcessorInterruptedException("Interrupted while downloading videos.")
-
-            # Check for repeated timeouts
-            if consecutive_timeouts > 5:
-                if use_yt_dlp:
-                    message = "Downloaded %i videos. Timed out %i consecutive times; try " \
-                              "deselecting the non-direct videos setting" % (self.downloaded_videos, consecutive_timeouts)
-                else:
-                    message = "Downloaded %i videos. Timed out %i consecutive times; check logs to ensure " \
-                              "video URLs are working links and you are not being blocked." % (self.downloaded_videos, consecutive_timeouts)
-                self.dataset.update_status(message, is_final=True)
-                if self.downloaded_videos == 0:
-                    self.dataset.finish(0)
-                    return
-                else:
-                    # Finish processor with already downloaded videos
-                    break
-
             # Reject known channels; unknown will still download!
             if not download_channels and any([sub_url in url for sub_url in self.known_channels]):
                 message = 'Skipping known channel: %s' % url
@@ -376,124 +424,86 @@ class VideoDownloaderPlus(BasicProcessor):
                 self.dataset.log(message)
                 continue
 
-            self.videos_downloaded_from_url = 0
-            # First we'll try to see if we can directly download the URL
+            urls_to_download.append(url)
+
+        # Then download the remaining URLs, a number at a time; never start
+        # more downloads than could still be needed to reach the maximum
+        download_queue = iter(urls_to_download)
+        downloads = {}
+        probes = {}
+        stop_message = None
+        with ThreadPoolExecutor(max_workers=max_downloads) as download_pool, \
+                ThreadPoolExecutor(max_workers=self.max_probes) as probe_pool:
             try:
-                filename = self.download_video_with_requests(url, results_path, max_video_size)
-                urls[url]["downloader"] = "direct_link"
-                urls[url]["files"] = [{
-                    "filename": filename,
-                    "metadata": {},
-                    "success": True
-                }]
-                success = True
-                self.videos_downloaded_from_url = 1
-            except (requests.exceptions.Timeout, requests.exceptions.SSLError, requests.exceptions.ConnectionError, FilesizeException, FailedDownload, NotAVideo) as e:
-                # FilesizeException raised when file size is too large or unknown filesize (and that is disabled in 4CAT settings)
-                # FailedDownload raised when response other than 200 received
-                # NotAVideo raised due to specific Content-Type known to not be a video (and not a webpage/html that could lead to a video via YT-DLP)
-                self.dataset.log(str(e))
-                urls[url]["error"] = str(e)
-                if type(e) is requests.exceptions.Timeout:
-                    # TODO: retry timeouts?
-                    consecutive_timeouts += 1
-                if type(e) in [requests.exceptions.Timeout, requests.exceptions.SSLError, requests.exceptions.ConnectionError, FilesizeException, FailedDownload]:
-                    failed_downloads += 1
-                if type(e) in [NotAVideo]:
-                    # No need to retry non videos
-                    urls[url]["retry"] = False
-                continue
-            except VideoStreamUnavailable as e:
-                if use_yt_dlp:
-                    # Take it away yt-dlp
-                    # Update filename
-                    ydl_opts["outtmpl"] = str(results_path) + '/' + re.sub(r"[^0-9a-z]+", "_", url.lower())[
-                                                                    :100] + '_%(autonumber)s.%(ext)s'
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        # Count and use self.yt_dlp_monitor() to ensure sure we don't download videos forever...
-                        self.url_files = []
-                        self.last_dl_status = {}
-                        self.last_post_process_status = {}
-                        self.dataset.update_status("Downloading %i/%i via yt-dlp: %s" % (
-                        self.downloaded_videos + 1, self.total_possible_videos, url))
-                        try:
-                            info = ydl.extract_info(url)
-                        except MaxVideosDownloaded:
-                            # Raised when already downloaded max number of videos per URL as defined in self.max_videos_per_url
-                            pass
-                        except ExistingVideoReached:
-                            # Video already downloaded; grab from archive
-                            # TODO: with multiple videos per URL, this may not capture the desired video and would instead repeat the first video; Need more feedback from yt-dlp!
-                            with yt_dlp.YoutubeDL({"socket_timeout": 30}) as ydl2:
-                                info2 = ydl2.extract_info(url, download=False)
-                                if info2:
-                                    self.url_files.append(yt_dlp_archive_map[info2.get('extractor') + info2.get('id')])
-                                    self.dataset.log("Already downloaded video associated with: %s" % url)
-                                else:
-                                    message = f"Video identified, but unable to identify which video from {url}"
-                                    self.dataset.log(message)
-                                    self.log.warning(message)
-                                    if self.videos_downloaded_from_url == 0:
-                                        # No videos downloaded for this URL
-                                        urls[url]['error'] = message
-                                        continue
-                        except (DownloadError, LiveVideoException) as e:
-                            # LiveVideoException raised when a video is known to be live
-                            if "Requested format is not available" in str(e):
-                                message = f"No format available for video (filesize less than {max_size}" + " and unknown sizes not allowed)" if not allow_unknown_sizes else ")"
-                            elif "Unable to download webpage: The read operation timed out" in str(e):
-                                # Certain sites fail repeatedly (22-12-8 TikTok has this issue)
-                                consecutive_timeouts += 1
-                                message = 'DownloadError: %s' % str(e)
-                            elif "HTTP Error 429: Too Many Requests" in str(e):
-                                # Oh no, https://github.com/yt-dlp/yt-dlp/wiki/FAQ#http-error-429-too-many-requests-or-402-payment-required
-                                consecutive_timeouts += 1
-                                message = 'Too Many Requests: %s' % str(e)
-                                # We can try waiting...
-                                # TODO: Should we check to see if we are hitting the same domain repeatedly?
-                                time.sleep(10 * consecutive_timeouts)
-                                # TODO: Add url back to end?
-                            else:
-                                message = 'DownloadError: %s' % str(e)
-                            urls[url]['error'] = message
-                            failed_downloads += 1
-                            self.dataset.log(message)
+                while True:
+                    while not stop_message and len(downloads) < max_downloads and \
+                            (amount == 0 or self.downloaded_videos + len(downloads) < amount):
+                        url = next(download_queue, None)
+                        if url is None:
+                            break
+                        downloads[download_pool.submit(self.download_url, url, results_path, media_cache)] = url
+
+                    if not downloads and not probes:
+                        break
+
+                    done = wait(list(downloads) + list(probes), timeout=1, return_when=FIRST_COMPLETED)[0]
+
+                    # Stop processing if worker has been asked to stop
+                    if self.interrupted:
+                        raise ProcessorInterruptedException("Interrupted while downloading videos.")
+
+                    for future in done:
+                        if future in probes:
+                            probes.pop(future)["probe"] = future.result()
                             continue
-                        except Exception as e:
-                            # Catch all other issues w/ yt-dlp
-                            message = "YT-DLP raised unexpected error: %s" % str(e)
-                            urls[url]['error'] = message
-                            failed_downloads += 1
-                            self.dataset.log(message)
-
-                    # Add file data collected by YT-DLP
-                    urls[url]["downloader"] = "yt_dlp"
-                    urls[url]['files'] = self.url_files
-                    # Add to archive mapping in case needed
-                    for file in self.url_files:
-                        yt_dlp_archive_map[
-                            file.get('metadata').get('extractor') + file.get('metadata').get('id')] = file
 
-                    # Check that download and processing finished
-                    success = all([self.last_dl_status.get('status') == 'finished',
-                                   self.last_post_process_status.get('status') == 'finished'])
+                        url = downloads.pop(future)
+                        result = future.result()
+                        urls[url].update(result["metadata"])
 
-                else:
-                    # No YT-DLP; move on
-                    self.dataset.log(str(e))
-                    urls[url]["error"] = str(e)
-                    continue
-
-            urls[url]["success"] = success
-            if success:
-                consecutive_timeouts = 0
+                        if result["timeout"]:
+                            consecutive_timeouts += 1
+                        if result["rate_limited"]:
+                            # Wait a bit before requesting from this site again
+                            self.throttle.defer(url, 10 * consecutive_timeouts)
+                        if result["failed"]:
+                            failed_downloads += 1
 
-            # Update status
-            self.downloaded_videos += self.videos_downloaded_from_url
-            self.dataset.update_status(f"Downloaded {self.downloaded_videos}/{self.total_possible_videos} videos" +
-                                       (f"; videos copied from {copied_videos} previous downloads" if copied_videos > 0 else "") +
-                                       (f"; {failed_downloads} URLs failed." if failed_downloads > 0 else ""))
-            self.dataset.update_progress(self.downloaded_videos / self.total_possible_videos)
+                        if urls[url]["success"]:
+                            consecutive_timeouts = 0
+                            if ffprobe:
+                                for file in urls[url]["files"]:
+                                    probes[probe_pool.submit(self.probe_video, ffprobe, results_path.joinpath(file["filename"]))] = file
+
+                        # Check for repeated timeouts
+                        if consecutive_timeouts > 5 and not stop_message:
+                            if self.use_yt_dlp:
+                                stop_message = "Downloaded %i videos. Timed out %i consecutive times; try " \
+                                               "deselecting the non-direct videos setting" % (self.downloaded_videos, consecutive_timeouts)
+                            else:
+                                stop_message = "Downloaded %i videos. Timed out %i consecutive times; check logs to ensure " \
+                                               "video URLs are working links and you are not being blocked." % (self.downloaded_videos, consecutive_timeouts)
+
+                        # Update status
+                        self.downloaded_videos += result["num_videos"]
+                        self.dataset.update_status(f"Downloaded {self.downloaded_videos}/{self.total_possible_videos} videos" +
+                                                   (f"; videos copied from {copied_videos} previous downloads" if copied_videos > 0 else "") +
+                                                   (f"; {failed_downloads} URLs failed." if failed_downloads > 0 else ""))
+                        self.dataset.update_progress(self.downloaded_videos / self.total_possible_videos)
+            finally:
+                # Don't start downloads that are no longer needed; the ones in
+                # progress stop at the next interruption check
+                for future in list(downloads) + list(probes):
+                    future.cancel()
+
+        if stop_message:
+            self.dataset.update_status(stop_message, is_final=True)
+            if self.downloaded_videos == 0:
+                self.dataset.finish(0)
+                return
+        else:
+            for url in download_queue:
+                urls[url]["error"] = "Max video download limit already reached."
 
         # Save some metadata to be able to connect the videos to their source
         metadata = {
@@ -506,20 +516,249 @@ class VideoDownloaderPlus(BasicProcessor):
         with results_path.joinpath(".metadata.json").open("w", encoding="utf-8") as outfile:
             json.dump(metadata, outfile)
 
+        media_cache.trim()
+
         # Finish up
         self.dataset.update_status(f"Downloaded {self.downloaded_videos} videos" +
                                    (f"; videos copied from {copied_videos} previous downloads" if copied_videos > 0 else "") +
                                    (f"; {failed_downloads} URLs failed." if failed_downloads > 0 else ""), is_final=True)
         self.write_archive_and_finish(results_path)
 
-    def yt_dlp_monitor(self, d):
+    def download_url(self, url, results_path, media_cache):
+        """
+        Download the video(s) a URL links to
+
+        First attempts to download the URL directly; if it does not link to a
+        video file, yt-dlp is used instead (if enabled). Called from the
+        download pool in `process()`; rather than logging to the dataset
+        itself, this returns a result that `process()` records.
+
+        :param str url:  URL to download from
+        :param Path results_path:  Staging area to save videos in
+        :param MediaCache media_cache:  Cache to add downloaded videos to
+        :return dict:  Download result, with the `metadata` to store for the
+        URL, the amount of videos downloaded (`num_videos`), and whether the
+        download `failed`, had a `timeout`, or was `rate_limited`
+        """
+        result = {"metadata": {}, "num_videos": 0, "failed": False, "timeout": False, "rate_limited": False}
+
+        # First we'll try to see if we can directly download the URL
+        try:
+            with self.throttle.request(url), self.acquire_slot(self.direct_slots):
+                filename = self.download_video_with_requests(url, results_path, self.max_video_size)
+
+            result["metadata"] = {
+                "downloader": "direct_link",
+                "files": [{
+                    "filename": filename,
+                    "metadata": {},
+                    "success": True
+                }],
+                "success": True
+            }
+            result["num_videos"] = 1
+            media_cache.add(url, [results_path.joinpath(filename)],
+                            metadata={"downloader": "direct_link", "files": result["metadata"]["files"]})
+        except (requests.exceptions.Timeout, requests.exceptions.SSLError, requests.exceptions.ConnectionError, FilesizeException, FailedDownload, NotAVideo) as e:
+            # FilesizeException raised when file size is too large or unknown filesize (and that is disabled in 4CAT settings)
+            # FailedDownload raised when response other than 200 received
+            # NotAVideo raised due to specific Content-Type known to not be a video (and not a webpage/html that could lead to a video via YT-DLP)
+            self.dataset.log(str(e))
+            result["metadata"]["error"] = str(e)
+            if type(e) is requests.exceptions.Timeout:
+                # TODO: retry timeouts?
+                result["timeout"] = True
+            if type(e) in [requests.exceptions.Timeout, requests.exceptions.SSLError, requests.exceptions.ConnectionError, FilesizeException, FailedDownload]:
+                result["failed"] = True
+            if type(e) in [NotAVideo]:
+                # No need to retry non videos
+                result["metadata"]["retry"] = False
+        except VideoStreamUnavailable as e:
+            if self.use_yt_dlp:
+                # Take it away yt-dlp
+                with self.throttle.request(url), self.acquire_slot(self.yt_dlp_slots):
+                    self.download_with_yt_dlp(url, results_path, media_cache, result)
+            else:
+                # No YT-DLP; move on
+                self.dataset.log(str(e))
+                result["metadata"]["error"] = str(e)
+
+        return result
+
+    def download_with_yt_dlp(self, url, results_path, media_cache, result):
+        """
+        Download the video(s) a URL links to with yt-dlp
+
+        :param str url:  URL to download from
+        :param Path results_path:  Staging area to save videos in
+        :param MediaCache media_cache:  Cache to add downloaded videos to
+        :param dict result:  Download result, as returned by `download_url()`,
+        to update
+        """
+        allow_unknown_sizes = config.get('video_downloader.DOWNLOAD_UNKNOWN_SIZE', False)
+        max_size = str(self.max_video_size) + "M"
+
+        # Keep track of what yt-dlp does with this URL
+        state = {"url_files": [], "videos_downloaded": 0, "last_dl_status": {}, "last_post_process_status": {}}
+        ydl_opts = {
+            **self.ydl_opts,
+            "outtmpl": str(results_path) + '/' + re.sub(r"[^0-9a-z]+", "_", url.lower())[:100] + '_%(autonumber)s.%(ext)s',
+            "postprocessor_hooks": [lambda d: self.yt_dlp_post_monitor(d, state)],
+            # This function ensures no more than self.max_videos_per_url downloaded and can be used to monitor progress
+            "progress_hooks": [lambda d: self.yt_dlp_monitor(d, state)],
+        }
+        metadata = result["metadata"]
+
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            # Count and use self.yt_dlp_monitor() to ensure sure we don't download videos forever...
+            try:
+                info = ydl.extract_info(url)
+            except MaxVideosDownloaded:
+                # Raised when already downloaded max number of videos per URL as defined in self.max_videos_per_url
+                pass
+            except ExistingVideoReached:
+                # Video already downloaded; grab from archive
+                # TODO: with multiple videos per URL, this may not capture the desired video and would instead repeat the first video; Need more feedback from yt-dlp!
+                with yt_dlp.YoutubeDL({"socket_timeout": 30}) as ydl2:
+                    info2 = ydl2.extract_info(url, download=False)
+                    # the download this was archived by may still be finishing
+                    archived = self.yt_dlp_archive_map.get(info2.get('extractor') + info2.get('id')) if info2 else None
+                    if archived:
+                        state["url_files"].append(archived)
+                        self.dataset.log("Already downloaded video associated with: %s" % url)
+                    else:
+                        message = f"Video identified, but unable to identify which video from {url}"
+                        self.dataset.log(message)
+                        self.log.warning(message)
+                        if state["videos_downloaded"] == 0:
+                            # No videos downloaded for this URL
+                            metadata['error'] = message
+                            return
+            except (DownloadError, LiveVideoException) as e:
+                # LiveVideoException raised when a video is known to be live
+                if "Requested format is not available" in str(e):
+                    message = f"No format available for video (filesize less than {max_size}" + " and unknown sizes not allowed)" if not allow_unknown_sizes else ")"
+                elif "Unable to download webpage: The read operation timed out" in str(e):
+                    # Certain sites fail repeatedly (22-12-8 TikTok has this issue)
+                    result["timeout"] = True
+                    message = 'DownloadError: %s' % str(e)
+                elif "HTTP Error 429: Too Many Requests" in str(e):
+                    # Oh no, https://github.com/yt-dlp/yt-dlp/wiki/FAQ#http-error-429-too-many-requests-or-402-payment-required
+                    result["timeout"] = True
+                    message = 'Too Many Requests: %s' % str(e)
+                    # We can try waiting... requests to this site are
+                    # postponed when the result is processed
+                    result["rate_limited"] = True
+                    # TODO: Add url back to end?
+                else:
+                    message = 'DownloadError: %s' % str(e)
+                metadata['error'] = message
+                result["failed"] = True
+                self.dataset.log(message)
+                return
+            except Exception as e:
+                # Catch all other issues w/ yt-dlp
+                message = "YT-DLP raised unexpected error: %s" % str(e)
+                metadata['error'] = message
+                result["failed"] = True
+                self.dataset.log(message)
+
+        # Add file data collected by YT-DLP
+        metadata["downloader"] = "yt_dlp"
+        metadata['files'] = state["url_files"]
+        # Add to archive mapping in case needed
+        for file in state["url_files"]:
+            self.yt_dlp_archive_map[file.get('metadata').get('extractor') + file.get('metadata').get('id')] = file
+
+        # Check that download and processing finished
+        metadata["success"] = all([state["last_dl_status"].get('status') == 'finished',
+                                   state["last_post_process_status"].get('status') == 'finished'])
+        result["num_videos"] = state["videos_downloaded"]
+
+        if metadata["success"] and state["url_files"]:
+            media_cache.add(url, [results_path.joinpath(file["filename"]) for file in state["url_files"]],
+                            metadata={"downloader": "yt_dlp", "files": [sets_to_lists(file) for file in state["url_files"]]})
+
+    @contextmanager
+    def acquire_slot(self, slots):
+        """
+        Wait for a download slot, unless interrupted
+
+        :param threading.BoundedSemaphore slots:  Slots to acquire one of
+        """
+        while not slots.acquire(timeout=1):
+            if self.interrupted:
+                raise ProcessorInterruptedException("Interrupted while downloading videos.")
+
+        try:
+            yield
+        finally:
+            slots.release()
+
+    @staticmethod
+    def get_ffprobe_path():
+        """
+        Get path to ffprobe executable
+
+        ffprobe is distributed with ffmpeg, so it is looked for next to the
+        configured ffmpeg executable.
+
+        :return str:  Path, or `None` if ffprobe is not available
+        """
+        ffmpeg_path = shutil.which(config.get("video_downloader.ffmpeg-path") or "")
+        if not ffmpeg_path:
+            return None
+
+        return shutil.which(str(Path(ffmpeg_path).with_name("ffprobe")))
+
+    @staticmethod
+    def probe_video(ffprobe, path):
+        """
+        Get basic properties of a downloaded video with ffprobe
+
+        :param str ffprobe:  Path to ffprobe executable
+        :param Path path:  Video file
+        :return dict:  Duration (in seconds) and container format of the video,
+        and codec and dimensions of its video stream; `None` if the file could
+        not be probed
+        """
+        try:
+            result = subprocess.run([ffprobe, "-v", "error", "-print_format", "json", "-show_format", "-show_streams",
+                                     str(path)], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, timeout=60)
+            probe = json.loads(result.stdout)
+        except (OSError, subprocess.TimeoutExpired, json.JSONDecodeError):
+            return None
+
+        if result.returncode != 0 or "format" not in probe:
+            return None
+
+        video_stream = [stream for stream in probe.get("streams", []) if stream.get("codec_type") == "video"]
+        video_stream = video_stream[0] if video_stream else {}
+        try:
+            duration = float(probe["format"].get("duration"))
+        except (TypeError, ValueError):
+            duration = None
+
+        return {
+            "duration": duration,
+            "format": probe["format"].get("format_name"),
+            "codec": video_stream.get("codec_name"),
+            "width": video_stream.get("width"),
+            "height": video_stream.get("height")
+        }
+
+    def yt_dlp_monitor(self, d, state):
         """
         Can be used to gather information from yt-dlp while downloading
+
+        :param dict d:  Status reported by yt-dlp
+        :param dict state:  State of the download of the current URL
         """
-        self.last_dl_status = d
+        state["last_dl_status"] = d
 
         # Check if Max Video Downloads already reached
-        if self.videos_downloaded_from_url != 0 and self.videos_downloaded_from_url >= self.max_videos_per_url:
+        if state["videos_downloaded"] != 0 and state["videos_downloaded"] >= self.max_videos_per_url:
             # DO NOT RAISE ON 0! (22-12-8 max_videos_per_url should no longer ever be 0)
             raise MaxVideosDownloaded('Max videos for URL reached.')
 
@@ -527,14 +766,17 @@ class VideoDownloaderPlus(BasicProcessor):
         if self.interrupted:
             raise ProcessorInterruptedException("Interrupted while downloading videos.")
 
-    def yt_dlp_post_monitor(self, d):
+    def yt_dlp_post_monitor(self, d, state):
         """
         Can be used to gather information from yt-dlp while post processing the downloads
+
+        :param dict d:  Status reported by yt-dlp
+        :param dict state:  State of the download of the current URL
         """
-        self.last_post_process_status = d
+        state["last_post_process_status"] = d
         if d['status'] == 'finished':  # "downloading", "error", or "finished"
-            self.videos_downloaded_from_url += 1
-            self.url_files.append({
+            state["videos_downloaded"] += 1
+            state["url_files"].append({
                 "filename": Path(d.get('info_dict').get('_filename')).name,
                 "metadata": d.get('info_dict'),
                 "success": True
@@ -582,9 +824,6 @@ class VideoDownloaderPlus(BasicProcessor):
                     self.dataset.log(f"DEBUG: Odd extension type {extension}; Notify 4CAT maintainers if video. "
                                      f"Content-Type for url {url}: {response.headers['Content-Type']}")
 
-                # Ensure unique filename
-                save_location = url_to_filename(url, extension, results_path)
-
                 # Check video size (after ensuring it is actually a video above)
                 if not max_video_size == 0:
                     if response.headers.get("Content-Length", False):
@@ -593,15 +832,31 @@ class VideoDownloaderPlus(BasicProcessor):
                                 f"Video size {response.headers.get('Content-Length')} larger than maximum allowed per 4CAT")
                     # Size unknown
                     elif not config.get("video_downloader.DOWNLOAD_UNKNOWN_SIZE", False):
-                        FilesizeException("Video size unknown; not allowed to download per 4CAT settings")
+                        raise FilesizeException("Video size unknown; not allowed to download per 4CAT settings")
+
+                # Ensure unique filename, also when downloading concurrently
+                with self.filename_lock:
+                    save_location = url_to_filename(url, extension, results_path)
+                    save_location.touch()
 
                 # Download video
-                self.dataset.update_status(
-                    "Downloading %i/%i via requests: %s" % (self.downloaded_videos + 1, self.total_possible_videos, url))
-                with open(results_path.joinpath(save_location), "wb") as f:
-                    for chunk in response.iter_content(chunk_size=1024 * 1024):
-                        if chunk:
-                            f.write(chunk)
+                try:
+                    downloaded_size = 0
+                    with open(results_path.joinpath(save_location), "wb") as f:
+                        for chunk in response.iter_content(chunk_size=1024 * 1024):
+                            if self.interrupted:
+                                raise ProcessorInterruptedException("Interrupted while downloading videos.")
+
+                            downloaded_size += len(chunk)
+                            if not max_video_size == 0 and downloaded_size > (max_video_size * 1000000):
+                                # Content-Length was missing or wrong
+                                raise FilesizeException(f"Video size larger than maximum allowed per 4CAT: {url}")
+
+                            if chunk:
+                                f.write(chunk)
+                except BaseException:
+                    save_location.unlink()
+                    raise
 
                 # Return filename to add to metadata
                 return save_location.name
@@ -724,6 +979,7 @@ class VideoDownloaderPlus(BasicProcessor):
 
         for file in data.get("files", [{}]):
             row["filename"] = file.get("filename", "N/A")
+            row["duration"] = (file.get("probe") or {}).get("duration", "N/A")
 
             yt_dlp_data = file.get("metadata", {})
             for common_column in ["title", "artist", "description", "view_count", "like_count", "repost_count", "comment_count", "uploader", "creator", "uploader_id"]:
@@ -10,6 +10,7 @@ from apiclient.discovery import build
 from backend.abstract.processor import BasicProcessor
 from common.lib.exceptions import ProcessorInterruptedException
 from common.lib.helpers import get_yt_compatible_ids
+from common.lib.media_cache import MediaCache
 
 __author__ = "Sal Hagen"
 __credits__ = ["Sal Hagen"]
@@ -63,11 +64,28 @@ class YouTubeThumbnails(BasicProcessor):
 		# prepare staging area
 		results_path = self.dataset.get_staging_area()
 
+		# thumbnails downloaded for other datasets are cached, and need not be
+		# requested via the API again. 'High' thumbnails are always at the
+		# same URL, so it is known in advance where they would be from
+		media_cache = MediaCache()
+		uncached_ids = []
+		for video_id in video_ids:
+			cached = media_cache.get("https://i.ytimg.com/vi/%s/hqdefault.jpg" % video_id)
+			if not cached:
+				uncached_ids.append(video_id)
+				continue
+
+			try:
+				media_cache.link_files(cached, results_path)
+			except FileNotFoundError:
+				# removed from the cache in the meantime
+				uncached_ids.append(video_id)
+
 		# Use YouTubeDL and the YouTube API to request video data
 		youtube = build(config.get('api.youtube.name'), config.get('api.youtube.version'),
 											developerKey=config.get('api.youtube.key'))
 		
-		ids_list = get_yt_compatible_ids(video_ids)
+		ids_list = get_yt_compatible_ids(uncached_ids)
 		retries = 0
 
 		for i, ids_string in enumerate(ids_list):
@@ -102,10 +120,13 @@ class YouTubeThumbnails(BasicProcessor):
 					save_path = results_path.joinpath(metadata["id"] + "." + str(thumb_url.split('.')[-1]))
 					# Download the image
 					urllib.request.urlretrieve(thumb_url, save_path)
+					media_cache.add(thumb_url, [save_path])
 
 			self.dataset.update_status("Downloaded thumbnails for " + str(i * 50) + "/" + str(len(video_ids)))
 			self.dataset.update_progress(i / len(ids_list))
 
+		media_cache.trim()
+
 		# create zip of archive and delete temporary files and folder
 		self.dataset.update_status("Compressing results into archive")
 
@@ -47,6 +47,7 @@ packages = [
 	"requests_futures",
 	"scikit-learn",
 	"scenedetect==0.6.0.3",
+	"scipy",
 	"shapely",
 	"spacy==3.4.3",
 	"svgwrite~=1.4.0",
@@ -16,14 +16,16 @@ if result.returncode != 0:
     print("stderr:\n".join(["  " + line for line in result.stderr.decode("utf-8").split("\n")]))
     exit(1)
 
-from flask import Flask
+from flask import Flask, g, has_app_context
 from flask_login import LoginManager
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from werkzeug.local import LocalProxy
 
 import common.config_manager as config
-from common.lib.database import Database
+from common.lib.database import Database, DatabasePool
 from common.lib.logger import Logger
+from common.lib.helpers import convert_to_int
 from common.lib.queue import JobQueue
 
 from webtool.lib.user import User
@@ -59,7 +61,47 @@ if config.get("USING_DOCKER"):
 else:
     log = Logger()
 
-db = Database(logger=log, dbname=database_name, appname="frontend")
+# requests check out a database connection from a pool shared by all request
+# threads of this process, if configured; the connection is returned to the
+# pool when the request has been handled
+pool_size = convert_to_int(config.get("flask.db_pool_size"), 10)
+db_pool = DatabasePool(size=pool_size, dbname=database_name, appname="frontend") if pool_size > 0 else None
+shared_db = None
+
+
+def get_db():
+    """
+    Get database handler for the current request
+
+    Outside of requests, or if no connection pool is used, a single connection
+    shared by the whole process is returned.
+
+    :return Database:  Database handler
+    """
+    global shared_db
+    if db_pool and has_app_context():
+        if "db" not in g:
+            g.db = Database(logger=log, dbname=database_name, appname="frontend", pool=db_pool)
+        return g.db
+
+    if shared_db is None:
+        shared_db = Database(logger=log, dbname=database_name, appname="frontend")
+    return shared_db
+
+
+@app.teardown_appcontext
+def release_db(exception=None):
+    """
+    Return the request's database connection to the pool
+
+    :param exception:  Exception raised while handling the request, if any
+    """
+    request_db = g.pop("db", None)
+    if request_db is not None:
+        request_db.close()
+
+
+db = LocalProxy(get_db)
 queue = JobQueue(logger=log, database=db)
 
 # initialize openapi endpoint collector for later specification generation
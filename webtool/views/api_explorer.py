@@ -5,7 +5,6 @@
 import datetime
 import common.config_manager as config
 import json
-import csv
 import re
 import operator
 #import markdown
@@ -22,6 +21,7 @@ from flask_login import login_required, current_user
 from webtool import app, db, log, openapi, limiter
 from webtool.lib.helpers import format_chan_post, error
 from common.lib.dataset import DataSet
+from common.lib.dataset_index import DatasetIndex
 from common.lib.helpers import strip_tags
 
 api_ratelimit = limiter.shared_limit("45 per minute", scope="api")
@@ -56,6 +56,8 @@ def explorer_dataset(key, page):
 	results_path = dataset.check_dataset_finished()
 	if not results_path:
 		return error(404, error="This dataset didn't finish executing (yet)")
+	elif results_path == "empty":
+		return error(404, error="No posts available for this datasource")
 
 	# The amount of posts to show on a page
 	limit = config.get("explorer.posts_per_page", 50)
@@ -99,37 +101,25 @@ def explorer_dataset(key, page):
 		force_int = False
 
 	# Load posts
-	post_ids = []
-	posts = []
-	count = 0
-
-	first_post = False
-
-
-	for post in iterate_items(results_path, max_rows=max_posts, sort_by=sort_by, descending=descending, force_int=force_int):
-
-		count += 1
-
-		# Use an offset if we're showing a page beyond the first.
-		if count <= offset:
-			continue
+	# The index is built once per dataset and lets us read any page, in any
+	# sort order, without going through the whole file.
+	try:
+		index = DatasetIndex(results_path, dataset.get_cache_area())
+	except NotImplementedError:
+		return error(404, error="This dataset cannot be explored")
 
-		# Use an offset if we're showing a page beyond the first.
-		if count <= offset:
-			continue
+	order = get_sort_order(index, sort_by, descending=descending, force_int=force_int, max_posts=max_posts) if sort_by else None
+	posts = index.get_items(offset, min(limit, max_posts - offset), order=order)
+	post_ids = []
 
+	for post in posts:
 		# Attribute column names and collect dataset's posts.
 		post_ids.append(post["id"])
-		posts.append(post)
 
 		if "link_id" in post:
 			if post["link_id"][2] == "_":
 				post["link_id"] = post["link_id"][3:]
 
-		# Stop if we exceed the max posts per page.
-		if count >= (offset + limit) or count > max_posts:
-			break
-
 	# Include custom css if it exists in the datasource's 'explorer' dir.
 	# The file's naming format should e.g. be 'reddit-explorer.css'.
 	css = get_custom_css(datasource)
@@ -505,69 +495,31 @@ def get_image_file(img_file, limit=0):
 
 	return send_file(str(image_path))
 
-def iterate_items(in_file, max_rows=None, sort_by=None, descending=False, force_int=False):
+def get_sort_order(index, sort_by, descending=False, force_int=False, max_posts=None):
 	"""
-	Loop through both csv and NDJSON files.
-	:param in_file, str:		The input file to read.
+	Get the order in which to show the posts of an indexed dataset.
+
+	:param DatasetIndex index:	Index of the dataset file.
 	:param sort_by, str:		The key that determines the sort order.
 	:param descending, bool:	Whether to sort by descending values.
 	:param force_int, bool:		Whether the sort value should be converted to an
 								integer.
-	"""
-
-	suffix = in_file.name.split(".")[-1].lower()
-
-	if suffix == "csv":
+	:param max_posts, int:		Only sort this many posts.
 
-		with open(in_file, "r", encoding="utf-8") as dataset_file:
-
-			# Sort on date by default
-			# Unix timestamp integers are not always saved in the same field.
-			reader = csv.reader(dataset_file)
-			columns = next(reader)
-			if sort_by:
-				try:
-					# Get index number of sort_by value
-					sort_by_index = columns.index(sort_by)
-
-					# Generate reader on the basis of sort_by value
-					reader = sorted(reader, key=lambda x: to_float(x[sort_by_index], convert=force_int) if len(x) >= sort_by_index else 0, reverse=descending)
-
-				except (ValueError, IndexError) as e:
-					pass
-
-			for item in reader:
-
-				# Add columns
-				item = {columns[i]: item[i] for i in range(len(item))}
-
-				yield item
-
-	elif suffix == "ndjson":
-
-		# In this format each line in the file is a self-contained JSON
-		# file
-		with open(in_file, "r", encoding="utf-8") as dataset_file:
-
-			# Unfortunately we can't easily sort here.
-			# We're just looping through the file if no sort is given.
-			if not sort_by:
-				for line in dataset_file:
-					item = json.loads(line)
-					yield item
-
-			# If a sort order is given explicitly, we're sorting anyway.
-			else:
-				keys = sort_by.split(".")
+	:return: Post numbers in the requested order, or `None` if the posts
+	cannot be sorted by the given key.
+	"""
 
-				if max_rows:
-					for item in sorted([json.loads(line) for i, line in enumerate(dataset_file) if i < max_rows], key=lambda x: to_float(get_nested_value(x, keys), convert=force_int), reverse=descending):
-							yield item
-				else:
-					for item in sorted([json.loads(line) for line in dataset_file], key=lambda x: to_float(get_nested_value(x, keys), convert=force_int), reverse=descending):
-							yield item
+	if index.meta["columns"] is not None:
+		# csv file; can only sort by existing columns
+		if sort_by not in index.meta["columns"]:
+			return None
+		sort_value = lambda item: to_float(item.get(sort_by, 0), convert=force_int)
+	else:
+		keys = sort_by.split(".")
+		sort_value = lambda item: to_float(get_nested_value(item, keys), convert=force_int)
 
-	return Exception("Can't loop through file with extension %s" % suffix)
+	return index.get_order(json.dumps([sort_by, force_int]), sort_value, descending=descending, max_items=max_posts)
 
 def get_posts(db, datasource, ids, board="", threads=False, limit=0, offset=0, order_by=["timestamp"]):
 
@@ -21,7 +21,7 @@ from flask import jsonify, request, render_template, render_template_string, red
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 
-from webtool import app, db, log, openapi, limiter, queue
+from webtool import app, db, db_pool, log, openapi, limiter, queue
 from webtool.lib.helpers import error
 
 from common.lib.exceptions import QueryParametersException, JobNotFoundException, QueryNeedsExplicitConfirmationException, QueryNeedsFurtherInputException
@@ -89,15 +89,28 @@ def api_status():
 	else:
 		backend_live = False
 
+	# connection pool usage, for the back-end via the internal API
+	backend_pool = None
+	if backend_live:
+		try:
+			backend_pool = call_api("db-pool").get("response")
+		except (ConnectionError, OSError, AttributeError):
+			pass
+
+	frontend_pool = {"enabled": True, **db_pool.get_stats()} if db_pool else {"enabled": False}
+
 	response = {
 		"code": API_SUCCESS,
 		"items": {
 			"backend": {
 				"live": backend_live,
-				"queued": jobs_sorted
+				"queued": jobs_sorted,
+				"db_pool": backend_pool
 			},
 			"frontend": {
-				"live": True  # duh
+				"live": True,  # duh
+				"settings_cache": config.settings_cache.get_stats(),
+				"db_pool": frontend_pool
 			}
 		}
 	}
@@ -948,12 +961,10 @@ def check_processor():
 
 	children = []
 
-	for key in keys:
-		try:
-			dataset = DataSet(key=key, db=db)
-		except TypeError:
-			continue
+	if type(keys) is not list:
+		return error(406, error="Unexpected format for child dataset key list.")
 
+	for dataset in DataSet.load_tree(keys, db=db):
 		if not current_user.can_access_dataset(dataset):
 			continue
 
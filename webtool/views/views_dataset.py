@@ -1,7 +1,6 @@
 """
 4CAT Web Tool views - pages to be viewed by the user
 """
-import json
 import csv
 import io
 import os
@@ -133,10 +132,9 @@ def show_results(page):
 
     # some housekeeping to prepare data for the template
     pagination = Pagination(page, page_size, num_datasets)
-    filtered = []
 
-    for dataset in datasets:
-        filtered.append(DataSet(key=dataset["key"], db=db))
+    # load the datasets with all their children in one go
+    filtered = DataSet.load_tree([dataset["key"] for dataset in datasets], db=db)
 
     favourites = [row["key"] for row in
                   db.fetchall("SELECT key FROM users_favourites WHERE name = %s", (current_user.get_id(),))]
@@ -192,8 +190,6 @@ def get_mapped_result(key):
         # cannot map without a mapping method
         return error(404, error="File not found.")
 
-    mapper = dataset.get_own_processor().map_item
-
     def map_response():
         """
         Yield a CSV file line by line
@@ -204,21 +200,21 @@ def get_mapped_result(key):
         """
         writer = None
         buffer = io.StringIO()
-        with dataset.get_results_path().open() as infile:
-            for line in infile:
-                mapped_item = mapper(json.loads(line))
-                if not writer:
-                    writer = csv.DictWriter(buffer, fieldnames=tuple(mapped_item.keys()))
-                    writer.writeheader()
-                    yield buffer.getvalue()
-                    buffer.truncate(0)
-                    buffer.seek(0)
-
-                writer.writerow(mapped_item)
+        # iterate_items maps the items, or reads them from the mapped item
+        # cache if they have been mapped before
+        for mapped_item in dataset.iterate_items():
+            if not writer:
+                writer = csv.DictWriter(buffer, fieldnames=tuple(mapped_item.keys()))
+                writer.writeheader()
                 yield buffer.getvalue()
                 buffer.truncate(0)
                 buffer.seek(0)
 
+            writer.writerow(mapped_item)
+            yield buffer.getvalue()
+            buffer.truncate(0)
+            buffer.seek(0)
+
     disposition = 'attachment; filename="%s"' % dataset.get_results_path().with_suffix(".csv").name
     return app.response_class(stream_with_context(map_response()), mimetype="text/csv",
                               headers={"Content-Disposition": disposition})
@@ -313,9 +309,11 @@ def show_result(key):
     :param key:  Result key
     :return:  Rendered template
     """
+    # the page shows the full tree of processors run on this dataset, which is
+    # loaded in one go
     try:
-        dataset = DataSet(key=key, db=db)
-    except TypeError:
+        dataset = DataSet.load_tree([key], db=db)[0]
+    except IndexError:
         return error(404)
 
     if not current_user.can_access_dataset(dataset):